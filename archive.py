@@ -0,0 +1,257 @@
+import json
+import os
+import queue
+import sys
+import threading
+from typing import Optional
+
+import numpy as np
+
+import utils
+from classes import Relation, RelationTable
+
+# A compact per-epoch archive of the eval predictions, as an alternative to writing out outputs_{epoch}.json
+# from inside compute_accuracy. Nothing gets decoded to strings at eval time; each epoch is a directory
+#
+#   {output_dir}/outputs_{epoch}/
+#       pred_ids.bin, pred_offsets.bin      every predicted token id (int32, trailing padding dropped),
+#                                           row i is pred_ids[pred_offsets[i]:pred_offsets[i+1]] (int64)
+#       true_ids.bin, true_offsets.bin      same, for the labels
+#       rows.bin                            which row of the eval split each row came from (int64)
+#       pred_relations.npz                  the delinearized relations, as RelationTables
+#       true_relations.npz
+#       meta.json                           written last, so its existence means the epoch is complete
+#
+# The .bin files are raw arrays that can be memory-mapped (see EpochArchive). All of the writing happens on
+# a background thread, so the trainer only pays for copying each batch onto a queue. read_epoch/write_json
+# turn an epoch back into exactly what outputs_{epoch}.json used to contain.
+
+# how many batches can be waiting to be written before add_batch blocks
+MAX_PENDING_BATCHES = 64
+
+_ARRAYS = {
+    'pred_ids': np.int32,
+    'pred_offsets': np.int64,
+    'true_ids': np.int32,
+    'true_offsets': np.int64,
+    'rows': np.int64,
+}
+
+
+def _strip_padding(token_ids: np.ndarray, pad_ids: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    parameters:
+        token_ids: (N, L) matrix of token ids
+        pad_ids: the ids that count as padding (all special tokens, so decoding never sees them anyway)
+    returns:
+        the rows with their trailing padding dropped, concatenated, and their lengths
+    """
+    if token_ids.shape[1] == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(len(token_ids), dtype=np.int64)
+    not_pad = ~np.isin(token_ids, pad_ids)
+    # the length of each row is one past its last non-pad token
+    lengths = np.where(not_pad.any(axis=1), token_ids.shape[1] - np.argmax(not_pad[:, ::-1], axis=1), 0)
+    keep = np.arange(token_ids.shape[1])[None, :] < lengths[:, None]
+    return token_ids[keep].astype(np.int32), lengths.astype(np.int64)
+
+
+class _EpochWriter:
+    # everything in here runs on the archiver's background thread
+    def __init__(self, epoch_dir: str, meta: dict, relation_types: dict):
+        os.makedirs(epoch_dir, exist_ok=True)
+        self.epoch_dir = epoch_dir
+        self.meta = meta
+        self.relation_types = relation_types
+        self.files = {name: open(f'{epoch_dir}/{name}.bin', 'wb') for name in _ARRAYS}
+        self.offsets = {'pred': 0, 'true': 0}
+        for prefix in self.offsets:
+            self.files[f'{prefix}_offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+        self.pred_tables: list[RelationTable] = []
+        self.true_tables: list[RelationTable] = []
+        self.n_rows = 0
+
+    def write_batch(self, predictions: np.ndarray, labels: np.ndarray, rows: np.ndarray,
+                    pred_relations: list[list[Relation]], true_relations: list[list[Relation]]) -> None:
+        for prefix, token_ids in [('pred', predictions), ('true', labels)]:
+            ids, lengths = _strip_padding(token_ids, self.meta['pad_ids'])
+            self.files[f'{prefix}_ids'].write(ids.tobytes())
+            offsets = self.offsets[prefix] + np.cumsum(lengths)
+            self.files[f'{prefix}_offsets'].write(offsets.astype(np.int64).tobytes())
+            self.offsets[prefix] = int(offsets[-1]) if len(offsets) else self.offsets[prefix]
+        self.files['rows'].write(rows.astype(np.int64).tobytes())
+        self.pred_tables.append(RelationTable.from_relations(pred_relations, self.relation_types))
+        self.true_tables.append(RelationTable.from_relations(true_relations, self.relation_types))
+        self.n_rows += len(rows)
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        RelationTable.concat(self.pred_tables).save(f'{self.epoch_dir}/pred_relations.npz')
+        RelationTable.concat(self.true_tables).save(f'{self.epoch_dir}/true_relations.npz')
+        meta = {**self.meta, 'n_rows': self.n_rows, 'dtypes': {name: np.dtype(t).str for name, t in _ARRAYS.items()}}
+        tmp_fname = f'{self.epoch_dir}/meta.json.tmp'
+        json.dump(meta, open(tmp_fname, 'w'), indent=2)
+        os.replace(tmp_fname, f'{self.epoch_dir}/meta.json')
+
+
+class PredictionArchiver:
+    """
+    Writes each epoch's eval predictions to an archive on a background thread.
+        archiver.start_epoch(epoch); archiver.add_batch(...) for each batch; archiver.end_epoch()
+    and archiver.close() at the end, which waits for everything to be written.
+    """
+    def __init__(self, output_dir: str, relation_types: dict, meta: dict):
+        """
+        parameters:
+            output_dir: where the outputs_{epoch} directories go
+            relation_types: the contents of rel_types.json (fixes the relation type ids)
+            meta: what's needed to rebuild the json view later: model_ckpt, tokens_file, eval_file, and
+                the pad_ids to strip from the ends of rows
+        """
+        self.output_dir = output_dir
+        self.relation_types = relation_types
+        self.meta = meta
+        self.tasks: queue.Queue = queue.Queue(maxsize=MAX_PENDING_BATCHES)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, name='PredictionArchiver', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        writer = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                # skip everything after a failure; it gets raised on the trainer's thread
+                continue
+            try:
+                kind, args = task
+                if kind == 'start':
+                    writer = _EpochWriter(*args, relation_types=self.relation_types)
+                elif kind == 'batch':
+                    writer.write_batch(*args)
+                elif kind == 'end':
+                    writer.close()
+                    writer = None
+            except BaseException as e:
+                self.error = e
+
+    def _put(self, task) -> None:
+        if self.error is not None:
+            raise RuntimeError('writing the prediction archive failed') from self.error
+        self.tasks.put(task)
+
+    def epoch_dir(self, epoch: int) -> str:
+        return f'{self.output_dir}/outputs_{epoch}'
+
+    def start_epoch(self, epoch: int) -> None:
+        self._put(('start', (self.epoch_dir(epoch), {**self.meta, 'epoch': epoch})))
+
+    def add_batch(self, predictions: np.ndarray, labels: np.ndarray, rows: np.ndarray,
+                  pred_relations: list[list[Relation]], true_relations: list[list[Relation]]) -> None:
+        # copies, since the caller is free to reuse its buffers as soon as this returns
+        self._put(('batch', (np.array(predictions), np.array(labels), np.array(rows),
+                             pred_relations, true_relations)))
+
+    def end_epoch(self) -> None:
+        self._put(('end', ()))
+
+    def close(self) -> None:
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('writing the prediction archive failed') from self.error
+
+
+class EpochArchive:
+    """
+    One epoch's archive, opened read-only. The token id arrays are memory-mapped.
+    """
+    def __init__(self, epoch_dir: str):
+        if not os.path.exists(f'{epoch_dir}/meta.json'):
+            raise FileNotFoundError(f'{epoch_dir} is not a complete prediction archive')
+        self.epoch_dir = epoch_dir
+        self.meta = json.load(open(f'{epoch_dir}/meta.json'))
+        self.arrays = {name: np.memmap(f'{epoch_dir}/{name}.bin', dtype=np.dtype(dtype), mode='r')
+                       if os.path.getsize(f'{epoch_dir}/{name}.bin') else np.zeros(0, dtype=np.dtype(dtype))
+                       for name, dtype in self.meta['dtypes'].items()}
+
+    def __len__(self) -> int:
+        return self.meta['n_rows']
+
+    def __repr__(self) -> str:
+        return f'<EpochArchive {self.epoch_dir} {len(self)} rows>'
+
+    def _row(self, prefix: str, i: int) -> np.ndarray:
+        offsets = self.arrays[f'{prefix}_offsets']
+        return self.arrays[f'{prefix}_ids'][offsets[i]:offsets[i + 1]]
+
+    def predictions(self, i: int) -> np.ndarray:
+        return self._row('pred', i)
+
+    def labels(self, i: int) -> np.ndarray:
+        return self._row('true', i)
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self.arrays['rows']
+
+    def pred_relations(self) -> list[list[Relation]]:
+        return RelationTable.load(f'{self.epoch_dir}/pred_relations.npz').to_relations()
+
+    def true_relations(self) -> list[list[Relation]]:
+        return RelationTable.load(f'{self.epoch_dir}/true_relations.npz').to_relations()
+
+    def load_tokenizer(self):
+        # the same tokenizer train.py used: the checkpoint's, plus the encoding's new tokens
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(self.meta['model_ckpt'])
+        tokenizer.add_tokens(json.load(open(self.meta['tokens_file'])))
+        return tokenizer
+
+    def to_json(self, tokenizer=None, texts: list[str] = None) -> list[dict]:
+        """
+        parameters:
+            tokenizer: for decoding the targets (default: rebuilt from the meta)
+            texts: the eval split's texts (default: read from the eval file in the meta, a .json or a .corpus)
+        returns:
+            the same records that used to be written to outputs_{epoch}.json
+        """
+        tokenizer = tokenizer or self.load_tokenizer()
+        if texts is None:
+            if self.meta['eval_file'].endswith('.corpus'):
+                texts = [article.text for article in utils.read_articles(self.meta['eval_file'])]
+            else:
+                texts = [record['text'] for record in utils.iter_json_array(self.meta['eval_file'])]
+        outputs = []
+        for i, (row, p_rels, t_rels) in enumerate(zip(self.rows.tolist(), self.pred_relations(), self.true_relations())):
+            outputs.append({
+                'row': row,
+                'text': texts[row],
+                'pred_target': tokenizer.decode(self.predictions(i), skip_special_tokens=True),
+                'true_target': tokenizer.decode(self.labels(i), skip_special_tokens=True),
+                'pred_relations': [rel.to_dict() for rel in p_rels],
+                'true_relations': [rel.to_dict() for rel in t_rels]
+            })
+        return outputs
+
+
+def read_epoch(output_dir: str, epoch: int) -> EpochArchive:
+    return EpochArchive(f'{output_dir}/outputs_{epoch}')
+
+def write_json(output_dir: str, epoch: int, tokenizer=None) -> str:
+    """
+    Writes an archived epoch out as outputs_{epoch}.json, next to the archive.
+    returns:
+        the json file name
+    """
+    fname = f'{output_dir}/outputs_{epoch}.json'
+    with utils.JsonArrayWriter(fname) as writer:
+        writer.write_all(read_epoch(output_dir, epoch).to_json(tokenizer))
+    return fname
+
+
+if __name__ == '__main__':
+    # python archive.py outputs/docred/boring_..._timestamp 3
+    print(write_json(sys.argv[1], int(sys.argv[2])))
@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+
+# Length-aware batching for train.py. Batches of random lengths get padded out to their longest example, and
+# every eval batch used to be generated out to the same fixed generation_max_length, even when every target
+# in it is a couple of relations long. Instead:
+#   - training batches are grouped by length (with some randomness left, see transformers' LengthGroupedSampler)
+#   - eval runs in order of input length, longest first, so each batch is mostly one length
+#   - optionally, each eval batch only generates about as far as the targets for inputs that long go in the
+#     training data (TargetLengthEnvelope, fitted on the training split)
+
+# how wide each input length bucket of the envelope is, in tokens
+ENVELOPE_BIN_SIZE = 32
+# how much of the training targets' length distribution a batch's limit has to cover, and the headroom on
+# top of that. By default all of it, i.e. the longest training target for inputs that long; lower quantiles
+# stop batches that are generating garbage a lot sooner, but cut the longest eval targets short (0.99 cut
+# 1-2% of them)
+ENVELOPE_QUANTILE = 1.0
+ENVELOPE_SLACK = 1.1
+ENVELOPE_MARGIN = 16
+
+
+def length_sorted_order(lengths: np.ndarray) -> np.ndarray:
+    """
+    returns:
+        the indices of lengths, longest first (so an OOM shows up on the first batch, not the last), with
+        ties kept in their original order
+    """
+    return np.argsort(-np.asarray(lengths), kind='stable')
+
+
+class TargetLengthEnvelope:
+    """
+    For a given input length, how long a target can plausibly get: a high quantile of the target lengths in
+    the training data among the inputs at most that long (rounded up to the bucket), plus some headroom.
+    """
+    def __init__(self, input_lengths: np.ndarray, target_lengths: np.ndarray, max_length: int,
+                 quantile: float = ENVELOPE_QUANTILE, bin_size: int = ENVELOPE_BIN_SIZE,
+                 slack: float = ENVELOPE_SLACK, margin: int = ENVELOPE_MARGIN):
+        """
+        parameters:
+            input_lengths/target_lengths: token counts of the training examples
+            max_length: the limit that applies regardless (generation_max_length)
+            quantile: which quantile of the target lengths to cover (1.0 for the longest one)
+        """
+        self.max_length = max_length
+        self.bin_size = bin_size
+        self.slack = slack
+        self.margin = margin
+        input_bins = np.asarray(input_lengths, dtype=np.int64) // bin_size
+        target_lengths = np.asarray(target_lengths, dtype=np.int64)
+        n_bins = int(input_bins.max()) + 1 if len(input_bins) else 1
+        # a batch of inputs up to some length can contain any of the shorter ones too, so each bucket
+        # covers all of the examples at most that long
+        self.target_length = np.zeros(n_bins, dtype=np.int64)
+        for b in range(n_bins):
+            covered = target_lengths[input_bins <= b]
+            if len(covered):
+                self.target_length[b] = math.ceil(np.quantile(covered, quantile))
+        self.target_length = np.maximum.accumulate(self.target_length)
+
+    def limit(self, input_length: int) -> int:
+        """
+        returns:
+            the number of target tokens to generate for a batch whose longest input is input_length
+        """
+        b = min(input_length // self.bin_size, len(self.target_length) - 1)
+        return min(self.max_length, math.ceil(self.target_length[b] * self.slack) + self.margin)
+
+    def __repr__(self) -> str:
+        limits = ', '.join(f'<{(b + 1) * self.bin_size}: {self.limit(b * self.bin_size)}' for b in range(len(self.target_length)))
+        return f'<TargetLengthEnvelope {limits}>'
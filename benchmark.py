@@ -0,0 +1,214 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import build
+import linearization
+from classes import Article
+
+# Benchmarks every encoding on every dataset, so encodings can be compared on numbers rather than guesses
+# (the target length is most of what generation costs), and so regressions show up. For each (dataset,
+# encoding, tokenizer) it measures
+#   mean/p95 target length     in tokens, including special tokens
+#   linearize/delinearize      docs/sec, best of a few runs; delinearize is the per-encoding function that
+#                              test_linearization uses, delinearize_batch is the one eval uses
+#   round-trip accuracy        fraction of docs whose relations come back exactly (as in test_linearization),
+#                              through delinearize and through delinearize_batch
+#   peak memory                of Python allocations (tracemalloc) while doing all of the above once; this
+#                              doesn't see the tokenizer's own (Rust) memory
+# and writes them out as a csv. Given a previous run's csv as --baseline, it lists the regressions and
+# exits with status 1 if there are any.
+#
+#   python benchmark.py t5-small facebook/bart-large --max-docs 500
+#   python benchmark.py t5-small --baseline outputs/benchmarks/encodings.csv --output /tmp/new.csv
+
+FIELDS = [
+    'dataset', 'encoding', 'tokenizer', 'n_docs',
+    'mean_target_tokens', 'p95_target_tokens',
+    'linearize_docs_per_sec', 'delinearize_docs_per_sec', 'delinearize_batch_docs_per_sec',
+    'round_trip_accuracy', 'batch_round_trip_accuracy', 'peak_memory_mb', 'error',
+]
+DEFAULT_OUTPUT = 'outputs/benchmarks/encodings.csv'
+# how much slower than the baseline a throughput can get before it counts as a regression (timings are noisy)
+THROUGHPUT_TOLERANCE = 0.2
+
+
+def load_tokenizer(model_ckpt: str, dataset: str, encoding: str):
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_ckpt)
+    tokenizer.add_tokens(json.load(open(f'data/{dataset}/{encoding}/tokens.json', 'r')))
+    return tokenizer
+
+
+def _best_time(fn, repeats: int) -> tuple[float, object]:
+    # best of a few runs, along with what the last one returned
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_encoding(articles: list[Article], dataset: str, encoding: str, tokenizer, repeats: int = 3) -> dict:
+    """
+    returns:
+        the benchmark row (see FIELDS) for one encoding on one dataset, without the identifying fields
+    """
+    linearize = linearization.LINEARIZERS[encoding]
+    delinearize = linearization.DELINEARIZERS[encoding]
+    n_docs = len(articles)
+
+    lin_time, targets = _best_time(lambda: linearize(articles, dataset), repeats)
+    token_ids = tokenizer(targets)['input_ids']
+    target_lengths = np.array([len(ids) for ids in token_ids])
+    delin_time, relations = _best_time(lambda: delinearize(token_ids, tokenizer, dataset), repeats)
+    batch_time, batch_relations = _best_time(
+        lambda: linearization.delinearize_batch(token_ids, tokenizer, dataset, encoding), repeats)
+    n_correct = n_docs - len(linearization.round_trip_errors(articles, relations))
+    n_batch_correct = n_docs - len(linearization.round_trip_errors(articles, batch_relations))
+    # on gold targets the two have to decode the same thing
+    disagreements = linearization.decoder_disagreements(relations, batch_relations)
+    if disagreements:
+        raise AssertionError(f'delinearize_batch disagrees with delinearize_{encoding} on {len(disagreements)} docs')
+
+    # memory gets its own run, since tracemalloc slows everything down
+    tracemalloc.start()
+    try:
+        ids = tokenizer(linearize(articles, dataset))['input_ids']
+        delinearize(ids, tokenizer, dataset)
+        linearization.delinearize_batch(ids, tokenizer, dataset, encoding)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    per_sec = lambda seconds: round(n_docs / seconds, 1) if seconds > 0 else float('inf')
+    return {
+        'n_docs': n_docs,
+        'mean_target_tokens': round(float(target_lengths.mean()), 1) if n_docs else 0.0,
+        'p95_target_tokens': int(np.percentile(target_lengths, 95)) if n_docs else 0,
+        'linearize_docs_per_sec': per_sec(lin_time),
+        'delinearize_docs_per_sec': per_sec(delin_time),
+        'delinearize_batch_docs_per_sec': per_sec(batch_time),
+        'round_trip_accuracy': round(n_correct / n_docs, 4) if n_docs else 0.0,
+        'batch_round_trip_accuracy': round(n_batch_correct / n_docs, 4) if n_docs else 0.0,
+        'peak_memory_mb': round(peak / 2**20, 1),
+        'error': '',
+    }
+
+
+def run_benchmark(model_ckpts: list[str], datasets: list[str] = None, encodings: list[str] = None,
+                  split: str = 'eval', max_docs: int = None, repeats: int = 3) -> list[dict]:
+    """
+    parameters:
+        model_ckpts: the tokenizers to measure with
+        datasets/encodings: what to benchmark (default: everything in build.DATASETS/linearization.LINEARIZERS)
+        max_docs: only use the first this many articles of each dataset's split
+    returns:
+        one row per (dataset, encoding, tokenizer); anything that failed has its error filled in instead
+    """
+    rows = []
+    for dataset in datasets or list(build.DATASETS):
+        try:
+            articles = list(itertools.islice(build.load_articles(dataset, split), max_docs))
+        except Exception as e:
+            articles, load_error = None, f'{type(e).__name__}: {e}'
+        for encoding in encodings or list(linearization.LINEARIZERS):
+            for model_ckpt in model_ckpts:
+                row = {'dataset': dataset, 'encoding': encoding, 'tokenizer': model_ckpt}
+                if articles is None:
+                    row['error'] = load_error
+                else:
+                    try:
+                        tokenizer = load_tokenizer(model_ckpt, dataset, encoding)
+                        row.update(benchmark_encoding(articles, dataset, encoding, tokenizer, repeats))
+                    except Exception as e:
+                        row['error'] = f'{type(e).__name__}: {e}'
+                print(format_row(row), flush=True)
+                rows.append(row)
+    return rows
+
+
+def format_row(row: dict) -> str:
+    if row.get('error'):
+        return f'{row["dataset"]}/{row["encoding"]} [{row["tokenizer"]}]: FAILED {row["error"]}'
+    return (f'{row["dataset"]}/{row["encoding"]} [{row["tokenizer"]}]: '
+            f'target tokens mean={row["mean_target_tokens"]} p95={row["p95_target_tokens"]}, '
+            f'docs/sec linearize={row["linearize_docs_per_sec"]} delinearize={row["delinearize_docs_per_sec"]} '
+            f'delinearize_batch={row["delinearize_batch_docs_per_sec"]}, '
+            f'round trip={row["round_trip_accuracy"]} (batch {row["batch_round_trip_accuracy"]}), peak memory={row["peak_memory_mb"]}MB')
+
+
+def write_table(rows: list[dict], fname: str) -> None:
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({field: row.get(field, '') for field in FIELDS})
+
+def read_table(fname: str) -> list[dict]:
+    with open(fname, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def find_regressions(rows: list[dict], baseline_rows: list[dict], tolerance: float = THROUGHPUT_TOLERANCE) -> list[str]:
+    """
+    returns:
+        a description of everything that got worse than in the baseline: anything that used to work and now
+        fails, any drop in round-trip accuracy, longer targets, or throughput down by more than tolerance
+    """
+    key = lambda row: (row['dataset'], row['encoding'], row['tokenizer'])
+    baseline = {key(row): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        old = baseline.get(key(row))
+        name = '{}/{} [{}]'.format(*key(row))
+        if old is None or old['error']:
+            continue
+        if row['error']:
+            regressions.append(f'{name}: now fails ({row["error"]})')
+            continue
+        if float(row['round_trip_accuracy']) < float(old['round_trip_accuracy']):
+            regressions.append(f'{name}: round trip accuracy {old["round_trip_accuracy"]} -> {row["round_trip_accuracy"]}')
+        # (baselines from before this was measured don't have it)
+        if old.get('batch_round_trip_accuracy') and \
+                float(row['batch_round_trip_accuracy']) < float(old['batch_round_trip_accuracy']):
+            regressions.append(f'{name}: batch round trip accuracy {old["batch_round_trip_accuracy"]} -> '
+                               f'{row["batch_round_trip_accuracy"]}')
+        if float(row['mean_target_tokens']) > float(old['mean_target_tokens']):
+            regressions.append(f'{name}: mean target tokens {old["mean_target_tokens"]} -> {row["mean_target_tokens"]}')
+        for field in ['linearize_docs_per_sec', 'delinearize_docs_per_sec', 'delinearize_batch_docs_per_sec']:
+            if float(row[field]) < (1 - tolerance) * float(old[field]):
+                regressions.append(f'{name}: {field} {old[field]} -> {row[field]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every encoding on every dataset')
+    parser.add_argument('model_ckpts', nargs='*', default=['t5-small'], help='tokenizers to measure with')
+    parser.add_argument('--datasets', nargs='+', choices=list(build.DATASETS))
+    parser.add_argument('--encodings', nargs='+', choices=list(linearization.LINEARIZERS))
+    parser.add_argument('--split', default='eval')
+    parser.add_argument('--max-docs', type=int, default=None)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', help='a previous run\'s csv to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=THROUGHPUT_TOLERANCE)
+    args = parser.parse_args()
+
+    rows = run_benchmark(args.model_ckpts, args.datasets, args.encodings, args.split, args.max_docs, args.repeats)
+    write_table(rows, args.output)
+    print(f'wrote {args.output}')
+    if args.baseline:
+        regressions = find_regressions(rows, read_table(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import linearization
+import utils
+from schema import get_encoding_spec
+
+# Builds the linearized train/eval data (data/{dataset}/{encoding}/{split}.json) from the raw datasets, along
+# with the same articles and targets as a binary corpus ({split}.corpus, see corpus.py), which is what
+# train.py reads.
+#
+# Every output gets a .stamp file next to it recording a fingerprint of everything that went into it:
+# the raw file's contents, rel_types.json/rel_slots.json, and the version of the encoding's linearizer
+# (linearization.ENCODING_VERSIONS). An output is only rebuilt when that fingerprint changes, so e.g.
+# adding a new encoding only builds that encoding. Each (dataset, encoding, split) is an independent
+# job, and they're run in a process pool.
+#
+#   python build.py                                   # everything that's out of date
+#   python build.py --datasets docred --encodings vertex_ref_evidence
+#   python build.py --force                           # rebuild regardless
+
+# bump this if the record format itself (linearization.data_records, or the corpus) changes
+BUILD_VERSION = 3
+
+# where each dataset's raw splits live, the function that loads them into Articles, and the
+# encodings that get built when none are asked for. split_into_words: the articles come split into words
+# (Article.words), so the model is trained on the words rather than the text, and has to be given words
+DATASETS = {
+    'docred': {
+        'loader': 'processing.docred.iter_docred',
+        'splits': {'train': 'train_data.json', 'eval': 'dev.json'},
+        'encodings': ['boring', 'vertex_ref'],
+        'split_into_words': True,
+    },
+    'evidence_inference': {
+        'loader': 'processing.evidence_inference.load_evidence_inference',
+        'splits': {'train': 'ev_inf_train.json', 'eval': 'ev_inf_eval.json'},
+        'encodings': ['boring', 'vertex_ref'],
+    },
+}
+
+# how many articles are linearized and written at a time
+CHUNK_SIZE = 1000
+
+
+def raw_path(dataset: str, split: str) -> str:
+    return f'data/{dataset}/{DATASETS[dataset]["splits"][split]}'
+
+def output_path(dataset: str, encoding: str, split: str) -> str:
+    return f'data/{dataset}/{encoding}/{split}.json'
+
+def corpus_path(dataset: str, encoding: str, split: str) -> str:
+    return f'data/{dataset}/{encoding}/{split}.corpus'
+
+def stamp_path(dataset: str, encoding: str, split: str) -> str:
+    return output_path(dataset, encoding, split) + '.stamp'
+
+
+def _sha256_file(fname: str) -> str:
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _read_json_or_none(fname: str):
+    try:
+        return json.load(open(fname))
+    except (OSError, ValueError):
+        return None
+
+def _write_atomic(fname: str, contents: str) -> None:
+    tmp_fname = f'{fname}.tmp{os.getpid()}'
+    with open(tmp_fname, 'w') as f:
+        f.write(contents)
+    os.replace(tmp_fname, fname)
+
+
+class FileHasher:
+    """
+    Content hashes of the raw inputs, computed at most once per build. If an old stamp recorded the
+    same size and mtime for a file, its hash is reused rather than reading the whole file again.
+    """
+    def __init__(self):
+        self.hashes: dict[str, dict] = {}
+
+    def __call__(self, fname: str, old_stamp=None) -> dict:
+        if fname not in self.hashes:
+            st = os.stat(fname)
+            info = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            old_info = (old_stamp or {}).get('inputs', {}).get(fname)
+            if old_info and all(old_info.get(k) == v for k, v in info.items()):
+                info['sha256'] = old_info['sha256']
+            else:
+                info['sha256'] = _sha256_file(fname)
+            self.hashes[fname] = info
+        return self.hashes[fname]
+
+
+def fingerprint(dataset: str, encoding: str, split: str, hasher: FileHasher, old_stamp=None) -> dict:
+    inputs = [raw_path(dataset, split), f'data/{dataset}/rel_types.json', f'data/{dataset}/rel_slots.json']
+    return {
+        'build_version': BUILD_VERSION,
+        'encoding': encoding,
+        'encoding_version': linearization.ENCODING_VERSIONS[encoding],
+        'inputs': {fname: hasher(fname, old_stamp) for fname in inputs},
+    }
+
+def _content_key(fp: dict) -> dict:
+    # size/mtime are only there to skip re-hashing; the content hashes are what decide
+    return {**fp, 'inputs': {fname: info['sha256'] for fname, info in fp['inputs'].items()}}
+
+def is_up_to_date(stamp, fp: dict, out_fnames: list[str]) -> bool:
+    if stamp is None or not all(os.path.exists(fname) for fname in out_fnames):
+        return False
+    return _content_key(stamp) == _content_key(fp)
+
+
+def _keep_profiled_lengths(contents: str, old_config) -> str:
+    # max lengths that length_profile.py worked out from the data take precedence over the defaults
+    if not old_config or 'length_profile' not in old_config:
+        return contents
+    profiled_keys = ['input_ids_max_len', 'labels_max_len', 'length_profile']
+    return json.dumps({**json.loads(contents), **{k: old_config[k] for k in profiled_keys}}, indent=2)
+
+def write_encoding_files(dataset: str, encoding: str) -> list[str]:
+    """
+    Writes tokens.json/config.json for the encoding, if they've changed.
+    returns:
+        the files that were (re)written
+    """
+    os.makedirs(f'data/{dataset}/{encoding}', exist_ok=True)
+    written = []
+    for name, contents in linearization.encoding_files(get_encoding_spec(dataset, encoding)).items():
+        fname = f'data/{dataset}/{encoding}/{name}'
+        if name == 'config.json' and os.path.exists(fname):
+            contents = _keep_profiled_lengths(contents, _read_json_or_none(fname))
+        if os.path.exists(fname) and open(fname).read() == contents:
+            continue
+        _write_atomic(fname, contents)
+        written.append(fname)
+    return written
+
+
+def load_articles(dataset: str, split: str):
+    module_name, fn_name = DATASETS[dataset]['loader'].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), fn_name)(raw_path(dataset, split))
+
+def run_job(dataset: str, encoding: str, split: str, fp: dict) -> int:
+    """
+    Linearizes one split with one encoding (in a worker process).
+    returns:
+        the number of articles written
+    """
+    out_fname = output_path(dataset, encoding, split)
+    tmp_fname = f'{out_fname}.tmp{os.getpid()}'
+    corpus_fname = corpus_path(dataset, encoding, split)
+    tmp_corpus_fname = f'{corpus_fname}.tmp{os.getpid()}'
+    linearize = linearization.LINEARIZERS[encoding]
+    articles = []
+    try:
+        with utils.JsonArrayWriter(tmp_fname) as writer:
+            for docs in utils.chunked(load_articles(dataset, split), CHUNK_SIZE):
+                targets = linearize(docs, dataset)
+                writer.write_all(linearization.data_records(docs, targets))
+                for doc, target in zip(docs, targets):
+                    doc.target = target
+                articles.extend(docs)
+        utils.write_articles(articles, tmp_corpus_fname)
+        # the outputs go into place before their stamp, so a crash in between just means a rebuild
+        os.replace(tmp_fname, out_fname)
+        os.replace(tmp_corpus_fname, corpus_fname)
+    finally:
+        for fname in [tmp_fname, tmp_corpus_fname]:
+            if os.path.exists(fname):
+                os.remove(fname)
+    _write_atomic(stamp_path(dataset, encoding, split), json.dumps(fp, indent=2))
+    return len(articles)
+
+
+def build(datasets: list[str] = None, encodings: list[str] = None, workers: int = None, force: bool = False) -> None:
+    """
+    parameters:
+        datasets: which datasets to build (default: all of them)
+        encodings: which encodings to build (default: each dataset's usual ones)
+        workers: max number of worker processes (default: one per CPU)
+        force: rebuild even the outputs that are up to date
+    """
+    hasher = FileHasher()
+    jobs = []
+    for dataset in datasets or list(DATASETS):
+        for encoding in encodings or DATASETS[dataset]['encodings']:
+            for fname in write_encoding_files(dataset, encoding):
+                print(f'wrote {fname}')
+            for split in DATASETS[dataset]['splits']:
+                old_stamp = _read_json_or_none(stamp_path(dataset, encoding, split))
+                fp = fingerprint(dataset, encoding, split, hasher, old_stamp)
+                out_fnames = [output_path(dataset, encoding, split), corpus_path(dataset, encoding, split)]
+                if not force and is_up_to_date(old_stamp, fp, out_fnames):
+                    print(f'{output_path(dataset, encoding, split)} is up to date')
+                    if old_stamp != fp:
+                        # same contents, but touched; record the new mtimes so it isn't hashed every time
+                        _write_atomic(stamp_path(dataset, encoding, split), json.dumps(fp, indent=2))
+                    continue
+                jobs.append((dataset, encoding, split, fp))
+
+    if not jobs:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            n_articles = run_job(*job)
+            print(f'built {output_path(*job[:3])} ({n_articles} articles)')
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, *job): job for job in jobs}
+        for future in as_completed(futures):
+            print(f'built {output_path(*futures[future][:3])} ({future.result()} articles)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the linearized datasets that are out of date')
+    parser.add_argument('--datasets', nargs='+', choices=list(DATASETS))
+    parser.add_argument('--encodings', nargs='+', choices=list(linearization.LINEARIZERS))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+    build(args.datasets, args.encodings, args.workers, args.force)
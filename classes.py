@@ -1,8 +1,30 @@
+import sys
+import json
+import numpy as np
+
+# All of these are __slots__ classes: a corpus can easily hold millions of entities, and a per-instance
+# __dict__ roughly doubles what each one costs. Span/type strings are interned so that repeated mentions
+# share one string, and hashes are cached since the same objects get hashed over and over in sets.
+# The flip side is that these objects should be treated as immutable once they're built.
+
+# one shared tuple per distinct list of slot names
+_SLOT_TUPLES: dict[tuple, tuple] = {}
+
+def _intern(s):
+    return sys.intern(s) if type(s) is str else s
+
+def _intern_slots(slots) -> tuple:
+    slots = tuple(_intern(s) for s in slots)
+    return _SLOT_TUPLES.setdefault(slots, slots)
+
 class Entity:
+    __slots__ = ('span', '_hash')
+
     def __init__(self, unused: str, span: str):
         # vestigial first positional argument; it used to be "etype", but that
         # behavior has been moved to TypedEntity
-        self.span = span
+        self.span = _intern(span)
+        self._hash = hash(self.span)
 
     def __repr__(self) -> str:
         repr: str = f'{self.span}'
@@ -15,15 +37,22 @@ class Entity:
         return self.span == other.span
 
     def __hash__(self) -> int:
-        return hash(self.span)
+        return self._hash
+
+    def __reduce__(self):
+        # rebuild rather than copying the slots, since the cached hash is only valid in this process
+        return (Entity, (None, self.span))
 
     def to_dict(self) -> dict:
         return {'span': self.span}
 
 class TypedEntity:
+    __slots__ = ('etype', 'span', '_hash')
+
     def __init__(self, etype: str, span: str):
-        self.etype = etype
-        self.span = span
+        self.etype = _intern(etype)
+        self.span = _intern(span)
+        self._hash = hash(self.etype) ^ hash(self.span)
 
     def __repr__(self) -> str:
         repr: str = f'<{self.etype}> {self.span}'
@@ -36,23 +65,29 @@ class TypedEntity:
         return self.etype == other.etype and self.span == other.span
 
     def __hash__(self) -> int:
-        return hash(self.etype) ^ hash(self.span)
+        return self._hash
+
+    def __reduce__(self):
+        return (TypedEntity, (self.etype, self.span))
 
     def to_dict(self) -> dict:
         return {'etype': self.etype, 'span': self.span}
 
 class Relation:
+    __slots__ = ('rtype', 'entities', 'slots', 'evidence', '_hash')
+
     def __init__(self, rtype: str, entities: list[Entity], slots: list[str], evidence=list[int]):
         assert len(entities) == len(slots)
-        self.rtype = rtype
-        self.entities = entities
-        self.slots = slots
+        self.rtype = _intern(rtype)
+        self.entities = tuple(entities)
+        self.slots = _intern_slots(slots)
         self.evidence = evidence
+        self._hash = None
 
     def __str__(self) -> str:
         repr: str = ' | '.join([f'<<{self.rtype}>>'] + [f'{slot}: {r}' for slot, r in zip(self.slots, self.entities)])
         return repr
-    
+
     def __repr__(self) -> str:
         return f'<<{self.rtype}>>' + ''.join([f'<{slot}>' for slot in self.slots])
 
@@ -60,11 +95,16 @@ class Relation:
         return self.rtype == other.rtype and self.entities == other.entities
 
     def __hash__(self) -> int:
-        return hash(self.rtype) ^ hash(tuple(self.entities))
+        if self._hash is None:
+            self._hash = hash(self.rtype) ^ hash(self.entities)
+        return self._hash
+
+    def __reduce__(self):
+        return (Relation, (self.rtype, self.entities, self.slots, self.evidence))
 
     def to_dict(self) -> dict:
         ents = { slot: e.to_dict() for slot, e in zip(self.slots, self.entities) }
-        return { 
+        return {
             'rtype': self.rtype,
             'entities': ents
         }
@@ -72,11 +112,64 @@ class Relation:
     def from_json(json_data):
         ...
 
+def index_entities(relations: list[Relation]) -> dict[Entity, int]:
+    """
+    returns:
+        every distinct entity in the relations, in the order they first appear, mapped to its position
+        in that order (i.e. its vertex id)
+    """
+    index: dict[Entity, int] = {}
+    for rel in relations:
+        for ent in rel.entities:
+            index.setdefault(ent, len(index))
+    return index
+
 class Article:
-    def __init__(self, text: str, relations: list[Relation]):
+    __slots__ = ('text', 'relations', 'target', 'words', 'sentence_offsets', '_entity_index')
+
+    def __init__(self, text: str, relations: list[Relation], words: list[str] = None, sentence_offsets: list[int] = None):
+        """
+        parameters:
+            words: the text, already split into words (if the dataset comes that way); text is then these
+                joined with spaces, see from_sentences
+            sentence_offsets: the index in words of the first word of each sentence, plus len(words) at
+                the end. These are the sentences that relation evidence refers to
+        """
         self.text: str = text
         self.relations: list[Relation] = relations
         self.target: str = ""
+        self.words: list[str] = words
+        self.sentence_offsets: list[int] = sentence_offsets
+        self._entity_index = None
+
+    @classmethod
+    def from_sentences(cls, sentences: list[list[str]], relations: list[Relation]) -> 'Article':
+        words = []
+        sentence_offsets = [0]
+        for sentence in sentences:
+            words.extend(sentence)
+            sentence_offsets.append(len(words))
+        return cls(''.join([word + ' ' for word in words]), relations, words, sentence_offsets)
+
+    @property
+    def n_sentences(self) -> int:
+        return len(self.sentence_offsets) - 1 if self.sentence_offsets is not None else 0
+
+    def sentence_words(self, i: int) -> list[str]:
+        return self.words[self.sentence_offsets[i]:self.sentence_offsets[i + 1]]
+
+    @property
+    def sentence_spans(self) -> list[tuple[int, int]]:
+        """
+        returns:
+            the (start, end) character offsets of each sentence in text (None if the sentences aren't known)
+        """
+        if self.sentence_offsets is None:
+            return None
+        # each word is followed by one space
+        word_starts = np.concatenate([[0], np.cumsum([len(word) + 1 for word in self.words])])
+        return [(int(word_starts[start]), int(word_starts[end]) - 1)
+                for start, end in zip(self.sentence_offsets, self.sentence_offsets[1:])]
 
     def __repr__(self) -> str:
         return f'<{len(self.text)=}|{len(self.relations)=}>'
@@ -86,15 +179,160 @@ class Article:
         return repr
 
     def to_dict(self) -> dict:
-        return {
+        a_dict = {
             'text': self.text,
             'relations': [r.to_dict() for r in self.relations]
         }
+        if self.words is not None:
+            a_dict['words'] = self.words
+            a_dict['sentence_offsets'] = self.sentence_offsets
+        return a_dict
+
+    @property
+    def entity_index(self) -> dict[Entity, int]:
+        # built on first use and then kept, so don't change the relations after that
+        if self._entity_index is None:
+            self._entity_index = index_entities(self.relations)
+        return self._entity_index
 
     def get_entities(self):
-        out = []
-        for rel in self.relations:
-            for ent in rel.entities:
-                if ent not in out:
-                    out.append(ent)
-        return out
\ No newline at end of file
+        return list(self.entity_index)
+
+
+def _evidence_idx(evidence, i: int) -> int:
+    # evidence can be missing, or (coming out of a delinearizer) a string that isn't a number at all
+    try:
+        return int(evidence[i])
+    except (TypeError, ValueError, IndexError):
+        return -1
+
+class RelationTable:
+    """
+    Columnar storage for all of the relations in a corpus: one row per relation, with integer ids into
+    shared tables of relation types and entity spans. This is a small fraction of the size of the
+    equivalent Relation/Entity objects, and converts to and from them.
+
+    Every relation in a table has to use the same slots (which is true within any one dataset).
+    Evidence is kept as [start, end] sentence indices; anything that isn't an int becomes -1.
+    """
+    def __init__(self, slots: list[str], type_names: list[str], spans: list[str],
+                 doc_ids: np.ndarray, type_ids: np.ndarray, entity_ids: np.ndarray,
+                 evidence_start: np.ndarray, evidence_end: np.ndarray, n_docs: int):
+        self.slots = _intern_slots(slots)
+        self.type_names = type_names
+        self.spans = spans
+        self.doc_ids = doc_ids
+        self.type_ids = type_ids
+        # (n_relations, n_slots)
+        self.entity_ids = entity_ids
+        self.evidence_start = evidence_start
+        self.evidence_end = evidence_end
+        self.n_docs = n_docs
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __repr__(self) -> str:
+        return f'<RelationTable {len(self)} relations|{self.n_docs} docs|{len(self.spans)} spans>'
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in [self.doc_ids, self.type_ids, self.entity_ids,
+                                       self.evidence_start, self.evidence_end])
+
+    @classmethod
+    def from_relations(cls, per_doc_relations: list[list[Relation]], relation_types: dict = None) -> 'RelationTable':
+        """
+        parameters:
+            per_doc_relations: the relations for each document (e.g. the output of a delinearizer)
+            relation_types: the contents of rel_types.json; fixes the type ids, if given
+        """
+        type_ids: dict[str, int] = {rtype: i for i, rtype in enumerate(relation_types or {})}
+        span_ids: dict[str, int] = {}
+        slots = None
+        doc_col, type_col, entity_col, ev_start_col, ev_end_col = [], [], [], [], []
+        for doc_id, relations in enumerate(per_doc_relations):
+            for rel in relations:
+                if slots is None:
+                    slots = rel.slots
+                assert rel.slots == slots, f'mixed slots in one table: {slots} vs {rel.slots}'
+                doc_col.append(doc_id)
+                type_col.append(type_ids.setdefault(rel.rtype, len(type_ids)))
+                entity_col.extend([span_ids.setdefault(e.span, len(span_ids)) for e in rel.entities])
+                ev_start_col.append(_evidence_idx(rel.evidence, 0))
+                ev_end_col.append(_evidence_idx(rel.evidence, 1))
+        slots = slots or ()
+        return cls(slots, list(type_ids), list(span_ids),
+                   np.array(doc_col, dtype=np.int32),
+                   np.array(type_col, dtype=np.int32),
+                   np.array(entity_col, dtype=np.int32).reshape(len(doc_col), len(slots)),
+                   np.array(ev_start_col, dtype=np.int32),
+                   np.array(ev_end_col, dtype=np.int32),
+                   len(per_doc_relations))
+
+    @classmethod
+    def from_articles(cls, articles: list[Article], relation_types: dict = None) -> 'RelationTable':
+        return cls.from_relations([article.relations for article in articles], relation_types)
+
+    def to_relations(self) -> list[list[Relation]]:
+        """
+        returns:
+            the relations for each document, as Relation objects with plain Entity entities
+        """
+        # one Entity per distinct span, shared by every relation that mentions it
+        entities = [Entity('[UNK]', span) for span in self.spans]
+        per_doc_relations: list[list[Relation]] = [[] for _ in range(self.n_docs)]
+        for doc_id, type_id, entity_ids, ev_start, ev_end in zip(self.doc_ids.tolist(), self.type_ids.tolist(),
+                                                                 self.entity_ids.tolist(),
+                                                                 self.evidence_start.tolist(),
+                                                                 self.evidence_end.tolist()):
+            evidence = [ev_start, ev_end] if ev_start >= 0 and ev_end >= 0 else []
+            per_doc_relations[doc_id].append(Relation(self.type_names[type_id], [entities[e] for e in entity_ids],
+                                                      self.slots, evidence))
+        return per_doc_relations
+
+    def to_articles(self, texts: list[str]) -> list[Article]:
+        return [Article(text, relations) for text, relations in zip(texts, self.to_relations())]
+
+    @classmethod
+    def concat(cls, tables: list['RelationTable']) -> 'RelationTable':
+        """
+        returns:
+            one table with the documents of each table in turn (type and span ids get remapped)
+        """
+        slots = next((table.slots for table in tables if len(table)), ())
+        type_ids: dict[str, int] = {}
+        span_ids: dict[str, int] = {}
+        doc_cols, type_cols, entity_cols, ev_start_cols, ev_end_cols = [], [], [], [], []
+        n_docs = 0
+        for table in tables:
+            type_map = np.array([type_ids.setdefault(t, len(type_ids)) for t in table.type_names], dtype=np.int32)
+            if len(table):
+                assert table.slots == slots, f'mixed slots in one table: {slots} vs {table.slots}'
+                span_map = np.array([span_ids.setdefault(s, len(span_ids)) for s in table.spans], dtype=np.int32)
+                doc_cols.append(table.doc_ids + n_docs)
+                type_cols.append(type_map[table.type_ids])
+                entity_cols.append(span_map[table.entity_ids])
+                ev_start_cols.append(table.evidence_start)
+                ev_end_cols.append(table.evidence_end)
+            n_docs += table.n_docs
+
+        def cat(cols, empty_shape=(0,)):
+            return np.concatenate(cols).astype(np.int32) if cols else np.zeros(empty_shape, dtype=np.int32)
+        return cls(slots, list(type_ids), list(span_ids), cat(doc_cols), cat(type_cols),
+                   cat(entity_cols, (0, len(slots))), cat(ev_start_cols), cat(ev_end_cols), n_docs)
+
+    def save(self, fname: str) -> None:
+        # the string tables go in as one json string, so loading never needs allow_pickle
+        header = {'slots': list(self.slots), 'type_names': self.type_names, 'spans': self.spans, 'n_docs': self.n_docs}
+        with open(fname, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps(header)), doc_ids=self.doc_ids, type_ids=self.type_ids,
+                     entity_ids=self.entity_ids, evidence_start=self.evidence_start, evidence_end=self.evidence_end)
+
+    @classmethod
+    def load(cls, fname: str) -> 'RelationTable':
+        with np.load(fname) as data:
+            header = json.loads(str(data['header']))
+            return cls(header['slots'], header['type_names'], header['spans'],
+                       data['doc_ids'], data['type_ids'], data['entity_ids'],
+                       data['evidence_start'], data['evidence_end'], header['n_docs'])
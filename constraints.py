@@ -0,0 +1,385 @@
+import json
+from typing import Optional
+
+import numpy as np
+
+import utils
+from schema import get_decoding_schema, DecodingSchema, MAX_VERTICES
+
+# Grammar-constrained generation. Every linearization scheme has a simple token-level grammar:
+#
+#   boring:       (<rel> TYPE <slot_0> text+ ... <slot_n> text+)*
+#   vertex_ref:   (<vertex> <k> text+)* (<rel> TYPE <slot_0> <k> ... <slot_n> <k>)*
+#   *_evidence:   the same, with <es> ev+ <ee> ev+ on the end of every relation
+#
+# where the vertices are numbered 0, 1, 2, ... in order, and a relation can only refer to a vertex that
+# has already been written out. Anything outside of that gets thrown away by the delinearizers (all of
+# their `continue`s), so GrammarLogitsProcessor just never lets the model generate it.
+#
+# EncodingGrammar is the state machine itself, and doesn't need torch; the processor walks every
+# hypothesis through it and masks the scores of the tokens it doesn't allow. Nothing here imports torch or
+# transformers until it's actually generating, so the grammar is cheap to import on its own.
+
+# how many of the previous step's states to keep; past this, a prefix is just re-run from the start
+MAX_CACHED_STATES = 1 << 16
+
+
+def _blank_ids(tokenizer, candidates: np.ndarray) -> list[int]:
+    """
+    parameters:
+        candidates: bool over the vocab, the tokens that can be blank (i.e. not special or added ones)
+    returns:
+        the ids of the ones that decode to nothing but whitespace
+    """
+    ids = np.flatnonzero(candidates).tolist()
+    texts = tokenizer.batch_decode([[i] for i in ids])
+    return [i for i, text in zip(ids, texts) if not text.strip()]
+
+
+class EncodingGrammar:
+    """
+    The grammar of one encoding scheme, for one tokenizer. States are small tuples:
+        ('start', n)             nothing generated yet
+        ('lead', n)              nothing but a leading special token (e.g. BART's <s>) generated yet
+        ('vertex_id', n)         just after <vertex>; has to be <n>
+        ('vertex_span', n, c)    in the text of vertex n-1 (c is 1 once there's at least one token)
+        ('type', n)              just after <rel>
+        ('slot', n, k)           has to be the marker for slot k
+        ('span', n, k, c)        in the entity of slot k
+        ('es', n, c)/('ee', n, c)  in the evidence start/end
+        ('done',)                after the end of the sequence; anything goes
+        ('free', n)              something the grammar doesn't allow got in anyway (e.g. a forced token);
+                                 anything goes until the next <rel>
+    where n is the number of vertices written so far.
+    The targets have a space between vertex list items and between relations (see linearization.target_pieces),
+    which a lot of tokenizers turn into a token of its own (▁ or Ġ), so whitespace-only tokens are let through
+    (without changing the state) wherever there can be one: at the start, after <vertex> and <k>, and at the
+    end of a vertex's name or a relation.
+    """
+    def __init__(self, schema: DecodingSchema, tokenizer):
+        self.schema = schema
+        self.vocab_size = len(tokenizer)
+        self.has_vertices = schema.has_vertices
+        self.has_evidence = schema.has_evidence
+        self.rel = schema.rel_token
+        self.vertex = schema.vertex_token
+        self.slots = schema.slot_tokens.tolist()
+        self.es = schema.str2token['<es>'] if schema.has_evidence else None
+        self.ee = schema.str2token['<ee>'] if schema.has_evidence else None
+        self.vertex_ids = schema.vertex_ids.tolist()
+        self.type_ids = tuple(sorted(schema.type_ids))
+        self.eos = tokenizer.eos_token_id
+        self.special_ids = set(tokenizer.all_special_ids)
+
+        structural = [self.rel] + self.slots + [t for t in [self.vertex, self.es, self.ee] if t is not None]
+        # entity/vertex text can't contain any of the added tokens; evidence can (the <k> sentence
+        # indices are vertex index tokens, and in evidence_inference even relation type tokens)
+        self.text_mask = np.ones(self.vocab_size, dtype=bool)
+        self.text_mask[list(tokenizer.get_added_vocab().values())] = False
+        self.text_mask[list(self.special_ids)] = False
+        self.evidence_mask = np.ones(self.vocab_size, dtype=bool)
+        self.evidence_mask[structural] = False
+        self.evidence_mask[list(self.special_ids)] = False
+
+        # <unk> is part of the targets wherever the tokenizer can't spell something
+        if tokenizer.unk_token_id is not None:
+            self.text_mask[tokenizer.unk_token_id] = True
+            self.evidence_mask[tokenizer.unk_token_id] = True
+        # the tokens that are nothing but whitespace (the separators), which are also text
+        self.blank_mask = np.zeros(self.vocab_size, dtype=bool)
+        self.blank_mask[_blank_ids(tokenizer, self.text_mask)] = True
+
+        self.lead_ids = (self.vertex if self.has_vertices else self.rel, self.eos)
+        # the targets can start with one special token, e.g. BART's <s> (forced_bos_token_id)
+        self.start_ids = self.lead_ids + ((tokenizer.bos_token_id,) if tokenizer.bos_token_id is not None else ())
+        self._masks: dict = {}
+
+    def _in(self, mask: np.ndarray, token: int) -> bool:
+        return 0 <= token < len(mask) and bool(mask[token])
+
+    def _separates(self, state: tuple) -> bool:
+        # whether a separator can come after this state
+        phase = state[0]
+        if phase in ('start', 'lead', 'vertex_id'):
+            return True
+        if phase == 'vertex_span':
+            return True
+        if phase == 'span':
+            # after a <k>, or after an entity's text (where it's text anyway)
+            return bool(state[3])
+        return False
+
+    def _end_of_entity(self, k: int) -> tuple:
+        # what can come after the entity in slot k
+        if k + 1 < len(self.slots):
+            return (self.slots[k + 1],)
+        if self.has_evidence:
+            return (self.es,)
+        return (self.rel, self.eos)
+
+    def initial_state(self) -> tuple:
+        return ('start', 0)
+
+    def step(self, state: tuple, token: int) -> tuple:
+        phase = state[0]
+        if phase == 'done':
+            return state
+        if token == self.eos:
+            return ('done',)
+        if self._in(self.blank_mask, token) and self._separates(state):
+            return state
+        if phase in ('start', 'lead'):
+            if phase == 'start' and token in self.special_ids:
+                return ('lead', 0)
+            if self.has_vertices and token == self.vertex:
+                return ('vertex_id', 0)
+            if not self.has_vertices and token == self.rel:
+                return ('type', 0)
+            return ('free', 0)
+        n = state[1]
+        if phase == 'free':
+            return ('type', n) if token == self.rel else state
+        if phase == 'vertex_id':
+            return ('vertex_span', n + 1, 0) if token == self.vertex_ids[n] else ('free', n)
+        if phase == 'vertex_span':
+            if state[2]:
+                if token == self.vertex and n < MAX_VERTICES:
+                    return ('vertex_id', n)
+                if token == self.rel:
+                    return ('type', n)
+            return ('vertex_span', n, 1) if self._in(self.text_mask, token) else ('free', n)
+        if phase == 'type':
+            return ('slot', n, 0) if token in self.schema.type_ids else ('free', n)
+        if phase == 'slot':
+            return ('span', n, state[2], 0) if token == self.slots[state[2]] else ('free', n)
+        if phase == 'span':
+            k, c = state[2], state[3]
+            if c and token in self._end_of_entity(k):
+                if token == self.rel:
+                    return ('type', n)
+                if token == self.es:
+                    return ('es', n, 0)
+                return ('span', n, k + 1, 0)
+            if self.has_vertices:
+                return ('span', n, k, 1) if not c and token in self.vertex_ids[:n] else ('free', n)
+            return ('span', n, k, 1) if self._in(self.text_mask, token) else ('free', n)
+        if phase == 'es':
+            if state[2] and token == self.ee:
+                return ('ee', n, 0)
+            return ('es', n, 1) if self._in(self.evidence_mask, token) else ('free', n)
+        if phase == 'ee':
+            if state[2] and token == self.rel:
+                return ('type', n)
+            return ('ee', n, 1) if self._in(self.evidence_mask, token) else ('free', n)
+        raise ValueError(f'unknown grammar state {state}')
+
+    def run(self, token_ids) -> tuple:
+        state = self.initial_state()
+        for token in token_ids:
+            state = self.step(state, int(token))
+        return state
+
+    def allowed(self, state: tuple) -> tuple:
+        """
+        returns:
+            a hashable description of the tokens allowed after this state: (base, extra token ids), where
+            base is 'any', 'none', 'blank', 'text' or 'evidence' (see mask)
+        """
+        base, extra_ids = self._allowed(state)
+        if base == 'none' and self._separates(state):
+            return ('blank', extra_ids)
+        return base, extra_ids
+
+    def _allowed(self, state: tuple) -> tuple:
+        phase = state[0]
+        if phase in ('done', 'free'):
+            return ('any', ())
+        if phase == 'start':
+            return ('none', self.start_ids)
+        if phase == 'lead':
+            return ('none', self.lead_ids)
+        n = state[1]
+        if phase == 'vertex_id':
+            return ('none', (self.vertex_ids[n],))
+        if phase == 'vertex_span':
+            if not state[2]:
+                return ('text', ())
+            return ('text', ((self.vertex,) if n < MAX_VERTICES else ()) + (self.rel, self.eos))
+        if phase == 'type':
+            return ('none', self.type_ids)
+        if phase == 'slot':
+            return ('none', (self.slots[state[2]],))
+        if phase == 'span':
+            k, c = state[2], state[3]
+            if self.has_vertices:
+                return ('none', self._end_of_entity(k) if c else tuple(self.vertex_ids[:n]))
+            return ('text', self._end_of_entity(k) if c else ())
+        if phase == 'es':
+            return ('evidence', (self.ee,) if state[2] else ())
+        if phase == 'ee':
+            return ('evidence', (self.rel, self.eos) if state[2] else ())
+        raise ValueError(f'unknown grammar state {state}')
+
+    def mask(self, allowed: tuple, vocab_size: Optional[int] = None) -> np.ndarray:
+        """
+        parameters:
+            allowed: from allowed()
+            vocab_size: the width of the model's scores, which can be bigger than the tokenizer
+        returns:
+            bool array over the vocab, True for the allowed tokens
+        """
+        vocab_size = vocab_size or self.vocab_size
+        key = (allowed, vocab_size)
+        if key not in self._masks:
+            base, extra_ids = allowed
+            mask = np.zeros(vocab_size, dtype=bool)
+            if base == 'any':
+                mask[:] = True
+            elif base in ('blank', 'text', 'evidence'):
+                base_mask = {'blank': self.blank_mask, 'text': self.text_mask, 'evidence': self.evidence_mask}[base]
+                n = min(vocab_size, self.vocab_size)
+                mask[:n] = base_mask[:n]
+            mask[[i for i in extra_ids if i is not None and i < vocab_size]] = True
+            self._masks[key] = mask
+        return self._masks[key]
+
+
+class GrammarLogitsProcessor:
+    """
+    Masks out every next token that the encoding's grammar doesn't allow. Works with greedy, sampling and
+    beam search: each hypothesis' grammar state is looked up by its whole prefix, so it doesn't matter
+    how beams get reordered between steps.
+    (generate() only needs a LogitsProcessor's __call__(input_ids, scores), so this doesn't subclass it,
+    which would mean importing transformers to import the grammar)
+    """
+    def __init__(self, tokenizer, dataset: str, encoding: str):
+        self.grammar = EncodingGrammar(get_decoding_schema(dataset, encoding, tokenizer), tokenizer)
+        self._states: dict[tuple, tuple] = {}
+        self._device_masks: dict = {}
+
+    def states(self, input_ids) -> list[tuple]:
+        """
+        parameters:
+            input_ids: the decoder's input so far, which starts with the decoder_start_token_id
+        returns:
+            the grammar state at the end of each row of input_ids
+        """
+        states = {}
+        for row in input_ids.tolist():
+            prefix = tuple(row)
+            if prefix in states:
+                continue
+            prev = self._states.get(prefix[:-1])
+            if prev is not None:
+                states[prefix] = self.grammar.step(prev, prefix[-1])
+            else:
+                # the decoder start token isn't part of the target (and for BART, it's </s>)
+                states[prefix] = self.grammar.run(prefix[1:])
+        # only the last step's states can be extended at the next step
+        self._states = states if len(states) <= MAX_CACHED_STATES else {}
+        return [states[tuple(row)] for row in input_ids.tolist()]
+
+    def _device_mask(self, allowed: tuple, vocab_size: int, device):
+        import torch
+        key = (allowed, vocab_size, str(device))
+        if key not in self._device_masks:
+            self._device_masks[key] = torch.from_numpy(self.grammar.mask(allowed, vocab_size)).to(device)
+        return self._device_masks[key]
+
+    def __call__(self, input_ids, scores):
+        import torch
+        vocab_size = scores.shape[-1]
+        allowed = torch.stack([self._device_mask(self.grammar.allowed(state), vocab_size, scores.device)
+                               for state in self.states(input_ids)])
+        masked = scores.masked_fill(~allowed, -float('inf'))
+        # if another processor (e.g. no_repeat_ngram_size) has already ruled out everything the grammar
+        # allows, leave that row alone rather than leaving it nothing at all to choose from
+        dead = (masked == -float('inf')).all(dim=-1) & (scores != -float('inf')).any(dim=-1)
+        if dead.any():
+            masked[dead] = scores[dead]
+        return masked
+
+
+def grammar_logits_processor(tokenizer, dataset: str, encoding: str) -> 'LogitsProcessorList':
+    """
+    For offline inference, e.g.
+        model.generate(**inputs, logits_processor=grammar_logits_processor(tokenizer, 'docred', 'boring'))
+    """
+    from transformers import LogitsProcessorList
+    return LogitsProcessorList([GrammarLogitsProcessor(tokenizer, dataset, encoding)])
+
+
+def masked_gold_token(grammar: EncodingGrammar, token_ids) -> Optional[int]:
+    """
+    parameters:
+        token_ids: a tokenized target, as the model is trained on it
+    returns:
+        the position of the first token the grammar would have masked out, or None if it lets them all through
+    """
+    state = grammar.initial_state()
+    for i, token in enumerate(token_ids):
+        token = int(token)
+        if not grammar.mask(grammar.allowed(state))[token]:
+            return i
+        state = grammar.step(state, token)
+    return None
+
+
+# Runs every gold target in data/*/*/eval.json through the grammar, and checks that it never masks out a
+# token of one; if it did, constrained generation would push the model off what it was trained on
+def test_gold_targets(model_ckpt: str = 't5-small', max_targets: Optional[int] = None, tokenizer_fn=None):
+    """
+    parameters:
+        tokenizer_fn: makes a fresh tokenizer (without the encoding's tokens); AutoTokenizer(model_ckpt) by default
+    """
+    import glob
+    if tokenizer_fn is None:
+        from transformers import AutoTokenizer
+        tokenizer_fn = lambda: AutoTokenizer.from_pretrained(model_ckpt)
+    for fname in sorted(glob.glob('data/*/*/eval.json')):
+        dataset, encoding = fname.split('/')[1:3]
+        tokenizer = tokenizer_fn()
+        tokenizer.add_tokens(json.load(open(f'data/{dataset}/{encoding}/tokens.json', 'r')))
+        grammar = EncodingGrammar(get_decoding_schema(dataset, encoding, tokenizer), tokenizer)
+        targets = [record['target'] for record, _ in zip(utils.iter_json_array(fname), range(max_targets or 1 << 62))]
+        failures = []
+        for target, ids in zip(targets, tokenizer(targets)['input_ids']):
+            i = masked_gold_token(grammar, ids)
+            if i is not None:
+                failures.append((target, tokenizer.convert_ids_to_tokens(ids[:i + 1])[-5:]))
+        print(f'{dataset}/{encoding}: {len(targets) - len(failures)}/{len(targets)} gold targets in the grammar')
+        assert not failures, f'masked out at the end of {failures[0][1]} in {failures[0][0]!r}'
+
+
+# Generates from a tiny, randomly initialised model (so, garbage) with and without the constraints, and
+# counts how many of the outputs stay inside the grammar; with them, all of them should
+def test_constrained_generation(dataset: str, encoding: str, n_examples: int = 8):
+    import torch
+    from transformers import AutoTokenizer, T5Config, T5ForConditionalGeneration
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained('t5-small')
+    tokenizer.add_tokens(json.load(open(f'data/{dataset}/{encoding}/tokens.json', 'r')))
+    config = T5Config(vocab_size=len(tokenizer), d_model=32, d_kv=8, d_ff=64, num_layers=1, num_heads=2,
+                      decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    model = T5ForConditionalGeneration(config).eval()
+    # the input texts are the same for every encoding
+    texts = [record['text'] for record, _ in zip(utils.iter_json_array(f'data/{dataset}/boring/eval.json'),
+                                                  range(n_examples))]
+    inputs = tokenizer(texts, max_length=128, truncation=True, padding=True, return_tensors='pt')
+    grammar = EncodingGrammar(get_decoding_schema(dataset, encoding, tokenizer), tokenizer)
+    for constrained in [False, True]:
+        for num_beams in [1, 3]:
+            kwargs = {'logits_processor': grammar_logits_processor(tokenizer, dataset, encoding)} if constrained else {}
+            with torch.no_grad():
+                outputs = model.generate(**inputs, max_new_tokens=64, num_beams=num_beams, do_sample=False, **kwargs)
+            in_grammar = sum(grammar.run(row[1:].tolist())[0] != 'free' for row in outputs)
+            print(f'{dataset}/{encoding} {constrained=} {num_beams=}: {in_grammar}/{len(outputs)} in the grammar')
+            if constrained:
+                assert in_grammar == len(outputs)
+
+
+if __name__ == '__main__':
+    test_gold_targets()
+    for encoding in ['boring', 'vertex_ref', 'boring_evidence', 'vertex_ref_evidence']:
+        test_constrained_generation('docred', encoding)
@@ -0,0 +1,247 @@
+import json
+import mmap
+import os
+from typing import Iterator, Union
+
+import numpy as np
+
+from classes import Article, Relation, Entity
+
+# A compact binary corpus format, so that loading a split is just an mmap rather than re-parsing
+# megabytes of pretty-printed json every run. The layout is:
+#
+#   MAGIC | uint64 header length | json header | (padding) | sections...
+#
+# The header holds the small tables (relation types, slot name lists) and the byte offset, dtype and
+# length of every section. The sections are flat numpy arrays:
+#
+#   text_offsets/text_bytes        utf-8 article texts, article i is text_bytes[text_offsets[i]:text_offsets[i+1]]
+#   target_offsets/target_bytes    same, for Article.target
+#   span_offsets/span_bytes        the table of distinct entity spans
+#   vertex_offsets/vertex_spans    each article's entities (Article.entity_index order), as span ids
+#   rel_offsets                    each article's relations are rows rel_offsets[i]:rel_offsets[i+1]
+#   rel_types/rel_slot_sets        per relation: index into the type/slot tables in the header
+#   ent_offsets/ent_vertices       per relation: its entities, as (per-article) vertex ids
+#   ev_offsets/ev_values           per relation: its evidence sentence indices (-1 for anything non-int)
+#   word_offsets/word_bytes        every article's words (Article.words), one after the other
+#   words_offsets                  article i's words are word_offsets[words_offsets[i]:words_offsets[i+1]+1]
+#   sent_offsets/sent_values       each article's Article.sentence_offsets
+#   has_words/has_sentences        whether the article has words/sentence_offsets at all (they can be None)
+#
+# Everything is read through np.frombuffer on the mmap, so opening a corpus is close to free, any article
+# can be built in O(1), slices of a corpus share the same buffers, and separate processes reading the
+# same file share the same pages.
+
+MAGIC = b'GRCORPUS'
+VERSION = 2
+# sections are aligned so that every array can be viewed in place
+ALIGN = 8
+
+
+def _evidence_values(evidence) -> list[int]:
+    if not isinstance(evidence, (list, tuple)):
+        # e.g. the Relation default, which isn't a real list
+        return []
+    values = []
+    for x in evidence:
+        try:
+            values.append(int(x))
+        except (TypeError, ValueError):
+            values.append(-1)
+    return values
+
+
+def _string_table(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def write_corpus(articles: list[Article], fname: str) -> None:
+    types: dict[str, int] = {}
+    slot_sets: dict[tuple, int] = {}
+    span_ids: dict[str, int] = {}
+    vertex_counts, vertex_spans = [], []
+    rel_counts, rel_types, rel_slot_sets = [], [], []
+    ent_counts, ent_vertices = [], []
+    ev_counts, ev_values = [], []
+    texts, targets = [], []
+    words, word_counts, has_words = [], [], []
+    sent_counts, sent_values, has_sentences = [], [], []
+    for article in articles:
+        texts.append(article.text)
+        targets.append(article.target)
+        has_words.append(article.words is not None)
+        word_counts.append(len(article.words) if article.words is not None else 0)
+        words.extend(article.words or [])
+        has_sentences.append(article.sentence_offsets is not None)
+        sent_counts.append(len(article.sentence_offsets) if article.sentence_offsets is not None else 0)
+        sent_values.extend(article.sentence_offsets or [])
+        vertex_ids = article.entity_index
+        vertex_counts.append(len(vertex_ids))
+        vertex_spans.extend([span_ids.setdefault(vertex.span, len(span_ids)) for vertex in vertex_ids])
+        rel_counts.append(len(article.relations))
+        for rel in article.relations:
+            rel_types.append(types.setdefault(rel.rtype, len(types)))
+            rel_slot_sets.append(slot_sets.setdefault(tuple(rel.slots), len(slot_sets)))
+            ent_counts.append(len(rel.entities))
+            ent_vertices.extend([vertex_ids[entity] for entity in rel.entities])
+            evidence = _evidence_values(rel.evidence)
+            ev_counts.append(len(evidence))
+            ev_values.extend(evidence)
+
+    text_offsets, text_bytes = _string_table(texts)
+    target_offsets, target_bytes = _string_table(targets)
+    span_offsets, span_bytes = _string_table(list(span_ids))
+    word_offsets, word_bytes = _string_table(words)
+    sections = {
+        'text_offsets': text_offsets,
+        'text_bytes': text_bytes,
+        'target_offsets': target_offsets,
+        'target_bytes': target_bytes,
+        'span_offsets': span_offsets,
+        'span_bytes': span_bytes,
+        'vertex_offsets': _offsets(vertex_counts),
+        'vertex_spans': np.array(vertex_spans, dtype=np.int32),
+        'rel_offsets': _offsets(rel_counts),
+        'rel_types': np.array(rel_types, dtype=np.int32),
+        'rel_slot_sets': np.array(rel_slot_sets, dtype=np.int32),
+        'ent_offsets': _offsets(ent_counts),
+        'ent_vertices': np.array(ent_vertices, dtype=np.int32),
+        'ev_offsets': _offsets(ev_counts),
+        'ev_values': np.array(ev_values, dtype=np.int64),
+        'word_offsets': word_offsets,
+        'word_bytes': word_bytes,
+        'words_offsets': _offsets(word_counts),
+        'has_words': np.array(has_words, dtype=np.uint8),
+        'sent_offsets': _offsets(sent_counts),
+        'sent_values': np.array(sent_values, dtype=np.int64),
+        'has_sentences': np.array(has_sentences, dtype=np.uint8),
+    }
+
+    # the header has to record where the sections go, which depends on how long the header is,
+    # so lay the sections out relative to the end of the header and fix it up after
+    layout = {}
+    pos = 0
+    for name, array in sections.items():
+        layout[name] = [pos, array.dtype.str, len(array)]
+        pos += -(-array.nbytes // ALIGN) * ALIGN
+    header = {
+        'version': VERSION,
+        'n_articles': len(texts),
+        'types': list(types),
+        'slot_sets': [list(slots) for slots in slot_sets],
+        'sections': layout,
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+    # write to a temp file and move it into place, so readers never see a half-written corpus
+    tmp_fname = f'{fname}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.seek(data_start + layout[name][0])
+            f.write(array.tobytes())
+        f.truncate(data_start + pos)
+    os.replace(tmp_fname, fname)
+
+
+class Corpus:
+    """
+    A read-only, memory-mapped sequence of Articles (see write_corpus). Indexing builds the Article
+    on the fly; slicing with a step of 1 gives another Corpus over the same buffers.
+    """
+    def __init__(self, fname: str):
+        with open(fname, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self._mmap
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{fname} is not a corpus file')
+        header_len = int(np.frombuffer(buf, dtype=np.uint64, count=1, offset=len(MAGIC))[0])
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(buf[header_start:header_start + header_len]))
+        if header['version'] != VERSION:
+            raise ValueError(f'{fname} is corpus version {header["version"]}, expected {VERSION}')
+        data_start = -(-(header_start + header_len) // ALIGN) * ALIGN
+
+        self.fname = fname
+        self.types: list[str] = header['types']
+        self.slot_sets: list[list[str]] = header['slot_sets']
+        self._arrays: dict[str, np.ndarray] = {
+            name: np.frombuffer(buf, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+            for name, (offset, dtype, count) in header['sections'].items()
+        }
+        # spans are decoded (and their Entities built) the first time they're needed
+        self._entities: list = [None] * (len(self._arrays['span_offsets']) - 1)
+        self._start = 0
+        self._stop = header['n_articles']
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __repr__(self) -> str:
+        return f'<Corpus {self.fname} [{self._start}:{self._stop}]>'
+
+    def __iter__(self) -> Iterator[Article]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx: Union[int, slice]):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            view = object.__new__(Corpus)
+            view.__dict__.update(self.__dict__)
+            view._start = self._start + start
+            view._stop = self._start + max(start, stop)
+            return view
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('corpus index out of range')
+        return self._article(self._start + idx)
+
+    def _string(self, section: str, i: int) -> str:
+        offsets = self._arrays[f'{section}_offsets']
+        return self._arrays[f'{section}_bytes'][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def _entity(self, span_id: int) -> Entity:
+        entity = self._entities[span_id]
+        if entity is None:
+            entity = self._entities[span_id] = Entity('[UNK]', self._string('span', span_id))
+        return entity
+
+    def _article(self, i: int) -> Article:
+        a = self._arrays
+        vertices = [self._entity(span_id) for span_id in
+                    a['vertex_spans'][a['vertex_offsets'][i]:a['vertex_offsets'][i + 1]].tolist()]
+        relations = []
+        for r in range(a['rel_offsets'][i], a['rel_offsets'][i + 1]):
+            entities = [vertices[v] for v in a['ent_vertices'][a['ent_offsets'][r]:a['ent_offsets'][r + 1]].tolist()]
+            evidence = a['ev_values'][a['ev_offsets'][r]:a['ev_offsets'][r + 1]].tolist()
+            relations.append(Relation(self.types[a['rel_types'][r]], entities,
+                                      self.slot_sets[a['rel_slot_sets'][r]], evidence))
+        words = sentence_offsets = None
+        if a['has_words'][i]:
+            start, stop = int(a['words_offsets'][i]), int(a['words_offsets'][i + 1])
+            offsets = a['word_offsets'][start:stop + 1]
+            # all of the article's words are one run of bytes
+            word_bytes = a['word_bytes'][offsets[0]:offsets[-1]].tobytes() if stop > start else b''
+            offsets = (offsets - offsets[0]).tolist()
+            words = [word_bytes[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+        if a['has_sentences'][i]:
+            sentence_offsets = a['sent_values'][a['sent_offsets'][i]:a['sent_offsets'][i + 1]].tolist()
+        article = Article(self._string('text', i), relations, words, sentence_offsets)
+        article.target = self._string('target', i)
+        return article
@@ -1,11 +1,18 @@
-from typing import Tuple, cast, Iterable
+from typing import Tuple, Iterable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import pdb
+import numpy as np
+import instrumentation
 from classes import Entity, Relation, Article
-from sklearn.metrics import precision_recall_fscore_support, classification_report
+from schema import get_encoding_spec
 
 # This is where our human-readable evaluation metrics will go!
 # e.g. precision, recall, f1, etc.
 
+MISSING_LABEL = '<NONE>'
+
 def match_entity(e1: Entity, e2: Entity) -> bool:
     return e1.span == e2.span
 
@@ -24,62 +31,378 @@ def match_relation(true_rel: Relation, pred_rels: Iterable[Relation]) -> list[Re
     return list(matched_pred_rels)
 
 
-def compute_score(all_true_rels: list[list[Relation]],
-                  all_pred_rels: list[list[Relation]],
-                  possible_labels: dict) -> dict:
-    MISSING_LABEL = '<NONE>'
-    eval_labels = [MISSING_LABEL] + list(possible_labels.keys())
-    all_true_labels = []
-    all_pred_labels = []
+def _align_labels_scan(doc_true_rels: list[Relation], doc_pred_rels: list[Relation]) -> Tuple[list[str], list[str]]:
+    # the original alignment, which checks every true relation against every remaining prediction.
+    # align_labels only falls back on this when relations have different numbers of entities
+    # list of things that we've found matches for
+    doc_pred_rels = set(doc_pred_rels)
 
-    for doc_true_rels, doc_pred_rels in zip(all_true_rels, all_pred_rels):
-        # list of things that we've found matches for
-        doc_pred_rels = set(doc_pred_rels)
-
-        # the first task is to align all of the predicted relations to the true
-        # relations with matching entities
-        # this is potentially a one-to-many alignment, since it's possible to generate
-        # multiple copies of the same entities as predictions
-        true_rel_matches: dict[Relation, list[Relation]]= {}
-        for true_rel in doc_true_rels:
-            # determine which (if any) of the predictions go with this relation
-            matched_pred_rels = match_relation(true_rel, doc_pred_rels)
-            true_rel_matches[true_rel] = matched_pred_rels
-            # each prediction should only get aligned to a single true relation
-            doc_pred_rels = doc_pred_rels.difference(matched_pred_rels)
-
-        # we can tap in to sklearn's functions for all this stuff by flattening out
-        # the labels into parallel lists
-        doc_true_labels = []
-        doc_pred_labels = []
-
-        # for each true relation, consider all of the aligned predicted relations
-        for true_rel, pred_rel_matches in true_rel_matches.items():
-            # maybe we just didn't predict any relation for the same entities; we have a special label for this case
-            if len(pred_rel_matches) == 0:
-                pred_labels = [MISSING_LABEL]
-            # if we did find prediction(s), we just need the labels from them
-            else:
-                pred_labels = [rel.rtype for rel in pred_rel_matches]
-            # and what the true label was supposed to be
-            # once we have all the (1+) predicted labels, we update our bookkeeping
-            for pred_label in pred_labels:
-                doc_true_labels.append(true_rel.rtype)
-                doc_pred_labels.append(pred_label)
-        
-        # finally, we have to consider the predictions that didn't get aligned to anything
-        # this means we predicted entities that just didn't match anything, which is a mistake
-        unmatched_pred_labels = [rel.rtype for rel in doc_pred_rels]
-        for pred_label in unmatched_pred_labels:
-            # the correct thing would have been not to predict a relation for these entities at all! oops
-            doc_true_labels.append(MISSING_LABEL)
+    # the first task is to align all of the predicted relations to the true
+    # relations with matching entities
+    # this is potentially a one-to-many alignment, since it's possible to generate
+    # multiple copies of the same entities as predictions
+    true_rel_matches: dict[Relation, list[Relation]]= {}
+    for true_rel in doc_true_rels:
+        # determine which (if any) of the predictions go with this relation
+        matched_pred_rels = match_relation(true_rel, doc_pred_rels)
+        true_rel_matches[true_rel] = matched_pred_rels
+        # each prediction should only get aligned to a single true relation
+        doc_pred_rels = doc_pred_rels.difference(matched_pred_rels)
+
+    return _flatten_alignment(true_rel_matches, doc_pred_rels)
+
+
+def _flatten_alignment(true_rel_matches: dict[Relation, list[Relation]],
+                       unmatched_pred_rels: Iterable[Relation]) -> Tuple[list[str], list[str]]:
+    # flatten the alignment out into parallel lists of labels, one entry per (true, pred) pair
+    doc_true_labels = []
+    doc_pred_labels = []
+
+    # for each true relation, consider all of the aligned predicted relations
+    for true_rel, pred_rel_matches in true_rel_matches.items():
+        # maybe we just didn't predict any relation for the same entities; we have a special label for this case
+        if len(pred_rel_matches) == 0:
+            pred_labels = [MISSING_LABEL]
+        # if we did find prediction(s), we just need the labels from them
+        else:
+            pred_labels = [rel.rtype for rel in pred_rel_matches]
+        # and what the true label was supposed to be
+        # once we have all the (1+) predicted labels, we update our bookkeeping
+        for pred_label in pred_labels:
+            doc_true_labels.append(true_rel.rtype)
             doc_pred_labels.append(pred_label)
 
+    # finally, we have to consider the predictions that didn't get aligned to anything
+    # this means we predicted entities that just didn't match anything, which is a mistake
+    unmatched_pred_labels = [rel.rtype for rel in unmatched_pred_rels]
+    for pred_label in unmatched_pred_labels:
+        # the correct thing would have been not to predict a relation for these entities at all! oops
+        doc_true_labels.append(MISSING_LABEL)
+        doc_pred_labels.append(pred_label)
+
+    return doc_true_labels, doc_pred_labels
+
+
+def align_labels(doc_true_rels: list[Relation], doc_pred_rels: list[Relation]) -> Tuple[list[str], list[str]]:
+    """
+    parameters:
+        doc_true_rels: the gold relations for one document
+        doc_pred_rels: the predicted relations for the same document
+    returns:
+        parallel lists of true and predicted labels, one entry per aligned (true, pred) pair
+    """
+    # the (distinct) predictions, bucketed by their entity spans. Each true relation then takes its
+    # whole bucket with one lookup, which is the same as matching it against every remaining
+    # prediction with match_entities, as long as the entity lists are all the same length
+    pred_buckets: dict[tuple, list[Relation]] = {}
+    n_entities = {len(rel.entities) for rel in doc_true_rels}
+    for pred_rel in dict.fromkeys(doc_pred_rels):
+        pred_buckets.setdefault(tuple(e.span for e in pred_rel.entities), []).append(pred_rel)
+        n_entities.add(len(pred_rel.entities))
+    if len(n_entities) > 1:
+        # match_entities zips, so a shorter entity list can match a prefix of a longer one
+        return _align_labels_scan(doc_true_rels, doc_pred_rels)
+
+    true_rel_matches: dict[Relation, list[Relation]] = {}
+    for true_rel in doc_true_rels:
+        # each prediction should only get aligned to a single true relation, so the bucket is used up
+        true_rel_matches[true_rel] = pred_buckets.pop(tuple(e.span for e in true_rel.entities), [])
+
+    return _flatten_alignment(true_rel_matches, [rel for rels in pred_buckets.values() for rel in rels])
+
+
+class ConfusionMatrix:
+    """
+    How many times each (true label, predicted label) pair was aligned, as an integer matrix:
+    counts[true_id, pred_id]. The ids are MISSING_LABEL then the rel_types.json labels in order; any
+    other label that turns up gets the next free id. Matrices from different shards of the data can
+    be merged together.
+    """
+    def __init__(self, possible_labels: dict = None):
+        self.labels: list[str] = [MISSING_LABEL] + list(possible_labels or {})
+        self.label_ids: dict[str, int] = {label: i for i, label in enumerate(self.labels)}
+        self.counts = np.zeros((len(self.labels), len(self.labels)), dtype=np.int64)
+
+    def __repr__(self) -> str:
+        return f'<ConfusionMatrix {len(self.labels)} labels|{self.total} pairs>'
+
+    @property
+    def total(self) -> int:
+        return int(self.counts.sum())
+
+    def label_id(self, label: str) -> int:
+        label_id = self.label_ids.get(label)
+        if label_id is None:
+            label_id = self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+            self.counts = np.pad(self.counts, ((0, 1), (0, 1)))
+        return label_id
+
+    def add_labels(self, true_labels: list[str], pred_labels: list[str]) -> None:
+        true_ids = np.array([self.label_id(label) for label in true_labels], dtype=np.int64)
+        pred_ids = np.array([self.label_id(label) for label in pred_labels], dtype=np.int64)
+        np.add.at(self.counts, (true_ids, pred_ids), 1)
+
+    def merge(self, other: 'ConfusionMatrix') -> 'ConfusionMatrix':
+        ids = [self.label_id(label) for label in other.labels]
+        self.counts[np.ix_(ids, ids)] += other.counts
+        return self
+
+    def to_counter(self) -> Counter:
+        true_ids, pred_ids = np.nonzero(self.counts)
+        return Counter({(self.labels[t], self.labels[p]): int(self.counts[t, p])
+                        for t, p in zip(true_ids.tolist(), pred_ids.tolist())})
+
+
+def count_labels(all_true_rels: list[list[Relation]],
+                 all_pred_rels: list[list[Relation]],
+                 possible_labels: dict = None) -> ConfusionMatrix:
+    """
+    returns:
+        how many times each (true label, predicted label) pair was aligned, over all of the documents
+    """
+    label_counts = ConfusionMatrix(possible_labels)
+    all_true_labels = []
+    all_pred_labels = []
+    for doc_true_rels, doc_pred_rels in zip(all_true_rels, all_pred_rels):
+        doc_true_labels, doc_pred_labels = align_labels(doc_true_rels, doc_pred_rels)
         all_true_labels.extend(doc_true_labels)
         all_pred_labels.extend(doc_pred_labels)
+    label_counts.add_labels(all_true_labels, all_pred_labels)
+    return label_counts
+
+
+def _prf_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    # x/0 is 0, like sklearn's default zero_division
+    mask = denominator == 0
+    result = np.asarray(numerator, dtype=np.float64) / np.where(mask, 1, denominator).astype(np.float64)
+    result[mask] = 0.0
+    return result
+
+
+def classification_report(label_counts: ConfusionMatrix, labels: list[str], digits: int = 2) -> Tuple[str, dict]:
+    """
+    The same per-label and averaged precision/recall/f1 as sklearn.metrics.classification_report, but
+    computed straight from the confusion matrix rather than from the flattened label lists.
+    parameters:
+        label_counts: the aligned label counts
+        labels: the labels to report on, in order
+    returns:
+        the printable report, and the report as a dict (what classification_report(output_dict=True) gives)
+    """
+    counts = label_counts.counts
+    if label_counts.total == 0:
+        raise ValueError('Found empty input array (e.g., `y_true` or `y_pred`) while a minimum of 1 sample is required.')
+    all_tp = np.diag(counts)
+    all_pred = counts.sum(axis=0)
+    all_true = counts.sum(axis=1)
+    ids = np.array([label_counts.label_ids.get(label, -1) for label in labels], dtype=np.int64)
+    seen = ids >= 0
+    tp = np.where(seen, all_tp[ids], 0)
+    pred_sum = np.where(seen, all_pred[ids], 0)
+    true_sum = np.where(seen, all_true[ids], 0)
+    # sklearn's supports come out as floats when nothing at all was predicted correctly
+    support = true_sum.astype(np.float64) if all_tp.sum() == 0 else true_sum
+
+    precision = _prf_divide(tp, pred_sum)
+    recall = _prf_divide(tp, true_sum)
+    f1 = _prf_divide(2.0 * tp, 1.0 * true_sum + pred_sum)
+
+    # the micro average is just accuracy, unless some pairs involve labels we aren't reporting on
+    present = {label for label, i in label_counts.label_ids.items() if all_pred[i] or all_true[i]}
+    micro_heading = 'accuracy' if set(labels) >= present else 'micro avg'
+    micro_tp, micro_pred, micro_true = np.array([tp.sum()]), np.array([pred_sum.sum()]), np.array([true_sum.sum()])
+    try:
+        weighted = [float(np.average(x, weights=true_sum)) for x in (precision, recall, f1)]
+    except ZeroDivisionError:
+        weighted = [float(np.average(x)) for x in (precision, recall, f1)]
+    averages = {
+        micro_heading: [float(_prf_divide(micro_tp, micro_pred)[0]),
+                        float(_prf_divide(micro_tp, micro_true)[0]),
+                        float(_prf_divide(2.0 * micro_tp, 1.0 * micro_true + micro_pred)[0])],
+        'macro avg': [float(np.nanmean(x)) for x in (precision, recall, f1)],
+        'weighted avg': weighted,
+    }
+    total_support = support.sum()
+
+    headers = ['precision', 'recall', 'f1-score', 'support']
+    report_dict = {}
+    for label, p, r, f, s in zip(labels, precision, recall, f1, support):
+        report_dict[f'{label}'] = dict(zip(headers, [float(p), float(r), float(f), float(s)]))
+    for heading, (p, r, f) in averages.items():
+        report_dict[heading] = dict(zip(headers, [p, r, f, float(total_support)]))
+    if micro_heading == 'accuracy':
+        report_dict['accuracy'] = report_dict['accuracy']['precision']
+
+    # the text layout is copied from sklearn, so the printed report looks the same as it always has
+    width = max(max(len(f'{label}') for label in labels), len('weighted avg'), digits)
+    head_fmt = '{:>{width}s} ' + ' {:>9}' * len(headers)
+    row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+    report = head_fmt.format('', *headers, width=width) + '\n\n'
+    for label, p, r, f, s in zip(labels, precision, recall, f1, support):
+        report += row_fmt.format(f'{label}', p, r, f, s, width=width, digits=digits)
+    report += '\n'
+    for heading, (p, r, f) in averages.items():
+        if heading == 'accuracy':
+            accuracy_fmt = '{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n'
+            report += accuracy_fmt.format(heading, '', '', f, total_support, width=width, digits=digits)
+        else:
+            report += row_fmt.format(heading, p, r, f, total_support, width=width, digits=digits)
+    return report, report_dict
+
+
+def score_counts(label_counts: ConfusionMatrix, possible_labels: dict) -> dict:
+    eval_labels = [MISSING_LABEL] + list(possible_labels.keys())
+    report, report_dict = classification_report(label_counts, eval_labels)
+    print(report)
+    return report_dict
+
+
+class ScoreAccumulator:
+    """
+    compute_score, a batch at a time: update() with each batch of true/predicted relations, merge() in
+    accumulators from other shards (e.g. other processes or nodes), and result() for the report. Only
+    the label counts are kept, so memory doesn't grow with the number of documents scored.
+    """
+    def __init__(self, possible_labels: dict):
+        self.possible_labels = possible_labels
+        self.label_counts = ConfusionMatrix(possible_labels)
+        self.n_docs = 0
+
+    def __repr__(self) -> str:
+        return f'<ScoreAccumulator {self.n_docs} docs|{self.label_counts.total} pairs>'
+
+    def update(self, batch_true_rels: list[list[Relation]], batch_pred_rels: list[list[Relation]]) -> 'ScoreAccumulator':
+        with instrumentation.stage('score'):
+            label_counts = count_labels(batch_true_rels, batch_pred_rels, self.possible_labels)
+        return self.update_counts(label_counts, len(batch_true_rels))
+
+    def update_counts(self, label_counts: ConfusionMatrix, n_docs: int) -> 'ScoreAccumulator':
+        # for counts that were already aligned elsewhere, e.g. by a ParallelScorer
+        self.label_counts.merge(label_counts)
+        self.n_docs += n_docs
+        return self
+
+    def merge(self, other: 'ScoreAccumulator') -> 'ScoreAccumulator':
+        return self.update_counts(other.label_counts, other.n_docs)
+
+    def result(self) -> dict:
+        return score_counts(self.label_counts, self.possible_labels)
+
+
+def compute_score(all_true_rels: list[list[Relation]],
+                  all_pred_rels: list[list[Relation]],
+                  possible_labels: dict) -> dict:
+    return ScoreAccumulator(possible_labels).update(all_true_rels, all_pred_rels).result()
+
+
+# Parallel delinearization + alignment for big eval sets. Each worker process gets its own copy of the
+# tokenizer once (when the pool starts), and then just delinearizes and aligns contiguous shards of the
+# prediction/label matrices. The partial label counts are added up at the end, and so are the workers'
+# profiles (see instrumentation.py), if profiling is on. Every shard is a round trip to a worker, and
+# delinearize_batch is vectorized across rows, so it only pays off for a lot of rows at once: with eval
+# scored a batch at a time, train.py saves the batches up and hands them over SCORER_CHUNK_ROWS at a time.
+
+# fewer rows than this to a shard isn't worth the round trip
+MIN_SHARD_ROWS = 64
+
+_worker_args = None
+
+def _init_worker(tokenizer, dataset: str, encoding: str, profiling: bool = False) -> None:
+    global _worker_args
+    _worker_args = (tokenizer, dataset, encoding)
+    # spawned workers don't inherit enable()
+    instrumentation.enable(profiling)
+
+def _delinearize_and_count_shard(pred_shard: np.ndarray, true_shard: np.ndarray):
+    import linearization
+    tokenizer, dataset, encoding = _worker_args
+    pred_rels = linearization.delinearize_batch(pred_shard, tokenizer, dataset, encoding, stage='delinearize/pred')
+    true_rels = linearization.delinearize_batch(true_shard, tokenizer, dataset, encoding, stage='delinearize/true')
+    possible_labels = get_encoding_spec(dataset, encoding).relation_types
+    with instrumentation.stage('score'):
+        label_counts = count_labels(true_rels, pred_rels, possible_labels)
+    profile = instrumentation.take().to_dict() if instrumentation.enabled() else None
+    return pred_rels, true_rels, label_counts, profile
+
+
+class ParallelScorer:
+    def __init__(self, tokenizer, dataset: str, encoding: str, num_workers: int):
+        self.num_workers = num_workers
+        self.dataset = dataset
+        self.encoding = encoding
+        # spawn rather than fork, since the parent process is usually holding a CUDA context
+        self.pool = ProcessPoolExecutor(max_workers=num_workers,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker,
+                                        initargs=(tokenizer, dataset, encoding, instrumentation.enabled()))
+
+    def delinearize_and_count(self, predictions, labels):
+        """
+        parameters:
+            predictions, labels: (N, L) token id matrices, or lists of N token id rows (which can be different
+                lengths, e.g. from batches padded to different lengths)
+        returns:
+            the predicted and true relations for each document (as from linearization.delinearize_batch),
+            and the ConfusionMatrix for all of them (as from count_labels)
+        """
+        # a few shards per worker so that one slow shard doesn't hold everything up, but not tiny ones
+        n_shards = max(1, min(len(predictions) // MIN_SHARD_ROWS, self.num_workers * 4))
+        bounds = np.linspace(0, len(predictions), n_shards + 1).astype(int)
+        results = self.pool.map(_delinearize_and_count_shard,
+                                [predictions[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+                                [labels[a:b] for a, b in zip(bounds[:-1], bounds[1:])])
+        all_pred_rels = []
+        all_true_rels = []
+        label_counts = ConfusionMatrix(get_encoding_spec(self.dataset, self.encoding).relation_types)
+        for pred_rels, true_rels, shard_counts, profile in results:
+            all_pred_rels.extend(pred_rels)
+            all_true_rels.extend(true_rels)
+            label_counts.merge(shard_counts)
+            # (the workers' stage times add up across processes, so they can come to more than the wall time)
+            instrumentation.merge(profile)
+        return all_pred_rels, all_true_rels, label_counts
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
 
-    print(classification_report(
-        all_true_labels, all_pred_labels, labels=eval_labels, output_dict=False))
+# The parallel path has to give exactly what the serial one does: the same relations for every document, and
+# the same label counts. Checked on the gold targets (as labels) against damaged copies of them (as predictions),
+# all at once and in ragged chunks like train.py hands over
+def test_parallel_scoring(tokenizer, dataset: str = 'docred', encoding: str = 'boring', num_workers: int = 2,
+                          max_docs: int = 500, chunk_rows: int = 150):
+    import linearization
+    import utils
+    records = [record for record, _ in zip(utils.iter_json_array(f'data/{dataset}/{encoding}/eval.json'), range(max_docs))]
+    labels = tokenizer([record['target'] for record in records])['input_ids']
+    rng = np.random.default_rng(0)
+    predictions = []
+    for ids in labels:
+        ids = list(ids)
+        # cut some off, and swap a few tokens around
+        ids = ids[:rng.integers(1, len(ids) + 1)] if rng.random() < 0.3 else ids
+        for _ in range(rng.integers(0, 3)):
+            i, j = rng.integers(0, len(ids), 2)
+            ids[i], ids[j] = ids[j], ids[i]
+        predictions.append(ids)
+    possible_labels = get_encoding_spec(dataset, encoding).relation_types
+    serial_pred = linearization.delinearize_batch(predictions, tokenizer, dataset, encoding)
+    serial_true = linearization.delinearize_batch(labels, tokenizer, dataset, encoding)
+    serial_counts = count_labels(serial_true, serial_pred, possible_labels).to_counter()
 
-    return cast(dict, classification_report(
-        all_true_labels, all_pred_labels, labels=eval_labels, output_dict=True))
+    scorer = ParallelScorer(tokenizer, dataset, encoding, num_workers)
+    try:
+        for chunk in [len(predictions), chunk_rows]:
+            pred_rels, true_rels, label_counts = [], [], ConfusionMatrix(possible_labels)
+            for start in range(0, len(predictions), chunk):
+                chunk_pred, chunk_true, chunk_counts = scorer.delinearize_and_count(predictions[start:start + chunk],
+                                                                                    labels[start:start + chunk])
+                pred_rels += chunk_pred
+                true_rels += chunk_true
+                label_counts.merge(chunk_counts)
+            assert pred_rels == serial_pred and true_rels == serial_true
+            assert label_counts.to_counter() == serial_counts
+            print(f'{dataset}/{encoding} in chunks of {chunk}: parallel == serial ({len(predictions)} docs)')
+    finally:
+        scorer.close()
@@ -0,0 +1,141 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Cold-start import times of the package's entry points, so that the ones that don't need a model (data
+# prep, scoring, offline rescoring) stay quick to start, and so that a top-level `import transformers`
+# (or torch, pandas, ...) creeping back in shows up. For each module it runs
+#   python -X importtime -c "import <module>"
+# in a fresh interpreter a few times, and reports
+#   wall       best total time, minus what an interpreter that imports nothing takes
+#   imports    the module's own cumulative import time, as -X importtime sees it (just the imports)
+#   heavy      any of HEAVY_PACKAGES that got imported; none of them should be until they're used
+#   slowest    which of the module's own imports took the longest
+# and exits with status 1 if anything imports a heavy package, or takes longer than --max-seconds.
+#
+#   python import_benchmark.py
+#   python import_benchmark.py evaluate archive --repeats 10 --max-seconds 0.5
+
+# the entry points, and what they're for
+ENTRY_POINTS = {
+    'build': 'data prep',
+    'length_profile': 'max lengths',
+    'linearization': 'encoding/decoding',
+    'streaming': 'incremental decoding',
+    'windowing': 'long documents',
+    'target_encoder': 'target tokenization',
+    'constraints': 'constrained generation',
+    'evaluate': 'scoring',
+    'archive': 'offline rescoring',
+    'benchmark': 'encoding benchmarks',
+    'server': 'inference server',
+    'train': 'training',
+}
+# the packages that take seconds to import between them
+HEAVY_PACKAGES = ['torch', 'transformers', 'datasets', 'tokenizers', 'pandas', 'sklearn', 'scipy']
+# `import time:  self [us] | cumulative | name`, with the name indented by how deep the import is
+_IMPORT_TIME_LINE = re.compile(r'import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)')
+
+
+def _run_import(module: str, cwd: str) -> tuple[float, str]:
+    # a fresh interpreter each time, so nothing's cached in sys.modules
+    code = f'import {module}' if module else 'pass'
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd,
+                          capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit {proc.returncode}')
+    return elapsed, proc.stderr
+
+
+def parse_import_times(stderr: str) -> dict[str, tuple[int, int]]:
+    """
+    parameters:
+        stderr: what `python -X importtime` printed
+    returns:
+        for each module imported, (depth, cumulative microseconds); depth 0 is imported by the code itself,
+        depth 1 by those, and so on
+    """
+    times = {}
+    for line in stderr.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = ((len(match.group(3)) - 1) // 2, int(match.group(2)))
+    return times
+
+
+def benchmark_import(module: str, repeats: int = 5, baseline: float = 0., cwd: str = '.') -> dict:
+    """
+    parameters:
+        module: the module to import, e.g. 'evaluate'
+        baseline: how long an interpreter that imports nothing takes, to take off the wall time
+    returns:
+        a row of the report
+    """
+    best, stderr = float('inf'), ''
+    for _ in range(repeats):
+        elapsed, stderr = _run_import(module, cwd)
+        best = min(best, elapsed)
+    times = parse_import_times(stderr)
+    heavy = sorted({name.split('.')[0] for name in times} & set(HEAVY_PACKAGES))
+    direct = sorted(((us, name) for name, (depth, us) in times.items() if depth == 1), reverse=True)
+    return {
+        'module': module,
+        'wall': max(best - baseline, 0.),
+        'imports': times.get(module, (0, 0))[1] / 1e6,
+        'heavy': heavy,
+        'slowest': [(name, us / 1e6) for us, name in direct[:3]],
+    }
+
+
+def run_benchmark(modules: list[str], repeats: int = 5, cwd: str = '.') -> list[dict]:
+    baseline = min(_run_import('', cwd)[0] for _ in range(repeats))
+    print(f'bare interpreter: {baseline:.3f}s (taken off the wall times)')
+    rows = []
+    for module in modules:
+        try:
+            rows.append(benchmark_import(module, repeats, baseline, cwd))
+        except RuntimeError as e:
+            # most likely a dependency that isn't installed here
+            rows.append({'module': module, 'error': str(e)})
+    return rows
+
+
+def report(rows: list[dict], max_seconds: float = None) -> list[str]:
+    """
+    returns:
+        the problems: heavy imports, and modules slower than max_seconds
+    """
+    problems = []
+    for row in rows:
+        what = ENTRY_POINTS.get(row['module'], '')
+        if 'error' in row:
+            print(f'{row["module"]:<16} {what:<24} failed: {row["error"]}')
+            continue
+        slowest = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in row['slowest'])
+        print(f'{row["module"]:<16} {what:<24} wall {row["wall"]:.3f}s  imports {row["imports"]:.3f}s  '
+              f'(slowest: {slowest})')
+        if row['heavy']:
+            problems.append(f'{row["module"]} imports {", ".join(row["heavy"])}')
+        if max_seconds is not None and row['wall'] > max_seconds:
+            problems.append(f'{row["module"]} takes {row["wall"]:.3f}s to import (> {max_seconds}s)')
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how long each entry point takes to import from cold')
+    parser.add_argument('modules', nargs='*', default=list(ENTRY_POINTS))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='fail if any module takes longer than this to import (on top of the interpreter)')
+    args = parser.parse_args()
+
+    rows = run_benchmark(args.modules, args.repeats, cwd=os.path.dirname(os.path.abspath(__file__)))
+    problems = report(rows, args.max_seconds)
+    for problem in problems:
+        print(f'PROBLEM {problem}')
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,172 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Stage timers and event counters, for telling where an eval epoch's time went (generation, delinearization,
+# scoring, writing the outputs, ...) and why relations went missing (which of the delinearizers' checks
+# threw them out). It's all off unless it's turned on, with enable() or RELATION_PROFILE=1 in the
+# environment, and then
+#
+#   with instrumentation.stage('delinearize'):      # adds up the time spent in the block
+#       ...
+#   instrumentation.count('delinearize/dropped/too_short')
+#   profile = instrumentation.take()                # everything since the last take(), e.g. one epoch
+#
+# Off, stage() hands back the same do-nothing context manager every time and count() returns straight
+# away, so the hooks can stay in the hot paths. Counters are named like paths, '<stage>/<what>'; the
+# delinearizers' ones are
+#   <stage>/sequences              sequences delinearized
+#   <stage>/relations              relations that came out
+#   <stage>/dropped/too_short      a <rel> without enough tokens after it for the type and slots
+#   <stage>/dropped/unknown_type   the token after <rel> isn't a relation type
+#   <stage>/dropped/slot_count     a slot (or evidence) marker missing, or there more than once
+#   <stage>/dropped/slot_order     the markers out of order
+#   <stage>/dropped/bad_vertex     a slot that isn't one <k>, or a <k> that isn't in the vertex list
+#   <stage>/dropped/duplicate      the same relation again
+#   <stage>/bad_vertices           <vertex>es in the vertex list that didn't have an index and a name
+# where <stage> is 'delinearize' (or whatever delinearize_batch was told), 'stream' for streaming.py, and
+# 'delinearize_<encoding>' for the per-encoding delinearizers. Those count every piece of the sequence
+# between <rel>s, so whatever's before the first one (e.g. BART's decoder start token) shows up as too_short.
+# Besides those,
+#   span_decoder/fallback          schema.SpanDecoder gave up on a faster way of decoding spans, for good
+#   target_encoder/fallback        target_encoder.TargetEncoder went back to the tokenizer, for good
+
+_enabled = os.environ.get('RELATION_PROFILE', '') not in ('', '0')
+_NOT_TIMING = contextlib.nullcontext()
+
+
+class Profile:
+    """
+    Time spent in each stage (and how many times it was entered), and the counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds: Counter = Counter()
+        self.calls: Counter = Counter()
+        self.counts: Counter = Counter()
+
+    def __repr__(self) -> str:
+        return f'<Profile {len(self.seconds)} stages|{len(self.counts)} counters>'
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counts[name] += n
+
+    def merge(self, other) -> 'Profile':
+        """
+        parameters:
+            other: another Profile, or one's to_dict() (e.g. from a worker process)
+        """
+        other = other if isinstance(other, Profile) else Profile.from_dict(other)
+        with self.lock:
+            self.seconds.update(other.seconds)
+            self.calls.update(other.calls)
+            self.counts.update(other.counts)
+        return self
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'stages': {stage: {'seconds': round(self.seconds[stage], 6), 'calls': self.calls[stage]}
+                           for stage in sorted(self.seconds)},
+                'counts': dict(sorted(self.counts.items())),
+            }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'Profile':
+        profile = cls()
+        for stage, timing in d['stages'].items():
+            profile.seconds[stage] = timing['seconds']
+            profile.calls[stage] = timing['calls']
+        profile.counts.update(d['counts'])
+        return profile
+
+    def metrics(self, prefix: str = 'profile/') -> dict[str, float]:
+        """
+        returns:
+            everything as one flat dict of numbers, for logging alongside the eval metrics
+        """
+        d = self.to_dict()
+        metrics = {f'{prefix}{stage}/seconds': timing['seconds'] for stage, timing in d['stages'].items()}
+        metrics.update({f'{prefix}{name}': n for name, n in d['counts'].items()})
+        return metrics
+
+    def write(self, fname: str) -> None:
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+_profile = Profile()
+
+
+class _Timer:
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _profile.add_time(self.name, time.perf_counter() - self.start)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(on: bool = True) -> None:
+    global _enabled
+    _enabled = on
+
+
+def stage(name: str):
+    """
+    returns:
+        a context manager that adds the time spent in it to the stage's total (if profiling is on)
+    """
+    return _Timer(name) if _enabled else _NOT_TIMING
+
+
+def count(name: str, n: int = 1) -> None:
+    if _enabled:
+        _profile.count(name, n)
+
+
+def count_all(counts: dict[str, int]) -> None:
+    # for counts that were worked out in bulk (only bother working them out if enabled())
+    if _enabled:
+        for name, n in counts.items():
+            if n:
+                _profile.count(name, n)
+
+
+def merge(other) -> None:
+    # e.g. a worker process' take().to_dict()
+    if _enabled and other is not None:
+        _profile.merge(other)
+
+
+def take() -> Profile:
+    """
+    returns:
+        everything since the last take() (or since the start), which starts over from nothing
+    """
+    global _profile
+    profile, _profile = _profile, Profile()
+    return profile
+
+
+def snapshot() -> dict:
+    # everything since the last take(), without starting over
+    return _profile.to_dict()
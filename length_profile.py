@@ -0,0 +1,182 @@
+import argparse
+import json
+
+import numpy as np
+
+import linearization
+import utils
+from schema import get_decoding_schema
+from target_encoder import TargetEncoder
+
+# Works out input/target max lengths for train.py from the data, rather than guessing. For a (dataset,
+# encoding) and the tokenizer that's going to be trained, it tokenizes a split, records the length
+# distributions, and counts how many of the gold relations each candidate max length would lose to
+# truncation:
+#   text:   a relation is lost if one of its entities doesn't appear in what's left of the text
+#   target: a relation is lost if it no longer comes out of the delinearizer
+# The max lengths written to config.json are the shortest candidates that lose at most MAX_LOST_FRACTION
+# of the relations (and never more than the model can take). build.py leaves them alone after that.
+#
+#   python length_profile.py facebook/bart-large --datasets docred --encodings boring vertex_ref
+
+CANDIDATE_LIMITS = [128, 192, 256, 320, 384, 448, 512, 640, 768, 896, 1024]
+MAX_LOST_FRACTION = 0.005
+PERCENTILES = [50, 90, 95, 99, 100]
+HISTOGRAM_BIN_SIZE = 64
+
+
+def _length_stats(lengths: np.ndarray) -> dict:
+    edges = np.arange(0, int(lengths.max(initial=0)) + HISTOGRAM_BIN_SIZE + 1, HISTOGRAM_BIN_SIZE)
+    counts, _ = np.histogram(lengths, bins=edges)
+    return {
+        'percentiles': {str(p): int(np.percentile(lengths, p)) if len(lengths) else 0 for p in PERCENTILES},
+        'mean': float(lengths.mean()) if len(lengths) else 0.0,
+        'histogram': {'bin_size': HISTOGRAM_BIN_SIZE, 'counts': counts.tolist()},
+    }
+
+
+def text_relations_lost(records: list[dict], tokenizer, limits: list[int]) -> dict[int, int]:
+    """
+    returns:
+        for each limit, how many of the gold relations mention an entity that's only in the truncated part
+        of the text (relations whose entities can't be found in the text at all don't count)
+    """
+    encodings = tokenizer([r['text'] for r in records], add_special_tokens=False, return_offsets_mapping=True)
+    n_content = {limit: max(limit - tokenizer.num_special_tokens_to_add(), 0) for limit in limits}
+    lost = {limit: 0 for limit in limits}
+    for record, offsets in zip(records, encodings['offset_mapping']):
+        text = record['text']
+        # where each relation's last entity first shows up in the text
+        ends = []
+        for rel in record['relations']:
+            positions = [text.find(ent['span']) for ent in rel['entities'].values()]
+            if all(p >= 0 for p in positions):
+                ends.append(max(p + len(ent['span']) for p, ent in zip(positions, rel['entities'].values())))
+        if not ends:
+            continue
+        ends = np.array(ends)
+        for limit in limits:
+            if n_content[limit] >= len(offsets):
+                continue
+            kept_chars = offsets[n_content[limit] - 1][1] if n_content[limit] else 0
+            lost[limit] += int((ends > kept_chars).sum())
+    return lost
+
+
+def _cut_relations(ids: list[int], n: int, rel_token: int, tokenizer) -> list[int]:
+    # ids[:n], minus the relation that got cut in half, if there is one. It's lost either way, and the
+    # vertex_ref delinearizer can't cope with half a relation (or half a vertex list) anyway
+    if len(ids) <= n:
+        return ids
+    next_rel = next((i for i in range(n, len(ids)) if ids[i] == rel_token), len(ids))
+    if not tokenizer.decode(ids[n:next_rel]).strip():
+        # only whitespace was cut off the end of it
+        return ids[:n]
+    rels = [i for i in range(n) if ids[i] == rel_token]
+    return ids[:rels[-1]] if rels else []
+
+
+def target_relations_lost(targets: list[str], tokenizer, dataset: str, encoding: str,
+                          limits: list[int], encoder: TargetEncoder = None) -> tuple[int, dict[int, int]]:
+    """
+    parameters:
+        encoder: the TargetEncoder to tokenize the targets with, if there's one already
+    returns:
+        the number of relations in the untruncated targets, and for each limit, how many of them don't
+        come back out of the truncated targets
+    """
+    # truncation keeps the special tokens, so it's the content that gets cut to make room for them. Only the
+    # content and the </s> go to the delinearizer, though (a leading <s> throws off vertex_ref's)
+    encoder = encoder or TargetEncoder(tokenizer, encoding)
+    content_ids = encoder.encode(targets, add_special_tokens=False)
+    n_content = lambda limit: max(limit - tokenizer.num_special_tokens_to_add(), 0)
+    rel_token = get_decoding_schema(dataset, encoding, tokenizer).rel_token
+    eos = [tokenizer.eos_token_id]
+    full = linearization.delinearize_batch([ids + eos for ids in content_ids], tokenizer, dataset, encoding)
+    n_relations = sum(len(rels) for rels in full)
+    lost = {}
+    for limit in limits:
+        truncated_ids = [_cut_relations(ids, n_content(limit), rel_token, tokenizer) + eos for ids in content_ids]
+        truncated = linearization.delinearize_batch(truncated_ids, tokenizer, dataset, encoding)
+        lost[limit] = sum(len(set(f) - set(t)) for f, t in zip(full, truncated))
+    return n_relations, lost
+
+
+def choose_limit(lost: dict[int, int], n_relations: int, lengths: np.ndarray, model_max_length: int) -> int:
+    # the shortest candidate that keeps enough of the relations, or just the longest input if it's shorter
+    usable = [limit for limit in sorted(lost) if limit <= model_max_length]
+    longest = int(lengths.max(initial=0))
+    for limit in usable:
+        if limit >= longest or lost[limit] <= MAX_LOST_FRACTION * n_relations:
+            return min(limit, max(longest, 1))
+    return usable[-1] if usable else model_max_length
+
+
+def profile(tokenizer, dataset: str, encoding: str, split: str = 'train', limits: list[int] = CANDIDATE_LIMITS) -> dict:
+    """
+    parameters:
+        tokenizer: the tokenizer train.py will use, with the encoding's tokens already added
+    returns:
+        the max lengths to train with, and the profile they came from (see the top of the file)
+    """
+    records = list(utils.iter_json_array(f'data/{dataset}/{encoding}/{split}.json'))
+    targets = [r['target'] for r in records]
+    text_lengths = np.array([len(ids) for ids in tokenizer([r['text'] for r in records])['input_ids']])
+    encoder = TargetEncoder(tokenizer, encoding)
+    target_lengths = np.array([len(ids) for ids in encoder.encode(targets)])
+
+    n_relations, target_lost = target_relations_lost(targets, tokenizer, dataset, encoding, limits, encoder)
+    text_lost = text_relations_lost(records, tokenizer, limits)
+    model_max_length = min(tokenizer.model_max_length, max(limits))
+    return {
+        'input_ids_max_len': choose_limit(text_lost, n_relations, text_lengths, model_max_length),
+        'labels_max_len': choose_limit(target_lost, n_relations, target_lengths, model_max_length),
+        'length_profile': {
+            'tokenizer': tokenizer.name_or_path,
+            'split': split,
+            'n_examples': len(records),
+            'n_relations': n_relations,
+            'max_lost_fraction': MAX_LOST_FRACTION,
+            'text': {**_length_stats(text_lengths), 'relations_lost': {str(k): v for k, v in text_lost.items()}},
+            'target': {**_length_stats(target_lengths), 'relations_lost': {str(k): v for k, v in target_lost.items()}},
+        },
+    }
+
+
+def format_report(dataset: str, encoding: str, config: dict) -> str:
+    prof = config['length_profile']
+    lines = [f'{dataset}/{encoding} ({prof["tokenizer"]}, {prof["split"]}: {prof["n_examples"]} examples, '
+             f'{prof["n_relations"]} relations)']
+    for side, chosen in [('text', config['input_ids_max_len']), ('target', config['labels_max_len'])]:
+        pct = ' '.join(f'p{p}={n}' for p, n in prof[side]['percentiles'].items())
+        lost = ' '.join(f'{limit}:{n}' for limit, n in prof[side]['relations_lost'].items())
+        lines.append(f'  {side:>6}: {pct}  -> {chosen}')
+        lines.append(f'          relations lost at each limit: {lost}')
+    return '\n'.join(lines)
+
+
+def write_config(dataset: str, encoding: str, config: dict) -> str:
+    fname = f'data/{dataset}/{encoding}/config.json'
+    config = {**json.load(open(fname, 'r')), **config}
+    json.dump(config, open(fname, 'w'), indent=2)
+    return fname
+
+
+if __name__ == '__main__':
+    from transformers import AutoTokenizer
+    parser = argparse.ArgumentParser(description='Profile the tokenized lengths of the linearized data and '
+                                                 'write the max lengths to use into config.json')
+    parser.add_argument('model_ckpt')
+    parser.add_argument('--datasets', nargs='+', default=['docred', 'evidence_inference'])
+    parser.add_argument('--encodings', nargs='+', default=['boring', 'vertex_ref'])
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--dry-run', action='store_true', help="just print the report, don't write config.json")
+    args = parser.parse_args()
+    for dataset in args.datasets:
+        for encoding in args.encodings:
+            tokenizer = AutoTokenizer.from_pretrained(args.model_ckpt)
+            tokenizer.add_tokens(json.load(open(f'data/{dataset}/{encoding}/tokens.json', 'r')))
+            config = profile(tokenizer, dataset, encoding, args.split)
+            print(format_report(dataset, encoding, config))
+            if not args.dry_run:
+                print(f'wrote {write_config(dataset, encoding, config)}')
@@ -1,64 +1,108 @@
-from typing import cast
+from typing import cast, Iterator, Optional
 import pdb
 import json
-import processing
+import numpy as np
 
+import instrumentation
 import utils
 from classes import Article, Relation, Entity
+from schema import get_decoding_schema, get_span_decoder, EncodingSpec
 
-def linearize_boring(docs: list[Article], dataset: str) -> list[str]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    # i guess we should have the DATASET by this point
-    name = 'boring'
-    new_words = ['<rel>'] + [f'<{k}>' for k in RELATION_TYPES.keys()] + [f'<{k}>' for k in RELATION_SLOTS]
-    json.dump(new_words, open(f'data/{dataset}/{name}/tokens.json', 'w'), indent=2)
 
+def encoding_files(spec: EncodingSpec) -> dict[str, str]:
+    """
+    returns:
+        the contents of the special tokens and model config files that train.py expects to find next
+        to the data (build.py writes these)
+    """
     config_data = {
         'input_ids_max_len': 600,
         'labels_max_len': 500,
     }
-    json.dump(config_data, open(f'data/{dataset}/{name}/config.json', 'w'), indent=2)
+    return {
+        'tokens.json': json.dumps(spec.tokens, indent=2),
+        'config.json': json.dumps(config_data, indent=2),
+    }
+
 
-    targets = []
-    for article in docs:
-        relation_strs = []
-        for rel in article.relations:
-            rel_pieces = ['<rel>', f'<{rel.rtype}>']
-            for entity, slot in zip(rel.entities, rel.slots):
-                rel_pieces += [f'<{slot}>', entity.span]
-            relation_strs.append(''.join(rel_pieces))
-        targets.append(' '.join(relation_strs))
-    return targets
+def _decode_vertices(vertex_token_seq: list[int], tokenizer, vertex_token: int) -> list[str]:
+    vertices = []
+    for x, vertex_seq in enumerate(utils.split_seq(vertex_token_seq, vertex_token)):
+        if len(vertex_seq) < 2:
+            continue
+        vertex_idx = tokenizer.convert_ids_to_tokens(vertex_seq.pop(0)).strip('<>')
+        # make sure it generates them in order
+        if int(vertex_idx) != x:
+            continue
+        vertices.append(tokenizer.decode(vertex_seq))
+    return vertices
+
+
+def _relation_pieces(rel: Relation, vertex_ids: Optional[dict[Entity, int]], evidence: bool) -> list[str]:
+    pieces = ['<rel>', f'<{rel.rtype}>']
+    for entity, slot in zip(rel.entities, rel.slots):
+        pieces += [f'<{slot}>', f'<{vertex_ids[entity]}>' if vertex_ids is not None else entity.span]
+    if evidence:
+        pieces += ['<es>', f'<{rel.evidence[0]}>', '<ee>', f'<{rel.evidence[1]}>']
+    return pieces
+
+
+def target_pieces(article: Article, encoding: str) -> list[str]:
+    """
+    parameters:
+        encoding: name of the linearization scheme, e.g. 'boring' or 'vertex_ref_evidence'
+    returns:
+        the article's target, as the strings that it's the concatenation of. Each of the scheme's added tokens
+        (<rel>, <P17>, <h>, ...) is a piece of its own (see target_encoder.py)
+    """
+    vertex_ids = article.entity_index if encoding.startswith('vertex_ref') else None
+    evidence = encoding.endswith('_evidence')
+    items = []
+    if vertex_ids is not None:
+        for vertex, x in vertex_ids.items():
+            items += [['<vertex>'], [f'<{x}>'], [f'{vertex}']]
+    items += [_relation_pieces(rel, vertex_ids, evidence) for rel in article.relations]
+    # everything is separated by a space, except within a relation
+    pieces = []
+    for i, item in enumerate(items):
+        if i:
+            pieces.append(' ')
+        pieces += item
+    return pieces
+
+
+def linearize_boring(docs: list[Article], dataset: str) -> list[str]:
+    return [''.join(target_pieces(article, 'boring')) for article in docs]
 
 
 def delinearize_boring(linearized_tokens: list[list[int]], tokenizer, dataset: str) -> list[list[Relation]]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    str2token = tokenizer.get_added_vocab()
-    rel_token = str2token['<rel>']
+    schema = get_decoding_schema(dataset, 'boring', tokenizer)
+    RELATION_SLOTS = schema.relation_slots
+    slot_tokens = schema.marker_tokens.tolist()
     per_doc_relations = []
     for token_seq in linearized_tokens:
         relations = set()
-        rel_token_seqs = utils.split_seq(token_seq, rel_token)
+        rel_token_seqs = utils.split_seq(token_seq, schema.rel_token)
         for rel_token_seq in rel_token_seqs:
             # Can't have fewer than the required tokens
             if len(rel_token_seq) < len(RELATION_SLOTS) + 1:
+                instrumentation.count('delinearize_boring/dropped/too_short')
                 continue
-            rel_type_str = tokenizer.convert_ids_to_tokens(int(rel_token_seq[0])).strip('<>')
             # The first token should be the relation type
-            if rel_type_str not in RELATION_TYPES:
+            rel_type_str = schema.id2type.get(int(rel_token_seq[0]))
+            if rel_type_str is None:
+                instrumentation.count('delinearize_boring/dropped/unknown_type')
                 continue
             # we need one head entity
-            slot_token_strs = [f'<{slot_name}>' for slot_name in RELATION_SLOTS]
-            slot_tokens = [str2token[slot_token] for slot_token in slot_token_strs]
             slot_token_counts = [rel_token_seq.count(slot_token) for slot_token in slot_tokens]
             if not all([count == 1 for count in slot_token_counts]):
+                instrumentation.count('delinearize_boring/dropped/slot_count')
                 continue
             # the tail can't come before the head
             slot_token_idxs = [rel_token_seq.index(slot_token) for slot_token in slot_tokens]
             valid_idxs = [slot_token_idxs[i] < slot_token_idxs[i+1] for i in range(len(slot_token_idxs)-1)]
             if not all(valid_idxs):
+                instrumentation.count('delinearize_boring/dropped/slot_order')
                 continue
 
             # everything seems in order! let's build the relation tuple
@@ -71,93 +115,52 @@ def delinearize_boring(linearized_tokens: list[list[int]], tokenizer, dataset: s
         per_doc_relations.append(list(relations))
     return per_doc_relations
 
+def data_records(articles: list[Article], targets: list[str]) -> Iterator[dict]:
+    for article, target in zip(articles, targets):
+        a_dict = article.to_dict()
+        a_dict['target'] = target
+        yield a_dict
+
 def write_data(articles: list[Article], targets: list[str],
                dataset: str, encoding: str, split: str) -> None:
-    article_dicts = [a.to_dict() for a in articles]
-    for a_dict, target in zip(article_dicts, targets):
-        a_dict['target'] = target
-    json.dump(article_dicts, open(f'data/{dataset}/{encoding}/{split}.json', 'w'), indent=2)
+    with utils.JsonArrayWriter(f'data/{dataset}/{encoding}/{split}.json') as writer:
+        writer.write_all(data_records(articles, targets))
 
 def linearize_vertex_ref(docs: list[Article], dataset: str) -> list[str]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    # i guess we should have the DATASET by this point
-    name = 'vertex_ref'
-    new_words = ['<rel>', '<vertex>'] + \
-                [f'<{k}>' for k in RELATION_TYPES.keys()] + \
-                [f'<{k}>' for k in RELATION_SLOTS] + \
-                [f'<{i}>' for i in range(100)]
-    json.dump(new_words, open(f'data/{dataset}/{name}/tokens.json', 'w'), indent=2)
-
-    config_data = {
-        'input_ids_max_len': 600,
-        'labels_max_len': 500,
-    }
-    json.dump(config_data, open(f'data/{dataset}/{name}/config.json', 'w'), indent=2)
-
-    outputs = []
-    for article in docs:
-        relation_strs = []
-        vertex_strs = []
-        vertices = article.get_entities()
-        for x, vertex in enumerate(vertices):
-            vertex_strs.append('<vertex>')
-            vertex_strs.append(f'<{x}>')
-            vertex_strs.append(f'{vertex}')
-        for rel in article.relations:
-            rel_pieces = ['<rel>', f'<{rel.rtype}>']
-            for entity, slot in zip(rel.entities, rel.slots):
-                rel_pieces += [f'<{slot}>', f'<{vertices.index(entity)}>']
-            relation_strs.append(''.join(rel_pieces))
-        target = ' '.join(vertex_strs + relation_strs)
-        outputs.append(target)
-    return outputs
-
+    return [''.join(target_pieces(article, 'vertex_ref')) for article in docs]
 
 
 def delinearize_vertex_ref(linearized_tokens: list[list[int]], tokenizer, dataset: str):
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    str2token = tokenizer.get_added_vocab()
-    rel_token = str2token['<rel>']
-    vertex_token = str2token['<vertex>']
+    schema = get_decoding_schema(dataset, 'vertex_ref', tokenizer)
+    RELATION_SLOTS = schema.relation_slots
+    slot_tokens = schema.marker_tokens.tolist()
     per_doc_relations = []
     for y, token_seq in enumerate(linearized_tokens):
         # print(tokenizer.convert_ids_to_tokens(token_seq))
         relations = set()
-        vertices = []
-        rel_token_seqs = utils.split_seq(token_seq, rel_token)
-        vertex_token_seqs = utils.split_seq(rel_token_seqs.pop(0), vertex_token)
-        for x, vertex_token_seq in enumerate(vertex_token_seqs):
-            # pdb.set_trace()
-            if len(vertex_token_seq) < 2:
-                continue
-            # print(tokenizer.convert_ids_to_tokens(vertex_token_seq))
-            vertex_idx = tokenizer.convert_ids_to_tokens(vertex_token_seq.pop(0)).strip('<>')
-            # make sure it generates them in order
-            if int(vertex_idx) != x:
-                continue
-            vertex_span = tokenizer.decode(vertex_token_seq)
-            vertices.append(vertex_span)
+        rel_token_seqs = utils.split_seq(token_seq, schema.rel_token)
+        vertices = _decode_vertices(rel_token_seqs.pop(0), tokenizer, schema.vertex_token)
         for rel_token_seq in rel_token_seqs:
             # Can't have fewer than the required tokens
             # pdb.set_trace()
             if len(rel_token_seq) < len(RELATION_SLOTS) + 1:
+                instrumentation.count('delinearize_vertex_ref/dropped/too_short')
                 continue
-            rel_type_str = tokenizer.convert_ids_to_tokens(rel_token_seq[0]).strip('<>')
             # The first token should be the relation type
-            if rel_type_str not in RELATION_TYPES:
+            rel_type_str = schema.id2type.get(int(rel_token_seq[0]))
+            if rel_type_str is None:
+                instrumentation.count('delinearize_vertex_ref/dropped/unknown_type')
                 continue
             # we need one head entity
-            slot_token_strs = [f'<{slot_name}>' for slot_name in RELATION_SLOTS]
-            slot_tokens = [str2token[slot_token] for slot_token in slot_token_strs]
             slot_token_counts = [rel_token_seq.count(slot_token) for slot_token in slot_tokens]
             if not all([count == 1 for count in slot_token_counts]):
+                instrumentation.count('delinearize_vertex_ref/dropped/slot_count')
                 continue
             # the tail can't come before the head
             slot_token_idxs = [rel_token_seq.index(slot_token) for slot_token in slot_tokens]
             valid_idxs = [slot_token_idxs[i] < slot_token_idxs[i + 1] for i in range(len(slot_token_idxs) - 1)]
             if not all(valid_idxs):
+                instrumentation.count('delinearize_vertex_ref/dropped/slot_order')
                 continue
 
             # everything seems in order! let's build the relation tuple
@@ -173,59 +176,38 @@ def delinearize_vertex_ref(linearized_tokens: list[list[int]], tokenizer, datase
 
 
 def linearize_boring_evidence(docs: list[Article], dataset: str) -> list[str]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    # i guess we should have the DATASET by this point
-    name = 'boring_evidence'
-    new_words = ['<rel>', '<ee>', '<es>'] + [f'<{k}>' for k in RELATION_TYPES.keys()] + [f'<{k}>' for k in RELATION_SLOTS]
-    json.dump(new_words, open(f'data/{dataset}/{name}/tokens.json', 'w'), indent=2)
-
-    config_data = {
-        'input_ids_max_len': 600,
-        'labels_max_len': 500,
-    }
-    json.dump(config_data, open(f'data/{dataset}/{name}/config.json', 'w'), indent=2)
-
-    targets = []
-    for article in docs:
-        relation_strs = []
-        for rel in article.relations:
-            rel_pieces = ['<rel>', f'<{rel.rtype}>']
-            for entity, slot in zip(rel.entities, rel.slots):
-                rel_pieces += [f'<{slot}>', entity.span]
-            rel_pieces.append(f'<es><{rel.evidence[0]}><ee><{rel.evidence[1]}>')
-            relation_strs.append(''.join(rel_pieces))
-        targets.append(' '.join(relation_strs))
-    return targets
+    return [''.join(target_pieces(article, 'boring_evidence')) for article in docs]
 
 
 def delinearize_boring_evidence(linearized_tokens: list[list[int]], tokenizer, dataset: str) -> list[list[Relation]]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    str2token = tokenizer.get_added_vocab()
-    rel_token = str2token['<rel>']
+    schema = get_decoding_schema(dataset, 'boring_evidence', tokenizer)
+    RELATION_SLOTS = schema.relation_slots
+    # the slots, then <es> and <ee>
+    slot_tokens = schema.marker_tokens.tolist()
     per_doc_relations = []
     for token_seq in linearized_tokens:
         relations = set()
-        rel_token_seqs = utils.split_seq(token_seq, rel_token)
+        rel_token_seqs = utils.split_seq(token_seq, schema.rel_token)
         for rel_token_seq in rel_token_seqs:
             # Can't have fewer than the required tokens
             if len(rel_token_seq) < len(RELATION_SLOTS) + 1:
+                instrumentation.count('delinearize_boring_evidence/dropped/too_short')
                 continue
-            rel_type_str = tokenizer.convert_ids_to_tokens(int(rel_token_seq[0])).strip('<>')
             # The first token should be the relation type
-            if rel_type_str not in RELATION_TYPES:
+            rel_type_str = schema.id2type.get(int(rel_token_seq[0]))
+            if rel_type_str is None:
+                instrumentation.count('delinearize_boring_evidence/dropped/unknown_type')
                 continue
             # we need one head entity
-            slot_token_strs = [f'<{slot_name}>' for slot_name in RELATION_SLOTS] + ['<es>', '<ee>']
-            slot_tokens = [str2token[slot_token] for slot_token in slot_token_strs]
             slot_token_counts = [rel_token_seq.count(slot_token) for slot_token in slot_tokens]
             if not all([count == 1 for count in slot_token_counts]):
+                instrumentation.count('delinearize_boring_evidence/dropped/slot_count')
                 continue
             # the tail can't come before the head
             slot_token_idxs = [rel_token_seq.index(slot_token) for slot_token in slot_tokens]
             valid_idxs = [slot_token_idxs[i] < slot_token_idxs[i+1] for i in range(len(slot_token_idxs)-1)]
             if not all(valid_idxs):
+                instrumentation.count('delinearize_boring_evidence/dropped/slot_order')
                 continue
 
             # everything seems in order! let's build the relation tuple
@@ -246,84 +228,41 @@ def delinearize_boring_evidence(linearized_tokens: list[list[int]], tokenizer, d
 
 
 def linearize_vertex_ref_evidence(docs: list[Article], dataset: str) -> list[str]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    # i guess we should have the DATASET by this point
-    name = 'vertex_ref'
-    new_words = ['<rel>', '<vertex>'] + \
-                [f'<{k}>' for k in RELATION_TYPES.keys()] + \
-                [f'<{k}>' for k in RELATION_SLOTS] + \
-                [f'<{i}>' for i in range(100)]
-    json.dump(new_words, open(f'data/{dataset}/{name}/tokens.json', 'w'), indent=2)
+    return [''.join(target_pieces(article, 'vertex_ref_evidence')) for article in docs]
 
-    config_data = {
-        'input_ids_max_len': 600,
-        'labels_max_len': 500,
-    }
-    json.dump(config_data, open(f'data/{dataset}/{name}/config.json', 'w'), indent=2)
-
-    outputs = []
-    for article in docs:
-        relation_strs = []
-        vertex_strs = []
-        vertices = article.get_entities()
-        for x, vertex in enumerate(vertices):
-            vertex_strs.append('<vertex>')
-            vertex_strs.append(f'<{x}>')
-            vertex_strs.append(f'{vertex}')
-        for rel in article.relations:
-            rel_pieces = ['<rel>', f'<{rel.rtype}>']
-            for entity, slot in zip(rel.entities, rel.slots):
-                rel_pieces += [f'<{slot}>', f'<{vertices.index(entity)}>']
-            rel_pieces.append(f'<es><{rel.evidence[0]}><ee><{rel.evidence[1]}>')
-            relation_strs.append(''.join(rel_pieces))
-        target = ' '.join(vertex_strs + relation_strs)
-        outputs.append(target)
-    return outputs
 
 def delinearize_vertex_ref_evidence(linearized_tokens: list[list[int]], tokenizer, dataset: str) -> list[list[Relation]]:
-    RELATION_TYPES = json.load(open(f'data/{dataset}/rel_types.json'))
-    RELATION_SLOTS = json.load(open(f'data/{dataset}/rel_slots.json'))
-    str2token = tokenizer.get_added_vocab()
-    rel_token = str2token['<rel>']
-    vertex_token = str2token['<vertex>']
+    schema = get_decoding_schema(dataset, 'vertex_ref_evidence', tokenizer)
+    RELATION_SLOTS = schema.relation_slots
+    # the slots, then <es> and <ee>
+    slot_tokens = schema.marker_tokens.tolist()
     per_doc_relations = []
     for y, token_seq in enumerate(linearized_tokens):
         # print(tokenizer.convert_ids_to_tokens(token_seq))
         relations = set()
-        vertices = []
-        rel_token_seqs = utils.split_seq(token_seq, rel_token)
-        vertex_token_seqs = utils.split_seq(rel_token_seqs.pop(0), vertex_token)
-        for x, vertex_token_seq in enumerate(vertex_token_seqs):
-            # pdb.set_trace()
-            if len(vertex_token_seq) < 2:
-                continue
-            # print(tokenizer.convert_ids_to_tokens(vertex_token_seq))
-            vertex_idx = tokenizer.convert_ids_to_tokens(vertex_token_seq.pop(0)).strip('<>')
-            # make sure it generates them in order
-            if int(vertex_idx) != x:
-                continue
-            vertex_span = tokenizer.decode(vertex_token_seq)
-            vertices.append(vertex_span)
+        rel_token_seqs = utils.split_seq(token_seq, schema.rel_token)
+        vertices = _decode_vertices(rel_token_seqs.pop(0), tokenizer, schema.vertex_token)
         for rel_token_seq in rel_token_seqs:
             # Can't have fewer than the required tokens
             # pdb.set_trace()
             if len(rel_token_seq) < len(RELATION_SLOTS) + 1:
+                instrumentation.count('delinearize_vertex_ref_evidence/dropped/too_short')
                 continue
-            rel_type_str = tokenizer.convert_ids_to_tokens(rel_token_seq[0]).strip('<>')
             # The first token should be the relation type
-            if rel_type_str not in RELATION_TYPES:
+            rel_type_str = schema.id2type.get(int(rel_token_seq[0]))
+            if rel_type_str is None:
+                instrumentation.count('delinearize_vertex_ref_evidence/dropped/unknown_type')
                 continue
             # we need one head entity
-            slot_token_strs = [f'<{slot_name}>' for slot_name in RELATION_SLOTS] + ['<es>', '<ee>']
-            slot_tokens = [str2token[slot_token] for slot_token in slot_token_strs]
             slot_token_counts = [rel_token_seq.count(slot_token) for slot_token in slot_tokens]
             if not all([count == 1 for count in slot_token_counts]):
+                instrumentation.count('delinearize_vertex_ref_evidence/dropped/slot_count')
                 continue
             # the tail can't come before the head
             slot_token_idxs = [rel_token_seq.index(slot_token) for slot_token in slot_tokens]
             valid_idxs = [slot_token_idxs[i] < slot_token_idxs[i + 1] for i in range(len(slot_token_idxs) - 1)]
             if not all(valid_idxs):
+                instrumentation.count('delinearize_vertex_ref_evidence/dropped/slot_order')
                 continue
 
             # everything seems in order! let's build the relation tuple
@@ -343,72 +282,436 @@ def delinearize_vertex_ref_evidence(linearized_tokens: list[list[int]], tokenize
 
 
 
+# Batched decoding for whole prediction matrices. The delinearize_* functions above walk every
+# sequence in Python; here the <rel>/slot/<vertex> positions for the whole batch are found at once
+# with numpy masks, and only the entity span slices of well-formed relations drop back into Python.
+# Those are all decoded together by the tokenizer's SpanDecoder (schema.py), and <k> vertex references
+# are looked up in schema.vertex_index_table instead of being decoded and parsed.
+# The parsing rules are the same as the per-encoding functions, so well-formed targets come out the same,
+# except that:
+#   - anything before the first <vertex> (like a decoder start token) isn't counted as a vertex, which
+#     used to push every index off by one
+#   - a vertex that's malformed leaves a hole rather than shifting the ones after it down, and a relation
+#     that refers to a vertex that isn't there (or to something other than a <k>) is skipped rather than
+#     raising an exception
+#   - the evidence is decoded without special tokens, so the last relation's doesn't end in </s>
+
+def _flatten_batch(linearized_tokens) -> tuple[np.ndarray, np.ndarray]:
+    """
+    parameters:
+        linearized_tokens: (N, L) array of token ids, or a ragged list of token id lists
+    returns:
+        all of the token ids concatenated into one array, and the N+1 row offsets into it
+    """
+    if isinstance(linearized_tokens, np.ndarray) and linearized_tokens.ndim == 2:
+        n_rows, n_cols = linearized_tokens.shape
+        flat = linearized_tokens.reshape(-1).astype(np.int64, copy=False)
+        row_offsets = np.arange(n_rows + 1, dtype=np.int64) * n_cols
+        return flat, row_offsets
+    rows = [np.asarray(seq, dtype=np.int64).reshape(-1) for seq in linearized_tokens]
+    row_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=row_offsets[1:])
+    flat = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    return flat, row_offsets
+
+
+def delinearize_batch(linearized_tokens, tokenizer, dataset: str, encoding: str,
+                      stage: str = 'delinearize') -> list[list[Relation]]:
+    """
+    parameters:
+        linearized_tokens: (N, L) array of token ids (e.g. generated predictions), or a list of token id lists
+        encoding: name of the linearization scheme, e.g. 'boring' or 'vertex_ref_evidence'
+        stage: what to time this as, and count the dropped relations under (see instrumentation.py), e.g. to
+            keep the predictions' apart from the labels'
+    returns:
+        each document's relations, in the order they were decoded rather than set order (which changes from
+        process to process with the hash seed). For well-formed targets they're the same relations as
+        delinearize_{encoding}'s, but not otherwise (see above): a decoder start token isn't counted as a
+        vertex, a malformed vertex leaves a hole instead of shifting the vertex indices after it, a relation
+        that refers to a missing vertex is dropped instead of raising, and evidence comes out without the
+        special tokens (e.g. a trailing </s>)
+    """
+    with instrumentation.stage(stage):
+        return _delinearize_batch(linearized_tokens, tokenizer, dataset, encoding, stage)
+
+
+def _delinearize_batch(linearized_tokens, tokenizer, dataset: str, encoding: str, stage: str) -> list[list[Relation]]:
+    schema = get_decoding_schema(dataset, encoding, tokenizer)
+    RELATION_SLOTS = schema.relation_slots
+    marker_tokens = schema.marker_tokens.tolist()
+
+    flat, row_offsets = _flatten_batch(linearized_tokens)
+    n_rows = len(row_offsets) - 1
+    n_tokens = len(flat)
+
+    # cut each sequence at its first token and at every <rel>, like utils.split_seq does
+    is_rel = flat == schema.rel_token
+    is_boundary = is_rel.copy()
+    is_boundary[row_offsets[:-1][row_offsets[:-1] < row_offsets[1:]]] = True
+    seg_starts = np.flatnonzero(is_boundary)
+    seg_ends = np.append(seg_starts[1:], n_tokens)
+    n_segs = len(seg_starts)
+    seg_rows = np.searchsorted(row_offsets, seg_starts, side='right') - 1
+    seg_of_token = np.cumsum(is_boundary) - 1
+    # the <rel> token itself isn't part of the relation
+    content_starts = seg_starts + is_rel[seg_starts]
+    content_lens = seg_ends - content_starts
+
+    # Can't have fewer than the required tokens
+    is_long_enough = content_lens >= len(RELATION_SLOTS) + 1
+    is_valid = is_long_enough.copy()
+    vertex_segs = np.full(n_rows, -1, dtype=np.int64)
+    if schema.has_vertices:
+        # the first non-empty piece of each sequence is the vertex list, not a relation
+        nonempty_segs = np.flatnonzero(content_lens > 0)
+        rows, first_idxs = np.unique(seg_rows[nonempty_segs], return_index=True)
+        vertex_segs[rows] = nonempty_segs[first_idxs]
+        is_valid[vertex_segs[rows]] = False
+
+    # The first token should be the relation type
+    first_tokens = flat[np.minimum(content_starts, max(n_tokens - 1, 0))] if n_tokens else np.zeros(0, dtype=np.int64)
+    seg_types = schema.lookup_types(first_tokens)
+    is_valid &= seg_types >= 0
+
+    # each slot (and evidence) marker appears exactly once, and they come in order
+    marker_idxs = np.full((len(marker_tokens), n_segs), -1, dtype=np.int64)
+    has_markers = np.ones(n_segs, dtype=bool)
+    for m, marker_token in enumerate(marker_tokens):
+        positions = np.flatnonzero(flat == marker_token)
+        counts = np.bincount(seg_of_token[positions], minlength=n_segs)
+        has_markers &= counts == 1
+        marker_idxs[m, seg_of_token[positions]] = positions
+    is_valid &= has_markers
+    in_order = np.ones(n_segs, dtype=bool)
+    if len(marker_tokens) > 1:
+        in_order = np.all(np.diff(marker_idxs, axis=0) > 0, axis=0)
+        is_valid &= in_order
+    if instrumentation.enabled():
+        # what each relation (anything after a <rel>) that didn't make it failed first
+        checks = [('too_short', is_long_enough), ('unknown_type', seg_types >= 0),
+                  ('slot_count', has_markers), ('slot_order', in_order)]
+        remaining = is_rel[seg_starts] if n_segs else np.zeros(0, dtype=bool)
+        remaining[vertex_segs[vertex_segs >= 0]] = False
+        counts = {f'{stage}/sequences': n_rows}
+        for reason, passed in checks:
+            counts[f'{stage}/dropped/{reason}'] = int(np.count_nonzero(remaining & ~passed))
+            remaining = remaining & passed
+        instrumentation.count_all(counts)
+
+    # everything else is slicing out the spans, and decoding them all at once
+    span_decoder = get_span_decoder(tokenizer)
+    per_doc_vertices: list[list[Optional[str]]] = [[] for _ in range(n_rows)]
+    if schema.has_vertices:
+        vertex_chunks = [_vertex_chunks(flat, content_starts[seg], seg_ends[seg], schema) if seg >= 0 else []
+                         for seg in vertex_segs.tolist()]
+        names = span_decoder.decode(tokenizer, [flat[start:stop].tolist() for chunks in vertex_chunks
+                                                for _, start, stop in chunks])
+        n_decoded = 0
+        for row, chunks in enumerate(vertex_chunks):
+            per_doc_vertices[row] = _vertex_list(chunks, names[n_decoded:n_decoded + len(chunks)])
+            n_decoded += len(chunks)
+        if instrumentation.enabled():
+            n_vertex_markers = sum(int(np.count_nonzero(flat[content_starts[seg]:seg_ends[seg]] == schema.vertex_token))
+                                   for seg in vertex_segs.tolist() if seg >= 0)
+            instrumentation.count_all({f'{stage}/bad_vertices': n_vertex_markers - n_decoded})
+
+    # (row, relation type index, the entity names if they're already known, how many texts it takes up)
+    pending = []
+    text_spans = []
+    tokens = flat.tolist()
+    vertex_indices = schema.lookup_vertex_indices(flat).tolist() if schema.has_vertices else []
+    valid_segs = np.flatnonzero(is_valid)
+    for row, rtype_idx, seg_end, idxs in zip(seg_rows[valid_segs].tolist(),
+                                             seg_types[valid_segs].tolist(),
+                                             seg_ends[valid_segs].tolist(),
+                                             marker_idxs[:, valid_segs].T.tolist()):
+        spans = _relation_spans(idxs, seg_end)
+        names = None
+        if schema.has_vertices:
+            names = [_vertex_name(tokens[start:stop], vertex_indices[start:stop], per_doc_vertices[row],
+                                  span_decoder, tokenizer) for start, stop in spans[:len(RELATION_SLOTS)]]
+            if None in names:
+                instrumentation.count(f'{stage}/dropped/bad_vertex')
+                continue
+            spans = spans[len(RELATION_SLOTS):]
+        pending.append((row, rtype_idx, names, len(spans)))
+        text_spans += [tokens[start:stop] for start, stop in spans]
+    texts = span_decoder.decode(tokenizer, text_spans, skip_special_tokens=True)
+
+    # dicts as insertion-ordered sets
+    per_doc_relations: list[dict[Relation, None]] = [{} for _ in range(n_rows)]
+    n_decoded = 0
+    for row, rtype_idx, names, n_texts in pending:
+        relation_texts = texts[n_decoded:n_decoded + n_texts]
+        n_decoded += n_texts
+        per_doc_relations[row].setdefault(_build_relation(rtype_idx, names, relation_texts, schema))
+    if instrumentation.enabled():
+        n_relations = sum(map(len, per_doc_relations))
+        instrumentation.count_all({f'{stage}/relations': n_relations,
+                                   f'{stage}/dropped/duplicate': len(pending) - n_relations})
+    return [list(relations) for relations in per_doc_relations]
+
+
+def _segment_markers(content: np.ndarray, schema, stage: Optional[str] = None) -> Optional[tuple[int, list[int]]]:
+    """
+    The checks delinearize_batch does on every segment, for just one.
+    parameters:
+        content: the tokens of one relation, after its <rel>
+        stage: what to count it under if it gets dropped (see instrumentation.py), if it should be counted
+    returns:
+        the relation type index and the position of each slot/evidence marker, or None if it isn't a valid relation
+    """
+    if len(content) < len(schema.relation_slots) + 1:
+        if stage:
+            instrumentation.count(f'{stage}/dropped/too_short')
+        return None
+    rtype_idx = int(schema.lookup_types(content[:1])[0])
+    if rtype_idx < 0:
+        if stage:
+            instrumentation.count(f'{stage}/dropped/unknown_type')
+        return None
+    marker_idxs = []
+    for marker_token in schema.marker_tokens.tolist():
+        positions = np.flatnonzero(content == marker_token)
+        if len(positions) != 1:
+            if stage:
+                instrumentation.count(f'{stage}/dropped/slot_count')
+            return None
+        marker_idxs.append(int(positions[0]))
+    if any(a >= b for a, b in zip(marker_idxs, marker_idxs[1:])):
+        if stage:
+            instrumentation.count(f'{stage}/dropped/slot_order')
+        return None
+    return rtype_idx, marker_idxs
+
+
+def _vertex_chunks(tokens: np.ndarray, start: int, stop: int, schema) -> list[tuple[int, int, int]]:
+    """
+    Finds the names in a vertex list, <vertex><0>name<vertex><1>name...
+    parameters:
+        start, stop: where the vertex list is in tokens
+    returns:
+        (k, name start, name stop) for each vertex that has a name and the right index token. Anything
+        before the first <vertex> (e.g. a decoder start token) isn't part of one
+    """
+    positions = start + np.flatnonzero(tokens[start:stop] == schema.vertex_token)
+    name_stops = np.append(positions[1:], stop)
+    index_tokens = schema.lookup_vertex_indices(tokens[np.minimum(positions + 1, len(tokens) - 1)])
+    chunks = []
+    for k, (position, name_stop, index) in enumerate(zip(positions.tolist(), name_stops.tolist(), index_tokens.tolist())):
+        # make sure it generates them in order
+        if name_stop - position > 2 and index == k:
+            chunks.append((k, position + 2, name_stop))
+    return chunks
+
+
+def _vertex_list(chunks: list[tuple[int, int, int]], names: list[str]) -> list[Optional[str]]:
+    """
+    returns:
+        the vertex names by index, with None for any that didn't come out right
+    """
+    vertices: list[Optional[str]] = [None] * (chunks[-1][0] + 1 if chunks else 0)
+    for (k, _, _), name in zip(chunks, names):
+        vertices[k] = name
+    return vertices
+
+
+def _vertex_name(span: list[int], span_indices: list[int], vertices: list[Optional[str]], span_decoder,
+                 tokenizer) -> Optional[str]:
+    """
+    parameters:
+        span: the tokens after a slot marker in a vertex_ref encoding, which should be a <k> (plus maybe </s>)
+        span_indices: schema.lookup_vertex_indices of them
+    returns:
+        the name of vertex k, or None if the span isn't one vertex index or there's no such vertex
+    """
+    refs = [i for i, k in enumerate(span_indices) if k >= 0]
+    if len(refs) != 1:
+        return None
+    # anything else has to be special tokens or whitespace
+    if not all(span_decoder.is_blank(tokenizer, token) for i, token in enumerate(span) if i != refs[0]):
+        return None
+    k = span_indices[refs[0]]
+    return vertices[k] if k < len(vertices) else None
+
+
+def _relation_spans(marker_idxs: list[int], seg_end: int) -> list[tuple[int, int]]:
+    """
+    parameters:
+        marker_idxs: the position of each slot marker, then the evidence markers (if any)
+        seg_end: one past the end of the relation's last span
+    returns:
+        the (start, stop) of the span after each marker
+    """
+    slice_idxs = marker_idxs + [seg_end]
+    return [(start + 1, stop) for start, stop in zip(slice_idxs[:-1], slice_idxs[1:])]
+
+
+def _build_relation(rtype_idx: int, names: Optional[list[str]], texts: list[str], schema) -> Relation:
+    """
+    parameters:
+        rtype_idx: the relation type index (schema.type_names)
+        names: the entity names for vertex_ref encodings, or None if they're the first texts
+        texts: the decoded spans (entity names, then evidence)
+    """
+    if names is None:
+        names, texts = texts[:len(schema.relation_slots)], texts[len(schema.relation_slots):]
+    entities = [Entity('[UNK]', name) for name in names]
+    rtype = schema.type_names[rtype_idx]
+    if schema.has_evidence:
+        return Relation(rtype, entities, schema.relation_slots, [text.strip('<>') for text in texts])
+    return Relation(rtype, entities, schema.relation_slots)
+
+
+def _decode_vertex_list(tokens: np.ndarray, schema, tokenizer) -> list[Optional[str]]:
+    """
+    delinearize_batch's vertex list decoding, for one list.
+    """
+    chunks = _vertex_chunks(tokens, 0, len(tokens), schema)
+    names = get_span_decoder(tokenizer).decode(tokenizer, [tokens[start:stop].tolist() for _, start, stop in chunks])
+    return _vertex_list(chunks, names)
+
+
+def _relation_from_markers(tokens: np.ndarray, rtype_idx: int, marker_idxs: list[int], seg_end: int,
+                           schema, tokenizer, vertices: list[Optional[str]]) -> Optional[Relation]:
+    """
+    delinearize_batch's span decoding, for one relation.
+    parameters:
+        tokens: token ids that the marker positions and seg_end index into
+        vertices: the decoded vertex list for vertex_ref encodings
+    returns:
+        the relation, or None if it refers to a vertex that isn't there
+    """
+    span_decoder = get_span_decoder(tokenizer)
+    spans = _relation_spans(marker_idxs, seg_end)
+    names = None
+    if schema.has_vertices:
+        n_slots = len(schema.relation_slots)
+        names = [_vertex_name(tokens[start:stop].tolist(), schema.lookup_vertex_indices(tokens[start:stop]).tolist(),
+                              vertices, span_decoder, tokenizer) for start, stop in spans[:n_slots]]
+        if None in names:
+            return None
+        spans = spans[n_slots:]
+    texts = span_decoder.decode(tokenizer, [tokens[start:stop].tolist() for start, stop in spans], skip_special_tokens=True)
+    return _build_relation(rtype_idx, names, texts, schema)
+
+
+# every encoding scheme, by name. The version goes into build.py's fingerprints, so bump it whenever
+# a change to the linearizer would change the targets it writes, and only that encoding gets rebuilt
+LINEARIZERS = {
+    'boring': linearize_boring,
+    'vertex_ref': linearize_vertex_ref,
+    'boring_evidence': linearize_boring_evidence,
+    'vertex_ref_evidence': linearize_vertex_ref_evidence,
+}
+DELINEARIZERS = {
+    'boring': delinearize_boring,
+    'vertex_ref': delinearize_vertex_ref,
+    'boring_evidence': delinearize_boring_evidence,
+    'vertex_ref_evidence': delinearize_vertex_ref_evidence,
+}
+ENCODING_VERSIONS = {
+    'boring': 1,
+    'vertex_ref': 1,
+    'boring_evidence': 1,
+    'vertex_ref_evidence': 1,
+}
+
 # Runs the encoding funcs for the DocRED train/eval splits, and writes the data to file
-# you may need to manually created the destination directory
+# (only the outputs that are out of date get rebuilt; see build.py)
 def write_all_docred():
-    dataset = 'docred'
-    import processing.docred
-    for fname_in, split in [('train_data', 'train'), ('dev', 'eval')]:
-        docs = processing.docred.get_docred(f'data/{dataset}/{fname_in}.json')
-        for encoding_name, encoding_func in [('boring', linearize_boring), ('vertex_ref', linearize_vertex_ref)]:
-            targets = encoding_func(docs, dataset)
-            write_data(docs, targets, 'docred', encoding_name, split)
+    import build
+    build.build(['docred'])
 
 # Runs the encoding funcs for the EvidenceInference train/eval splits, and writes the data to file
-# you may need to manually created the destination directory
 def write_all_ev_inf():
-    dataset = 'evidence_inference'
-    import processing.evidence_inference
-    for fname_in, split in [('ev_inf_train', 'train'), ('ev_inf_eval', 'eval')]:
-        docs = processing.evidence_inference.load_evidence_inference(f'data/{dataset}/{fname_in}.json')
-        for encoding_name, encoding_func in [('boring', linearize_boring), ('vertex_ref', linearize_vertex_ref)]:
-            targets = encoding_func(docs, dataset)
-            write_data(docs, targets, dataset, encoding_name, split)
+    import build
+    build.build(['evidence_inference'])
 
 # Tests to make sure that the process of
 #       article.relations -> linearized -> tokenized -> delinearized
 # gets you back to the starting relations
-def test_linearization(articles, dataset, name, linearization_fn, delinearization_fn):
-    # arbitrary choice of tokenizer; it may even be wise to test multiple different ones just in case
-    # ultimately, each tokenizer will fail to recreate the true originals in some way (e.g. missing accents)
-    # but this isn't a huge issue since the true relations will also be put through the tokenizer during training
-    from transformers import AutoTokenizer
-    tokenizer = AutoTokenizer.from_pretrained('t5-small')
-    new_tokens = json.load(open(f'data/{dataset}/{name}/tokens.json', 'r'))
-    tokenizer.add_tokens(new_tokens)
-    linearized_targets = linearization_fn(articles, dataset)
-    linearized_tokens = cast(list[list[int]], tokenizer(linearized_targets)['input_ids'])
-    delinearized_rels = delinearization_fn(linearized_tokens, tokenizer, dataset)
-    all_correct = 0
+def round_trip_errors(articles: list[Article], delinearized_rels: list[list[Relation]]) -> list[tuple[set, set]]:
+    """
+    returns:
+        for each article whose relations didn't come back exactly, the (missing, spurious) relation strings
+    """
+    errors = []
     for article, d_rels in zip(articles, delinearized_rels):
         # since we've overloaded the __hash__ implementation for Relations, this works!
-        if set(article.relations) == set(d_rels):
-            all_correct += 1
-        else:
+        if set(article.relations) != set(d_rels):
             true_strs = set(map(str, article.relations))
             pred_strs = set(map(str, d_rels))
-            print('TRUE:')
-            for rel in true_strs.difference(pred_strs):
-                print('\t', rel)
-            print('DECODED:')
-            for rel in pred_strs.difference(true_strs):
-                print('\t', rel)
-            print()
-    print(f'All correct = {all_correct}/{len(articles)} = {all_correct/len(articles)}')
+            errors.append((true_strs.difference(pred_strs), pred_strs.difference(true_strs)))
+    return errors
+
+def decoder_disagreements(relations: list[list[Relation]], batch_relations: list[list[Relation]]) -> list[int]:
+    """
+    parameters:
+        relations: what a delinearize_{encoding} function decoded
+        batch_relations: what delinearize_batch decoded from the same sequences
+    returns:
+        the indices of the sequences the two didn't decode the same relations from
+    """
+    return [i for i, (rels, batch_rels) in enumerate(zip(relations, batch_relations)) if set(rels) != set(batch_rels)]
+
+def test_linearization(articles, dataset, name, linearization_fn, delinearization_fn, tokenizer=None, verbose=True):
+    """
+    Round trips the articles through linearization_fn and delinearization_fn, and through delinearize_batch,
+    which has to decode the same relations as delinearization_fn from every one of the (gold) targets.
+    returns:
+        how many of the articles' relations came back exactly, and how many articles there were
+    """
+    # arbitrary choice of tokenizer; it may even be wise to test multiple different ones just in case
+    # ultimately, each tokenizer will fail to recreate the true originals in some way (e.g. missing accents)
+    # but this isn't a huge issue since the true relations will also be put through the tokenizer during training
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained('t5-small')
+        new_tokens = json.load(open(f'data/{dataset}/{name}/tokens.json', 'r'))
+        tokenizer.add_tokens(new_tokens)
+    all_correct = 0
+    n_articles = 0
+    # articles can be a generator (e.g. processing.docred.iter_docred), so work through it a chunk at a time
+    for chunk in utils.chunked(articles, 1000):
+        linearized_targets = linearization_fn(chunk, dataset)
+        linearized_tokens = cast(list[list[int]], tokenizer(linearized_targets)['input_ids'])
+        delinearized_rels = delinearization_fn(linearized_tokens, tokenizer, dataset)
+        # the decoders only part ways on malformed sequences (see delinearize_batch), which these aren't
+        batch_rels = delinearize_batch(linearized_tokens, tokenizer, dataset, name)
+        disagreements = decoder_disagreements(delinearized_rels, batch_rels)
+        assert not disagreements, (f'delinearize_batch and {delinearization_fn.__name__} decoded {len(disagreements)} '
+                                   f'{dataset} targets differently, e.g. {linearized_targets[disagreements[0]]!r}')
+        n_articles += len(chunk)
+        errors = round_trip_errors(chunk, delinearized_rels)
+        all_correct += len(chunk) - len(errors)
+        if verbose:
+            for missing, spurious in errors:
+                print('TRUE:')
+                for rel in missing:
+                    print('\t', rel)
+                print('DECODED:')
+                for rel in spurious:
+                    print('\t', rel)
+                print()
+    if verbose:
+        print(f'All correct = {all_correct}/{n_articles} = {all_correct/n_articles}')
+    return all_correct, n_articles
 
 def run_tests(name, linearization_fn, delinearization_fn):
     # somewhat awkwardly, the syntax for loading different datasets is a little different
     # TODO: standardize this so we can just loop over dataset names?
+    # (benchmark.py does every encoding on every dataset at once, with timings and without the printouts)
     print("Loading articles to test DocRED")
     import processing.docred
-    articles = processing.docred.get_docred('data/docred/dev.json')
-    input(f"Testing on DocRED {len(articles)=}. Press any key to continue.")
+    articles = processing.docred.iter_docred('data/docred/dev.json')
+    print("Testing on DocRED")
     test_linearization(articles, 'docred', name, linearization_fn, delinearization_fn)
-    
+
     print("Loading articles to test EvidenceInference")
     import processing.evidence_inference
     articles = processing.evidence_inference.load_evidence_inference('data/evidence_inference/ev_inf_eval.json')
-    input(f"Testing on EvInf {len(articles)=}. Press any key to continue.")
+    print(f"Testing on EvInf {len(articles)=}")
     test_linearization(articles, 'evidence_inference', name, linearization_fn, delinearization_fn)
 
 # test suites that will run the specific scheme on multiple datasets and print diagnostics
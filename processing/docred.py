@@ -1,10 +1,10 @@
-import pandas
 import json
 import pickle
 import pdb
 import os
 import utils
 import sys
+from typing import Iterator
 sys.path.append("..")
 import config
 
@@ -13,44 +13,47 @@ from classes import Article, Relation, Entity
 # take a filepath for json containing data
 # return a dictionary containing data of interest
 def get_docred(fp):
-    i = 0
-    file = pandas.read_json(fp)
-    articles = []
-    for index, row in file.iterrows():
-        document = ""
-        sentence_lengths = []
-        for sentence in row['sents']:
-            sentence_lengths.append(len(sentence))
-            for word in sentence:
-                document += word + ' '
+    return list(iter_docred(fp))
 
-        vertices = []
-        for vertex_set in row['vertexSet']:
-            vertex = dict()
-            for usage in vertex_set:
-                vertex['span'] = usage['name']
-                vertex['etype'] = usage['type']
-                sent_idx = sum(sentence_lengths[:usage['sent_id']])
-                vertex['start_idx'] = sent_idx + usage['pos'][0]
-                vertex['end_idx'] = sent_idx + usage['pos'][1]
-            vertices.append(vertex)
+# same as get_docred, but parses and yields the articles one at a time instead of loading
+# the whole file up front
+def iter_docred(fp) -> Iterator[Article]:
+    for row in utils.iter_json_array(fp):
+        yield docred_article(row)
 
+def docred_article(row: dict) -> Article:
+    words = []
+    # sentence_offsets[i] is the index of the first word of sentence i
+    sentence_offsets = [0]
+    for sentence in row['sents']:
+        words.extend(sentence)
+        sentence_offsets.append(len(words))
+    document = ''.join([word + ' ' for word in words])
 
-        relations = []
-        for relation in row['labels']:
-            h_vertex = vertices[relation['h']]
-            t_vertex = vertices[relation['t']]
-            entities = [Entity(h_vertex['etype'], h_vertex['span']),
-                        Entity(t_vertex['etype'], t_vertex['span'])]
-            # pdb.set_trace()
-            if relation['evidence'] == []:
-                continue
-            relations.append(Relation(relation['r'], entities, ['h', 't'], evidence=[relation['evidence'][0], relation['evidence'][-1]]))
+    vertices = []
+    for vertex_set in row['vertexSet']:
+        vertex = dict()
+        for usage in vertex_set:
+            vertex['span'] = usage['name']
+            vertex['etype'] = usage['type']
+            sent_idx = sentence_offsets[usage['sent_id']]
+            vertex['start_idx'] = sent_idx + usage['pos'][0]
+            vertex['end_idx'] = sent_idx + usage['pos'][1]
+        vertices.append(vertex)
 
-        article = Article(document, relations)
-        articles.append(article)
-        i += 1
-    return articles
+
+    relations = []
+    for relation in row['labels']:
+        h_vertex = vertices[relation['h']]
+        t_vertex = vertices[relation['t']]
+        entities = [Entity(h_vertex['etype'], h_vertex['span']),
+                    Entity(t_vertex['etype'], t_vertex['span'])]
+        # pdb.set_trace()
+        if relation['evidence'] == []:
+            continue
+        relations.append(Relation(relation['r'], entities, ['h', 't'], evidence=[relation['evidence'][0], relation['evidence'][-1]]))
+
+    return Article(document, relations, words, sentence_offsets)
 # take a dataset from json import format
 # return a linear string including vertices and relations
 def linearize_vertex_ref(dataset):
@@ -1,4 +1,3 @@
-import pandas as pd
 import json
 import os
 import pickle
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Caches extraction results, so a document that's already been seen (the same abstract resubmitted, say)
+# skips generation entirely. Two tiers:
+#   LRUCache   in memory, up to max_entries results
+#   DiskCache  optional, an sqlite file that survives restarts, up to max_bytes of results
+# ResultCache puts them together: look in memory, then on disk (copying hits back into memory), and write
+# new results to both.
+#
+# Results are keyed on a hash of the text and everything else that decides what comes out of the model: the
+# checkpoint (and a fingerprint of its weights), dataset/encoding and the generation settings (see cache_key).
+# The text is hashed exactly as it came in; e.g. byte-level BPE tokenizers tokenize differently spaced or
+# differently normalized texts differently, so they can come out with different relations.
+#
+# The values are whatever's passed in, as long as it can be stored as JSON; server.py stores each
+# document's relations as Relation.to_dict()s.
+
+DEFAULT_MEMORY_ENTRIES = 10000
+DEFAULT_DISK_MAX_BYTES = 1 << 30
+
+
+def cache_key(text: str, settings: dict) -> str:
+    """
+    parameters:
+        settings: everything besides the text that the result depends on (has to be JSON-serializable)
+    returns:
+        a hex digest identifying the result
+    """
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+
+class LRUCache:
+    """
+    In-memory least-recently-used cache of up to max_entries values.
+    """
+    def __init__(self, max_entries: int = DEFAULT_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.n_evictions = 0
+
+    def get(self, key: str):
+        """
+        returns:
+            the value, or None if it isn't cached
+        """
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.n_evictions += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class DiskCache:
+    """
+    sqlite-backed cache of up to max_bytes of JSON values (not counting sqlite's own overhead). Once it goes
+    over, the least recently used entries are deleted until it's back under.
+    """
+    def __init__(self, path: str, max_bytes: int = DEFAULT_DISK_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.n_evictions = 0
+        # the connection is shared between the server's threads; ResultCache's lock serializes the use of it
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.db.commit()
+        self.n_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def get(self, key: str):
+        row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value) -> None:
+        data = json.dumps(value)
+        old = self.db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+        self.n_bytes += len(data) - (old[0] if old else 0)
+        while self.n_bytes > self.max_bytes:
+            oldest = self.db.execute('SELECT key, size FROM results ORDER BY last_used LIMIT 1').fetchone()
+            if oldest is None:
+                break
+            self.db.execute('DELETE FROM results WHERE key = ?', (oldest[0],))
+            self.n_bytes -= oldest[1]
+            self.n_evictions += 1
+        self.db.commit()
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class ResultCache:
+    """
+    An LRUCache in front of an optional DiskCache, with hit/miss counts. Thread-safe.
+    """
+    def __init__(self, memory_entries: int = DEFAULT_MEMORY_ENTRIES, disk_path: Optional[str] = None,
+                 disk_max_bytes: int = DEFAULT_DISK_MAX_BYTES):
+        """
+        parameters:
+            disk_path: the sqlite file to keep results in, or None to only cache in memory
+        """
+        self.lock = threading.Lock()
+        self.memory = LRUCache(memory_entries)
+        self.disk = DiskCache(disk_path, disk_max_bytes) if disk_path else None
+        self.n_memory_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+
+    def get(self, key: str):
+        """
+        returns:
+            the cached value, or None
+        """
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.n_memory_hits += 1
+                return value
+            value = self.disk.get(key) if self.disk is not None else None
+            if value is not None:
+                self.n_disk_hits += 1
+                self.memory.put(key, value)
+                return value
+            self.n_misses += 1
+            return None
+
+    def put(self, key: str, value) -> None:
+        with self.lock:
+            self.memory.put(key, value)
+            if self.disk is not None:
+                self.disk.put(key, value)
+
+    def stats(self) -> dict:
+        with self.lock:
+            n_lookups = self.n_memory_hits + self.n_disk_hits + self.n_misses
+            stats = {
+                'lookups': n_lookups,
+                'memory_hits': self.n_memory_hits,
+                'disk_hits': self.n_disk_hits,
+                'misses': self.n_misses,
+                'hit_rate': round((n_lookups - self.n_misses) / n_lookups, 4) if n_lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'memory_evictions': self.memory.n_evictions,
+            }
+            if self.disk is not None:
+                stats.update({'disk_entries': len(self.disk), 'disk_bytes': self.disk.n_bytes,
+                              'disk_evictions': self.disk.n_evictions})
+            return stats
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
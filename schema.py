@@ -0,0 +1,307 @@
+import json
+import warnings
+import weakref
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+import instrumentation
+
+# All of the linearization schemes are built out of the same few added tokens: <rel>, one token per
+# relation type in rel_types.json, one per slot in rel_slots.json, and (depending on the scheme)
+# <vertex>, <es>/<ee> and the vertex index tokens <0>..<99>.
+#
+# EncodingSpec is the tokenizer-independent half of that, which is all the linearize_* functions need.
+# DecodingSchema adds the token ids for one particular tokenizer, for the delinearizers, and SpanDecoder
+# turns the spans between them back into text.
+# All of them are built once and memoized, so nothing gets re-read from disk on every call.
+
+ENCODINGS = ['boring', 'vertex_ref', 'boring_evidence', 'vertex_ref_evidence']
+
+# how many <k> vertex index tokens the vertex_ref schemes add to the vocabulary
+MAX_VERTICES = 100
+
+
+class EncodingSpec:
+    def __init__(self, dataset: str, encoding: str):
+        assert encoding in ENCODINGS, f'unknown encoding {encoding}'
+        self.dataset = dataset
+        self.encoding = encoding
+        self.relation_types: dict[str, str] = json.load(open(f'data/{dataset}/rel_types.json'))
+        self.relation_slots: list[str] = json.load(open(f'data/{dataset}/rel_slots.json'))
+        self.has_vertices: bool = encoding.startswith('vertex_ref')
+        self.has_evidence: bool = encoding.endswith('_evidence')
+
+        self.type_strs = [f'<{k}>' for k in self.relation_types.keys()]
+        self.slot_strs = [f'<{slot_name}>' for slot_name in self.relation_slots]
+        self.vertex_strs = [f'<{i}>' for i in range(MAX_VERTICES)] if self.has_vertices else []
+        # every relation needs each of these exactly once, in this order
+        self.marker_strs = self.slot_strs + (['<es>', '<ee>'] if self.has_evidence else [])
+
+    def __repr__(self) -> str:
+        return f'<EncodingSpec {self.dataset}/{self.encoding}>'
+
+    @property
+    def tokens(self) -> list[str]:
+        """
+        returns:
+            the new words that need to be added to the tokenizer for this scheme (i.e. tokens.json)
+        """
+        if self.encoding == 'boring':
+            head = ['<rel>']
+        elif self.encoding == 'boring_evidence':
+            head = ['<rel>', '<ee>', '<es>']
+        elif self.encoding == 'vertex_ref':
+            head = ['<rel>', '<vertex>']
+        else:
+            head = ['<rel>', '<vertex>', '<es>', '<ee>']
+        return head + self.type_strs + self.slot_strs + self.vertex_strs
+
+
+class DecodingSchema:
+    def __init__(self, spec: EncodingSpec, tokenizer):
+        self.spec = spec
+        self.relation_types = spec.relation_types
+        self.relation_slots = spec.relation_slots
+        self.has_vertices = spec.has_vertices
+        self.has_evidence = spec.has_evidence
+        self.vocab_size = len(tokenizer)
+
+        self.str2token: dict[str, int] = tokenizer.get_added_vocab()
+        self.rel_token: int = self.str2token['<rel>']
+        self.vertex_token: Optional[int] = self.str2token['<vertex>'] if spec.has_vertices else None
+        self.slot_tokens = np.array([self.str2token[s] for s in spec.slot_strs], dtype=np.int64)
+        self.marker_tokens = np.array([self.str2token[s] for s in spec.marker_strs], dtype=np.int64)
+        # vertex_ids[k] is the token id of <k>, and vertex_index_table the other way around (-1 for anything else)
+        self.vertex_ids = np.array([self.str2token[s] for s in spec.vertex_strs], dtype=np.int64)
+        self.vertex_index_table = np.full(self.vocab_size, -1, dtype=np.int64)
+        self.vertex_index_table[self.vertex_ids] = np.arange(len(self.vertex_ids))
+
+        # maps every token id to its index in type_names (or -1), using the same
+        # convert_ids_to_tokens(...).strip('<>') test the delinearizers have always used
+        self.type_names: list[str] = list(spec.relation_types.keys())
+        type_idxs = {rtype: i for i, rtype in enumerate(self.type_names)}
+        tokens = tokenizer.convert_ids_to_tokens(list(range(self.vocab_size)))
+        self.type_table = np.array([type_idxs.get(tok.strip('<>'), -1) if tok is not None else -1 for tok in tokens],
+                                   dtype=np.int64)
+        self.type_ids: set[int] = set(np.flatnonzero(self.type_table >= 0).tolist())
+        self.id2type: dict[int, str] = {i: self.type_names[self.type_table[i]] for i in self.type_ids}
+
+    def __repr__(self) -> str:
+        return f'<DecodingSchema {self.spec.dataset}/{self.spec.encoding} vocab={self.vocab_size}>'
+
+    def lookup_types(self, token_ids: np.ndarray) -> np.ndarray:
+        """
+        parameters:
+            token_ids: array of token ids
+        returns:
+            the relation type index of each token, or -1 if it isn't a relation type token
+        """
+        in_vocab = (token_ids >= 0) & (token_ids < len(self.type_table))
+        return np.where(in_vocab, self.type_table[np.where(in_vocab, token_ids, 0)], -1)
+
+    def lookup_vertex_indices(self, token_ids: np.ndarray) -> np.ndarray:
+        """
+        parameters:
+            token_ids: array of token ids
+        returns:
+            k for each <k> vertex index token, or -1 if it isn't one
+        """
+        in_vocab = (token_ids >= 0) & (token_ids < len(self.vertex_index_table))
+        return np.where(in_vocab, self.vertex_index_table[np.where(in_vocab, token_ids, 0)], -1)
+
+
+@lru_cache(maxsize=None)
+def get_encoding_spec(dataset: str, encoding: str) -> EncodingSpec:
+    return EncodingSpec(dataset, encoding)
+
+
+# keyed on the tokenizer object itself, so a schema lives exactly as long as its tokenizer does
+_decoding_schemas: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+def get_decoding_schema(dataset: str, encoding: str, tokenizer) -> DecodingSchema:
+    per_tokenizer = _decoding_schemas.setdefault(tokenizer, {})
+    # adding tokens to the tokenizer changes the ids, so that has to invalidate the schema
+    key = (dataset, encoding, len(tokenizer))
+    if key not in per_tokenizer:
+        per_tokenizer[key] = DecodingSchema(get_encoding_spec(dataset, encoding), tokenizer)
+    return per_tokenizer[key]
+
+
+# the printable characters GPT-2 style byte-level BPE uses for each byte (see transformers' bytes_to_unicode)
+def _byte_chars() -> dict[int, str]:
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    chars = {b: chr(b) for b in printable}
+    n = 0
+    for b in range(256):
+        if b not in chars:
+            chars[b] = chr(256 + n)
+            n += 1
+    return chars
+
+# what decode(clean_up_tokenization_spaces=True) does to the text
+_CLEAN_UPS = [(' .', '.'), (' ?', '?'), (' !', '!'), (' ,', ','), (" ' ", "'"), (" n't", "n't"), (" 'm", "'m"),
+              (" 's", "'s"), (" 've", "'ve"), (" 're", "'re")]
+
+def _clean_up(text: str) -> str:
+    for old, new in _CLEAN_UPS:
+        text = text.replace(old, new)
+    return text
+
+
+def _probe_spans(tokenizer, n_random: int = 200) -> list[list[int]]:
+    # token sequences to check a SpanDecoder against tokenizer.decode with: some real text (including the
+    # things decode's clean up changes), and random mixes of ordinary, added and special tokens
+    texts = ["Foo's bar . baz , qux isn't ! (1,000 m²)", 'Université de Montréal – Québec', '  two  spaces ',
+             '"quoted" [[x]] <3> 12.5% ?']
+    probes = [tokenizer(text, add_special_tokens=False)['input_ids'] for text in texts]
+    rng = np.random.default_rng(0)
+    vocab_size = len(tokenizer)
+    added = list(tokenizer.get_added_vocab().values())
+    for _ in range(n_random):
+        length = int(rng.integers(1, 7))
+        pool = rng.choice(3, size=length, p=[0.7, 0.2, 0.1])
+        probes.append([int(rng.integers(vocab_size)) if kind == 0 else
+                       int(rng.choice(added)) if kind == 1 else
+                       int(rng.choice(tokenizer.all_special_ids)) for kind in pool])
+    return probes
+
+
+class SpanDecoder:
+    """
+    Decodes a lot of short spans of token ids (entity names, evidence) at once, rather than with one
+    tokenizer.decode each. It has three ways of doing it, fastest first:
+        pieces     join each token's surface text from a precomputed table (or its bytes, for byte-level
+                   BPE). For tokenizers with a Metaspace (T5) or ByteLevel (BART) decoder
+        backend    the Rust tokenizer's decode_batch, for any other fast tokenizer
+        tokenizer  tokenizer.batch_decode
+    and uses the fastest one that decodes a set of probe spans exactly the way tokenizer.decode does. After
+    that each call only spot checks its first span against tokenizer.decode, and drops to the next way for
+    good if they don't agree (with a RuntimeWarning, counted as span_decoder/fallback, see instrumentation.py).
+    """
+    MODES = ['pieces', 'backend', 'tokenizer']
+
+    def __init__(self, tokenizer):
+        self.vocab_size = len(tokenizer)
+        self.special = np.zeros(self.vocab_size, dtype=bool)
+        self.special[[i for i in tokenizer.all_special_ids if 0 <= i < self.vocab_size]] = True
+        # whether a token id decodes to nothing but whitespace, as they come up
+        self._blank: dict[int, bool] = {}
+        self._build_pieces(tokenizer)
+        probes = _probe_spans(tokenizer)
+        self.mode = 'tokenizer'
+        self.clean_up = False
+        for mode in self.MODES[:-1]:
+            if self._check(mode, tokenizer, probes):
+                self.mode = mode
+                break
+
+    def __repr__(self) -> str:
+        return f'<SpanDecoder {self.mode}>'
+
+    def _build_pieces(self, tokenizer) -> None:
+        self.pieces = None
+        backend = getattr(tokenizer, 'backend_tokenizer', None)
+        if backend is None:
+            return
+        decoder = json.loads(backend.to_str()).get('decoder') or {}
+        tokens = [tok or '' for tok in tokenizer.convert_ids_to_tokens(list(range(self.vocab_size)))]
+        if decoder.get('type') == 'ByteLevel':
+            byte_values = {c: b for b, c in _byte_chars().items()}
+            # anything that isn't byte-level text (i.e. the added tokens) is its own utf-8
+            self.pieces = [bytes(byte_values[c] for c in tok) if all(c in byte_values for c in tok) else tok.encode('utf-8')
+                           for tok in tokens]
+            self.pieces_are_bytes = True
+        elif decoder.get('type') == 'Metaspace':
+            replacement = decoder.get('replacement', '\u2581')
+            self.pieces = [tok.replace(replacement, ' ') for tok in tokens]
+            self.pieces_are_bytes = False
+            # the space that marks the start of a word isn't output for the first one
+            prepend_scheme = decoder.get('prepend_scheme', 'always' if decoder.get('add_prefix_space', True) else 'never')
+            self.strip_first_space = prepend_scheme != 'never'
+
+    def _join(self, span: list[int], skip_special_tokens: bool) -> str:
+        if skip_special_tokens:
+            span = [i for i in span if not self.special[i]]
+        if self.pieces_are_bytes:
+            return b''.join([self.pieces[i] for i in span]).decode('utf-8', 'replace')
+        text = ''.join([self.pieces[i] for i in span])
+        if self.strip_first_space and text.startswith(' ') and self.pieces[span[0]].startswith(' '):
+            text = text[1:]
+        return text
+
+    def _raw_decode(self, mode: str, tokenizer, spans: list[list[int]], skip_special_tokens: bool) -> list[str]:
+        # what the underlying decoder gives, before any clean up
+        if mode == 'pieces':
+            return [self._join(span, skip_special_tokens) for span in spans]
+        return tokenizer.backend_tokenizer.decode_batch(spans, skip_special_tokens=skip_special_tokens)
+
+    def _check(self, mode: str, tokenizer, probes: list[list[int]]) -> bool:
+        if (mode == 'pieces' and self.pieces is None) or getattr(tokenizer, 'backend_tokenizer', None) is None:
+            return False
+        # whether decode cleans up the spaces depends on the tokenizer (and the transformers version)
+        clean_up = None
+        for skip_special_tokens in [False, True]:
+            expected = [tokenizer.decode(span, skip_special_tokens=skip_special_tokens) for span in probes]
+            decoded = self._raw_decode(mode, tokenizer, probes, skip_special_tokens)
+            matches = [option for option in [False, True] if clean_up in (None, option)
+                       and [_clean_up(text) if option else text for text in decoded] == expected]
+            if not matches:
+                return False
+            clean_up = matches[0]
+        self.clean_up = clean_up
+        return True
+
+    def decode(self, tokenizer, spans: list[list[int]], skip_special_tokens: bool = False) -> list[str]:
+        """
+        parameters:
+            tokenizer: the tokenizer this was built for
+            spans: lists of (non-negative) token ids
+        returns:
+            the decoded spans, meant to be tokenizer.batch_decode(spans, skip_special_tokens=skip_special_tokens).
+            That's only guaranteed for the probe spans the mode was picked with (in __init__); after that, each
+            call only spot checks its first span against tokenizer.decode
+        """
+        if not spans:
+            return []
+        while self.mode != 'tokenizer':
+            try:
+                decoded = self._raw_decode(self.mode, tokenizer, spans, skip_special_tokens)
+            except IndexError:
+                # ids past the end of the table (from a model whose vocabulary is padded out)
+                break
+            if self.clean_up:
+                decoded = [_clean_up(text) for text in decoded]
+            if decoded[0] == tokenizer.decode(spans[0], skip_special_tokens=skip_special_tokens):
+                return decoded
+            # this runs in eval workers and the server's batching thread, so warn (once) and count it rather
+            # than print
+            warnings.warn(f'{self.mode} span decoding disagrees with tokenizer.decode on {spans[0]}; '
+                          f'not using it any more', RuntimeWarning)
+            instrumentation.count('span_decoder/fallback')
+            self.mode = self.MODES[self.MODES.index(self.mode) + 1]
+        return tokenizer.batch_decode(spans, skip_special_tokens=skip_special_tokens)
+
+    def is_blank(self, tokenizer, token_id: int) -> bool:
+        """
+        returns:
+            whether the token is special, or decodes to nothing but whitespace
+        """
+        if token_id >= self.vocab_size:
+            return False
+        if self.special[token_id]:
+            return True
+        if token_id not in self._blank:
+            self._blank[token_id] = not tokenizer.decode([token_id]).strip()
+        return self._blank[token_id]
+
+
+_span_decoders: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+def get_span_decoder(tokenizer) -> SpanDecoder:
+    # like get_decoding_schema, a new one if tokens have been added since
+    decoder = _span_decoders.get(tokenizer)
+    if decoder is None or decoder.vocab_size != len(tokenizer):
+        decoder = _span_decoders[tokenizer] = SpanDecoder(tokenizer)
+    return decoder
@@ -0,0 +1,460 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+import numpy as np
+
+import build
+import instrumentation
+import linearization
+import utils
+import windowing
+from classes import Relation
+from result_cache import ResultCache, cache_key, DEFAULT_MEMORY_ENTRIES, DEFAULT_DISK_MAX_BYTES
+from schema import get_decoding_schema
+
+# Runs a trained checkpoint over new documents, as a local HTTP service:
+#
+#   python server.py outputs/docred/boring_.../checkpoint-1000 --dataset docred --encoding boring --port 8000
+#   curl -d '{"text": "..."}' localhost:8000/extract           -> {"relations": [{"rtype": ..., ...}, ...]}
+#   curl -d '{"texts": ["...", "..."]}' localhost:8000/extract  -> {"relations": [[...], [...]]}
+#   curl localhost:8000/stats
+#
+# The model, tokenizer and decoding tables are loaded once. Every document goes onto one queue, whichever
+# request it came from, and a single worker thread takes them off in batches: as many as are waiting, up to
+# max_batch_size, waiting at most max_wait after the first one for more to show up. So a lone request only
+# ever pays max_wait, and under load the batches fill up straight from the backlog.
+#
+# With a ResultCache (on by default from the command line, see result_cache.py), documents that have been
+# seen before are answered from the cache without going anywhere near the queue.
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT = 0.01
+# how many of the most recent documents the latency percentiles are over
+LATENCY_WINDOW = 1000
+
+
+class ServerStats:
+    """
+    Throughput/latency counters, updated by the batching thread and read by the /stats handler.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.n_docs = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        # time spent actually processing batches, as opposed to waiting for documents
+        self.busy_seconds = 0.0
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def record_batch(self, queued_at: list[float], started_at: float, finished_at: float, failed: bool) -> None:
+        with self.lock:
+            self.n_docs += len(queued_at)
+            self.n_batches += 1
+            self.n_errors += len(queued_at) if failed else 0
+            self.busy_seconds += finished_at - started_at
+            self.latencies.extend(finished_at - t for t in queued_at)
+            self.queue_waits.extend(started_at - t for t in queued_at)
+
+    def snapshot(self, queue_depth: int = 0) -> dict:
+        def percentiles_ms(values) -> dict:
+            if not values:
+                return {}
+            return {f'p{p}': round(float(np.percentile(values, p)) * 1000, 2) for p in [50, 95, 99]}
+        with self.lock:
+            uptime = time.monotonic() - self.start_time
+            return {
+                'uptime_seconds': round(uptime, 1),
+                'docs': self.n_docs,
+                'batches': self.n_batches,
+                'errors': self.n_errors,
+                'queue_depth': queue_depth,
+                'mean_batch_size': round(self.n_docs / self.n_batches, 2) if self.n_batches else 0.0,
+                'docs_per_second': round(self.n_docs / uptime, 2) if uptime > 0 else 0.0,
+                # how fast it goes while it's actually working
+                'busy_docs_per_second': round(self.n_docs / self.busy_seconds, 2) if self.busy_seconds > 0 else 0.0,
+                'latency_ms': percentiles_ms(list(self.latencies)),
+                'queue_wait_ms': percentiles_ms(list(self.queue_waits)),
+            }
+
+
+class DynamicBatcher:
+    """
+    Collects items submitted from any number of threads into batches for process_batch, which is run on
+    one background thread. process_batch takes a list of items and returns a list of results in the same
+    order; if it raises, every item in that batch gets the exception.
+    """
+    _STOP = object()
+
+    def __init__(self, process_batch: Callable[[list], list], max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait: float = DEFAULT_MAX_WAIT):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = ServerStats()
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='DynamicBatcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, item) -> Future:
+        future: Future = Future()
+        self.queue.put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, items: list) -> list:
+        # submits them all before waiting on any, so they can share batches
+        return [future.result() for future in [self.submit(item) for item in items]]
+
+    def _next_batch(self) -> Optional[list]:
+        first = self.queue.get()
+        if first is self._STOP:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                entry = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is self._STOP:
+                # finish this batch first
+                self.queue.put(self._STOP)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            items, futures, queued_at = zip(*batch)
+            started_at = time.monotonic()
+            try:
+                results = self.process_batch(list(items))
+                failed = False
+            except Exception as e:
+                results, failed = [e] * len(items), True
+            self.stats.record_batch(list(queued_at), started_at, time.monotonic(), failed)
+            for future, result in zip(futures, results):
+                if failed:
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats_snapshot(self) -> dict:
+        return self.stats.snapshot(self.queue.qsize())
+
+    def close(self) -> None:
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+
+def weights_fingerprint(checkpoint: Optional[str], model=None) -> Optional[str]:
+    """
+    parameters:
+        checkpoint: where the model came from, a local directory or a hub name
+    returns:
+        for a local directory, a hash of the names, sizes and modification times of the files in it (the
+        weights, config and tokenizer); otherwise the hub revision the model was downloaded at, if known
+    """
+    if checkpoint and os.path.isdir(checkpoint):
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(checkpoint)):
+            path = os.path.join(checkpoint, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                h.update(f'{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode('utf-8'))
+        return h.hexdigest()
+    return getattr(getattr(model, 'config', None), '_commit_hash', None)
+
+
+class RelationExtractor:
+    """
+    A model and everything needed to turn its outputs back into relations.
+    """
+    def __init__(self, model, tokenizer, dataset: str, encoding: str, max_input_length: int, max_length: int,
+                 constrained: bool = False, checkpoint: str = None, windowed: bool = False, word_tokenizer=None):
+        """
+        parameters:
+            max_input_length: documents get truncated to this many tokens
+            max_length: max generation length
+            constrained: only generate targets that parse (see constraints.py)
+            checkpoint: where the model came from (only used to tell cached results apart, along with a
+                fingerprint of its files, see weights_fingerprint)
+            windowed: extract from documents longer than max_input_length a window at a time (see windowing.py),
+                rather than truncating them
+            word_tokenizer: what to tokenize the words with, for datasets the model was trained on the words of
+                (see utils.load_word_tokenizer); the tokenizer itself if not given
+        """
+        self.model = model
+        self.checkpoint = checkpoint or getattr(model, 'name_or_path', None)
+        # so that retraining into the same directory doesn't serve the old model's cached results
+        self.weights = weights_fingerprint(self.checkpoint, model)
+        self.tokenizer = tokenizer
+        self.word_tokenizer = word_tokenizer or tokenizer
+        # train.py tokenizes these datasets' words (is_split_into_words) rather than their text, so the texts
+        # here get split on whitespace and tokenized the same way
+        self.split_into_words = build.DATASETS[dataset].get('split_into_words', False)
+        self.dataset = dataset
+        self.encoding = encoding
+        self.max_input_length = max_input_length
+        self.gen_kwargs = {'max_length': max_length}
+        self.constrained = constrained
+        self.windowed = windowed
+        if constrained:
+            import constraints
+            self.gen_kwargs['logits_processor'] = constraints.grammar_logits_processor(tokenizer, dataset, encoding)
+        # build the decoding tables now, rather than on the first request
+        get_decoding_schema(dataset, encoding, tokenizer)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: str, dataset: str, encoding: str, device: str = None,
+                        constrained: bool = False, windowed: bool = False) -> 'RelationExtractor':
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+        data_dir = f'data/{dataset}/{encoding}'
+        # the same tokenizer train.py used; if the checkpoint saved it, the tokens are already there
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        new_tokens = json.load(open(f'{data_dir}/tokens.json', 'r'))
+        tokenizer.add_tokens(new_tokens)
+        word_tokenizer = None
+        if build.DATASETS[dataset].get('split_into_words', False):
+            word_tokenizer = utils.load_word_tokenizer(tokenizer, checkpoint, new_tokens)
+        model = AutoModelForSeq2SeqLM.from_pretrained(checkpoint)
+        if model.get_input_embeddings().num_embeddings < len(tokenizer):
+            model.resize_token_embeddings(len(tokenizer))
+        device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        model = model.to(device).eval()
+        config = json.load(open(f'{data_dir}/config.json', 'r'))
+        return cls(model, tokenizer, dataset, encoding,
+                   max_input_length=min(config['input_ids_max_len'], tokenizer.model_max_length),
+                   max_length=min(config['labels_max_len'], tokenizer.model_max_length),
+                   constrained=constrained, checkpoint=os.path.abspath(checkpoint), windowed=windowed,
+                   word_tokenizer=word_tokenizer)
+
+    def cache_settings(self) -> dict:
+        """
+        returns:
+            everything besides the text that decides what extract_batch returns (for result_cache.cache_key)
+        """
+        return {'checkpoint': self.checkpoint, 'weights': self.weights, 'dataset': self.dataset, 'encoding': self.encoding,
+                'max_input_length': self.max_input_length, 'max_length': self.gen_kwargs['max_length'],
+                'constrained': self.constrained, 'windowed': self.windowed}
+
+    def _generate(self, texts: list[str]) -> list[list[Relation]]:
+        import torch
+        with instrumentation.stage('tokenize'):
+            if self.split_into_words:
+                inputs = self.word_tokenizer([text.split() for text in texts], is_split_into_words=True,
+                                             max_length=self.max_input_length, truncation=True, padding=True,
+                                             return_tensors='pt')
+            else:
+                inputs = self.tokenizer(texts, max_length=self.max_input_length, truncation=True, padding=True,
+                                        return_tensors='pt')
+            inputs = inputs.to(self.model.device)
+        with instrumentation.stage('generate'), torch.no_grad():
+            outputs = self.model.generate(**inputs, **self.gen_kwargs).cpu().numpy()
+        return linearization.delinearize_batch(outputs, self.tokenizer, self.dataset, self.encoding)
+
+    def extract_batch(self, texts: list[str]) -> list[list[dict]]:
+        """
+        returns:
+            each text's relations, as Relation.to_dict()s
+        """
+        # the same document twice in one batch only gets generated once
+        unique_texts = list(dict.fromkeys(texts))
+        if self.windowed:
+            # the windows of all of the documents go through in batches as big as this one
+            relations = windowing.extract_windowed(unique_texts, self.tokenizer, self.max_input_length, self._generate,
+                                                   batch_size=len(unique_texts))
+        else:
+            relations = self._generate(unique_texts)
+        results = {text: [rel.to_dict() for rel in rels] for text, rels in zip(unique_texts, relations)}
+        return [results[text] for text in texts]
+
+
+def _extract(server, texts: list[str]) -> list[list[dict]]:
+    # cached results where there are any, and everything else through the batcher (and into the cache)
+    if server.cache is None:
+        return server.batcher(texts)
+    keys = [cache_key(text, server.cache_settings) for text in texts]
+    results = [server.cache.get(key) for key in keys]
+    # one text per key that isn't cached, so a document repeated within the request is only generated once
+    misses = {key: text for key, text, result in zip(keys, texts, results) if result is None}
+    if misses:
+        for key, result in zip(misses, server.batcher(list(misses.values()))):
+            server.cache.put(key, result)
+            misses[key] = result
+        results = [misses[key] if result is None else result for key, result in zip(keys, results)]
+    return results
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # self.server.batcher is the DynamicBatcher, self.server.cache the ResultCache (or None)
+    def _reply(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == '/stats':
+            stats = self.server.batcher.stats_snapshot()
+            if self.server.cache is not None:
+                stats['cache'] = self.server.cache.stats()
+            if instrumentation.enabled():
+                # stage times and dropped relations since the server started (see instrumentation.py)
+                stats['profile'] = instrumentation.snapshot()
+            self._reply(200, stats)
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': f'no such endpoint {self.path}'})
+
+    def do_POST(self) -> None:
+        if self.path != '/extract':
+            self._reply(404, {'error': f'no such endpoint {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            texts = [request['text']] if 'text' in request else request['texts']
+            if not all(isinstance(text, str) for text in texts):
+                raise ValueError('texts have to be strings')
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f'expected {{"text": "..."}} or {{"texts": [...]}} ({e})'})
+            return
+        try:
+            results = _extract(self.server, texts)
+        except Exception as e:
+            self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self._reply(200, {'relations': results[0] if 'text' in request else results})
+
+    def log_message(self, format, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(extractor: RelationExtractor, host: str = 'localhost', port: int = 8000,
+          max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_wait: float = DEFAULT_MAX_WAIT,
+          cache: Optional[ResultCache] = None, verbose: bool = False) -> ThreadingHTTPServer:
+    """
+    parameters:
+        cache: where to look up documents before generating anything for them
+    returns:
+        the server (not started; call serve_forever()), with its DynamicBatcher as .batcher
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.batcher = DynamicBatcher(extractor.extract_batch, max_batch_size, max_wait)
+    server.cache = cache
+    server.cache_settings = extractor.cache_settings() if cache is not None else None
+    server.verbose = verbose
+    return server
+
+
+# A tiny, randomly initialised T5 with a tokenizer trained on the eval texts, so the server can be tested
+# without downloading anything. Its outputs are garbage, but garbage in the right format
+def make_tiny_checkpoint(output_dir: str, dataset: str, encoding: str, vocab_size: int = 2000) -> str:
+    import torch
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders, processors
+    from transformers import PreTrainedTokenizerFast, T5Config, T5ForConditionalGeneration
+    texts = [record['text'] for record in utils.iter_json_array(f'data/{dataset}/boring/eval.json')]
+    backend = Tokenizer(models.Unigram())
+    backend.pre_tokenizer = pre_tokenizers.Metaspace()
+    backend.decoder = decoders.Metaspace()
+    backend.train_from_iterator(texts, trainers.UnigramTrainer(vocab_size=vocab_size, unk_token='<unk>',
+                                                               special_tokens=['<pad>', '</s>', '<unk>']))
+    backend.post_processor = processors.TemplateProcessing(single='$A </s>', special_tokens=[('</s>', 1)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token='</s>', pad_token='<pad>',
+                                        unk_token='<unk>', model_max_length=512)
+    tokenizer.add_tokens(json.load(open(f'data/{dataset}/{encoding}/tokens.json', 'r')))
+    torch.manual_seed(0)
+    config = T5Config(vocab_size=len(tokenizer), d_model=32, d_kv=8, d_ff=64, num_layers=1, num_heads=2,
+                      decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    T5ForConditionalGeneration(config).save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+
+def test_server(dataset: str = 'docred', encoding: str = 'boring', n_requests: int = 24):
+    import tempfile
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        extractor = RelationExtractor.from_checkpoint(make_tiny_checkpoint(tmp_dir, dataset, encoding),
+                                                      dataset, encoding, device='cpu', constrained=True)
+        records = zip(utils.iter_json_array(f'data/{dataset}/boring/eval.json'), range(n_requests))
+        texts = [record['text'] for record, _ in records]
+        expected = [extractor.extract_batch([text])[0] for text in texts]
+
+        server = serve(extractor, port=0, max_batch_size=8, max_wait=0.05, cache=ResultCache())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://localhost:{server.server_address[1]}'
+        def post(text):
+            request = urllib.request.Request(f'{url}/extract', data=json.dumps({'text': text}).encode('utf-8'))
+            return json.loads(urllib.request.urlopen(request).read())['relations']
+        try:
+            # all at once, so they get batched together
+            with ThreadPoolExecutor(n_requests) as pool:
+                results = list(pool.map(post, texts))
+            # the second time around, they all come out of the cache
+            assert list(pool.map(post, texts)) == results
+            stats = json.loads(urllib.request.urlopen(f'{url}/stats').read())
+        finally:
+            server.shutdown()
+            server.batcher.close()
+        print(stats)
+        assert results == expected
+        assert stats['docs'] == n_requests and stats['batches'] < n_requests
+        assert stats['cache']['memory_hits'] == n_requests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a trained checkpoint over HTTP')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--encoding', required=True)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT * 1000)
+    parser.add_argument('--constrained', action='store_true', help='grammar-constrained generation')
+    parser.add_argument('--windowed', action='store_true', help='extract from long documents a window at a time')
+    parser.add_argument('--cache-entries', type=int, default=DEFAULT_MEMORY_ENTRIES,
+                        help='how many results to cache in memory (0 to turn caching off)')
+    parser.add_argument('--cache-path', help='an sqlite file to also cache results in, across restarts')
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_DISK_MAX_BYTES / 2**20)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--profile', action='store_true', help='time the stages and count dropped relations in /stats')
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable()
+    extractor = RelationExtractor.from_checkpoint(args.checkpoint, args.dataset, args.encoding, args.device,
+                                                  args.constrained, args.windowed)
+    cache = (ResultCache(args.cache_entries, args.cache_path, int(args.cache_max_mb * 2**20))
+             if args.cache_entries > 0 else None)
+    server = serve(extractor, args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000, cache, args.verbose)
+    print(f'serving {args.checkpoint} ({args.dataset}/{args.encoding}) on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    finally:
+        server.batcher.close()
+        if cache is not None:
+            cache.close()
@@ -0,0 +1,173 @@
+import queue
+from typing import Callable, Iterable, Optional, Union
+
+import numpy as np
+
+import instrumentation
+from classes import Relation
+from linearization import _decode_vertex_list, _segment_markers, _relation_from_markers
+from schema import get_decoding_schema
+
+# Delinearizing while the target is still being generated. A relation's last span only ends where the
+# next <rel> starts (or the sequence does), so that's when StreamingDelinearizer emits it: the time to the
+# first relation is however long it takes to generate one relation, not the whole target.
+#
+#   parser = StreamingDelinearizer(tokenizer, 'docred', 'boring')
+#   for token in generated_tokens:
+#       for relation in parser.feed(token):
+#           ...
+#   parser.finish()
+#
+# Each segment goes through the same checks and span decoding as delinearize_batch, so once it's finished,
+# parser.relations is exactly what delinearize_batch returns for the same tokens, in the same order. Like
+# delinearize_batch, it doesn't treat </s> specially (it's part of the last span), so the last relation
+# comes out of finish(); RelationStreamer, which hooks all of this up to model.generate, calls that as
+# soon as generation stops.
+
+
+class StreamingDelinearizer:
+    """
+    Incremental delinearizer for one generated sequence (without its decoder start token).
+    """
+    def __init__(self, tokenizer, dataset: str, encoding: str, stage: str = 'stream'):
+        """
+        parameters:
+            stage: what to count the relations (and dropped ones) under (see instrumentation.py)
+        """
+        self.tokenizer = tokenizer
+        self.stage = stage
+        self.schema = get_decoding_schema(dataset, encoding, tokenizer)
+        # the tokens since the last <rel> (including it)
+        self.segment: list[int] = []
+        self.vertices: list[Optional[str]] = []
+        # in vertex_ref encodings, the first non-empty segment is the vertex list
+        self.have_vertices = not self.schema.has_vertices
+        # dict as an insertion-ordered set
+        self._relations: dict[Relation, None] = {}
+        self.finished = False
+
+    @property
+    def relations(self) -> list[Relation]:
+        return list(self._relations)
+
+    def _close_segment(self) -> list[Relation]:
+        segment, self.segment = self.segment, []
+        content = np.array(segment[1:] if segment and segment[0] == self.schema.rel_token else segment, dtype=np.int64)
+        if not self.have_vertices:
+            if len(content):
+                self.vertices = _decode_vertex_list(content, self.schema, self.tokenizer)
+                self.have_vertices = True
+                if instrumentation.enabled():
+                    n_good = sum(vertex is not None for vertex in self.vertices)
+                    n_vertices = int(np.count_nonzero(content == self.schema.vertex_token))
+                    instrumentation.count_all({f'{self.stage}/bad_vertices': n_vertices - n_good})
+            return []
+        # (like delinearize_batch, only what comes after a <rel> counts as a relation that got dropped)
+        is_relation = bool(segment) and segment[0] == self.schema.rel_token
+        markers = _segment_markers(content, self.schema, self.stage if is_relation else None)
+        if markers is None:
+            return []
+        rtype_idx, marker_idxs = markers
+        relation = _relation_from_markers(content, rtype_idx, marker_idxs, len(content), self.schema,
+                                          self.tokenizer, self.vertices)
+        if relation is None:
+            instrumentation.count(f'{self.stage}/dropped/bad_vertex')
+            return []
+        if relation in self._relations:
+            instrumentation.count(f'{self.stage}/dropped/duplicate')
+            return []
+        instrumentation.count(f'{self.stage}/relations')
+        self._relations[relation] = None
+        return [relation]
+
+    def feed(self, token_ids: Union[int, Iterable[int]]) -> list[Relation]:
+        """
+        parameters:
+            token_ids: the next token, or the next chunk of them
+        returns:
+            the relations completed by these tokens (not counting ones that were already emitted)
+        """
+        if self.finished:
+            return []
+        if isinstance(token_ids, (int, np.integer)):
+            token_ids = [token_ids]
+        new_relations = []
+        for token in token_ids:
+            token = int(token)
+            if token == self.schema.rel_token and self.segment:
+                new_relations += self._close_segment()
+            self.segment.append(token)
+        return new_relations
+
+    def finish(self) -> list[Relation]:
+        """
+        Ends the sequence.
+        returns:
+            the last relation, if it's complete
+        """
+        if self.finished:
+            return []
+        self.finished = True
+        instrumentation.count(f'{self.stage}/sequences')
+        return self._close_segment() if self.segment else []
+
+
+class RelationStreamer:
+    """
+    A streamer for model.generate(..., streamer=...) that delinearizes as the tokens come in. Like the
+    transformers streamers, it only works with a batch size of 1. The relations are passed to on_relation
+    as they're completed, and can also be iterated over from another thread:
+
+        streamer = RelationStreamer(tokenizer, 'docred', 'boring')
+        threading.Thread(target=model.generate, kwargs={**inputs, 'streamer': streamer}).start()
+        for relation in streamer:
+            ...
+    """
+    _STOP = object()
+
+    def __init__(self, tokenizer, dataset: str, encoding: str,
+                 on_relation: Optional[Callable[[Relation], None]] = None, timeout: Optional[float] = None):
+        """
+        parameters:
+            on_relation: called with each relation as soon as it's complete
+            timeout: how long iterating waits for the next relation before raising queue.Empty
+        """
+        self.parser = StreamingDelinearizer(tokenizer, dataset, encoding)
+        self.on_relation = on_relation
+        self.timeout = timeout
+        self.queue: queue.Queue = queue.Queue()
+        # the first thing generate() puts is the decoder start token, which isn't part of the target
+        self.next_tokens_are_prompt = True
+
+    def _emit(self, relations: list[Relation]) -> None:
+        for relation in relations:
+            if self.on_relation is not None:
+                self.on_relation(relation)
+            self.queue.put(relation)
+
+    def put(self, value) -> None:
+        # (1, n) for the prompt, (1,) for each new token
+        token_ids = np.asarray(value.cpu() if hasattr(value, 'cpu') else value)
+        if token_ids.ndim > 1 and token_ids.shape[0] > 1:
+            raise ValueError('RelationStreamer only supports a batch size of 1')
+        elif token_ids.ndim > 1:
+            token_ids = token_ids[0]
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        self._emit(self.parser.feed(token_ids.reshape(-1).tolist()))
+
+    def end(self) -> None:
+        self._emit(self.parser.finish())
+        self.queue.put(self._STOP)
+
+    @property
+    def relations(self) -> list[Relation]:
+        return self.parser.relations
+
+    def __iter__(self):
+        while True:
+            relation = self.queue.get(timeout=self.timeout)
+            if relation is self._STOP:
+                return
+            yield relation
@@ -0,0 +1,208 @@
+import re
+import warnings
+from typing import Optional
+
+import instrumentation
+from classes import Article
+from linearization import target_pieces
+
+# Tokenizing linearized targets without (mostly) going through the tokenizer. A target is mostly added
+# tokens (<rel>, <P17>, <h>, ...), with short runs of text between them, and the same runs (entity names,
+# mostly) come up over and over. Passing the whole string to the tokenizer means it has to find every added
+# token in it again, which is the slowest part of HF tokenization, and tokenize every name every time.
+# TargetEncoder looks the added tokens' ids up, and tokenizes each distinct run of text just once:
+#
+#   encoder = TargetEncoder(tokenizer, 'boring')
+#   labels = encoder.encode(targets, max_length=512, truncation=True)   # == tokenizer(targets, ...)['input_ids']
+#   labels = encoder.encode_articles(articles)                          # straight from the Relations
+#
+# That's what the tokenizer does itself (it splits the text at the added tokens and tokenizes what's in
+# between on its own), but only as long as nothing fancier is going on, so the first CHECK_SIZE targets are
+# also run through the tokenizer, and so is the first target of every call after that. If they ever
+# disagree, the encoder goes back to the tokenizer for good (with a RuntimeWarning, and counted as
+# target_encoder/fallback, see instrumentation.py).
+
+CHECK_SIZE = 200
+# what added tokens usually look like
+_BRACKETED = re.compile('<[^<>]*>')
+# about how many distinct runs of text to keep the ids of (after that, the cache starts over)
+MAX_CACHED_SEGMENTS = 1_000_000
+
+
+class TargetEncoder:
+    def __init__(self, tokenizer, encoding: str):
+        """
+        parameters:
+            tokenizer: with the encoding's tokens (tokens.json) already added
+            encoding: name of the linearization scheme, e.g. 'boring' or 'vertex_ref_evidence'
+        """
+        self.tokenizer = tokenizer
+        self.encoding = encoding
+        # the text between added tokens is tokenized on its own, by the Rust tokenizer if there is one. This
+        # has its own copy, since the tokenizer leaves its truncation and padding settings on it between calls
+        self.backend = None
+        if getattr(tokenizer, 'backend_tokenizer', None) is not None:
+            self.backend = type(tokenizer.backend_tokenizer).from_str(tokenizer.backend_tokenizer.to_str())
+            self.backend.no_truncation()
+            self.backend.no_padding()
+        added_vocab = tokenizer.get_added_vocab()
+        # (depending on the transformers version, the python side might only know about the special ones)
+        added_tokens = self.backend.get_added_tokens_decoder() if self.backend is not None else tokenizer.added_tokens_decoder
+        # every added token (special ones included) splits the text. Some of them also take the whitespace on
+        # either side (lstrip/rstrip), which is easy enough to do here, but ones that only match whole words
+        # are left to the tokenizer
+        self.tokens: dict[str, tuple[int, bool, bool]] = {}
+        for token_id, token in added_tokens.items():
+            if not token.single_word:
+                self.tokens[token.content] = (token_id, token.lstrip, token.rstrip)
+        self.added = set(added_vocab) | {token.content for token in added_tokens.values()}
+        # python's re is slow with hundreds of alternatives, so if they're all <something> (as all of ours are),
+        # split at anything that looks like that, and put back whatever isn't actually a token. Otherwise,
+        # longest first, so that the regex matches the longest token at each position, like the tokenizer does
+        self.bracketed = all(_BRACKETED.fullmatch(token) for token in self.added)
+        if self.bracketed:
+            self.splitter = re.compile(f'({_BRACKETED.pattern})')
+        else:
+            self.splitter = re.compile('(' + '|'.join(map(re.escape, sorted(self.added, key=len, reverse=True))) + ')')
+        self.segments: dict[str, list[int]] = {}
+        # the special tokens the tokenizer puts around every sequence
+        rel_id = added_vocab['<rel>']
+        ids = tokenizer('<rel>')['input_ids']
+        self.prefix = ids[:ids.index(rel_id)]
+        self.suffix = ids[ids.index(rel_id) + 1:]
+        self.direct = True
+        self.n_checked = 0
+
+    def _tokenize_segments(self, texts: list[str]) -> None:
+        # the ones that aren't cached yet, all at once
+        if len(self.segments) > MAX_CACHED_SEGMENTS:
+            self.segments.clear()
+        texts = [text for text in dict.fromkeys(texts) if text not in self.segments]
+        if not texts:
+            return
+        if self.backend is not None:
+            all_ids = [encoding.ids for encoding in self.backend.encode_batch(texts, add_special_tokens=False)]
+        else:
+            all_ids = self.tokenizer(texts, add_special_tokens=False)['input_ids']
+        self.segments.update(zip(texts, all_ids))
+
+    def _split(self, pieces: list[str]) -> Optional[tuple[list[str], list[str]]]:
+        """
+        parameters:
+            pieces: strings whose concatenation is the target
+        returns:
+            the added tokens in the target, and the texts before, between and after them (the way the tokenizer
+            splits it), or None if it needs the tokenizer
+        """
+        parts = ['']
+        for piece in pieces:
+            if piece in self.tokens:
+                parts += [piece, '']
+            else:
+                # the text can still have added tokens in it (entity names that look like one, say)
+                split = self.splitter.split(piece)
+                parts[-1] += split[0]
+                parts += split[1:]
+        texts, names = parts[::2], parts[1::2]
+        if self.bracketed and not all(map(self.added.__contains__, names)):
+            texts, names = self._rejoin(texts, names)
+        tokens = self.tokens
+        for i, name in enumerate(names):
+            token = tokens.get(name)
+            if token is None:
+                return None
+            if token[1] and texts[i]:
+                texts[i] = texts[i].rstrip()
+            if token[2] and texts[i + 1]:
+                texts[i + 1] = texts[i + 1].lstrip()
+        return texts, names
+
+    def _rejoin(self, texts: list[str], names: list[str]) -> tuple[list[str], list[str]]:
+        # put the things that only look like added tokens back into the text around them
+        new_texts, new_names = [texts[0]], []
+        for name, text in zip(names, texts[1:]):
+            if name in self.added:
+                new_names.append(name)
+                new_texts.append(text)
+            else:
+                new_texts[-1] += name + text
+        return new_texts, new_names
+
+    def _content_ids(self, texts: list[str], names: list[str]) -> list[int]:
+        # the target's token ids, without the special tokens around it
+        ids = []
+        segments, tokens = self.segments, self.tokens
+        for text, name in zip(texts, names):
+            if text:
+                ids += segments[text]
+            ids.append(tokens[name][0])
+        if texts[-1]:
+            ids += segments[texts[-1]]
+        return ids
+
+    def _finish(self, content: list[int], max_length: Optional[int], truncation: bool,
+                add_special_tokens: bool) -> Optional[list[int]]:
+        # add the special tokens, truncating the content first so that it all fits
+        prefix, suffix = (self.prefix, self.suffix) if add_special_tokens else ([], [])
+        if truncation and max_length is not None:
+            n_content = max_length - len(prefix) - len(suffix)
+            if n_content <= 0:
+                return None
+            if len(content) > n_content:
+                content = content[-n_content:] if self.tokenizer.truncation_side == 'left' else content[:n_content]
+        return prefix + content + suffix
+
+    def _encode(self, pieces: list[list[str]], targets: Optional[list[str]], max_length: Optional[int],
+                truncation: bool, add_special_tokens: bool) -> list[list[int]]:
+        """
+        parameters:
+            pieces: for each target, strings whose concatenation is the target
+            targets: the targets, if they've already been put together
+        """
+        def target(i: int) -> str:
+            return targets[i] if targets is not None else ''.join(pieces[i])
+        def tokenize(idxs) -> list[list[int]]:
+            return self.tokenizer([target(i) for i in idxs], max_length=max_length, truncation=truncation,
+                                  add_special_tokens=add_special_tokens)['input_ids']
+
+        if not self.direct:
+            return tokenize(range(len(pieces)))
+        splits = list(map(self._split, pieces))
+        self._tokenize_segments([text for split in splits if split is not None for text in split[0] if text])
+        labels = [self._finish(self._content_ids(*split), max_length, truncation, add_special_tokens)
+                  if split is not None else None for split in splits]
+        # whatever can't be done directly goes through the tokenizer
+        todo = [i for i, ids in enumerate(labels) if ids is None]
+        for i, ids in zip(todo, tokenize(todo) if todo else []):
+            labels[i] = ids
+        # and some of the rest are checked
+        check_idxs = range(min(max(CHECK_SIZE - self.n_checked, 1), len(pieces)))
+        self.n_checked += len(check_idxs)
+        for i, expected in zip(check_idxs, tokenize(check_idxs) if check_idxs else []):
+            if labels[i] != expected:
+                warnings.warn(f'TargetEncoder disagrees with the tokenizer on {target(i)!r}; '
+                              f'using the tokenizer from now on', RuntimeWarning)
+                instrumentation.count('target_encoder/fallback')
+                self.direct = False
+                return tokenize(range(len(pieces)))
+        return labels
+
+    def encode(self, targets: list[str], max_length: Optional[int] = None, truncation: bool = False,
+               add_special_tokens: bool = True) -> list[list[int]]:
+        """
+        parameters:
+            targets: linearized targets (as from linearization.LINEARIZERS[encoding])
+        returns:
+            tokenizer(targets, max_length=..., truncation=..., add_special_tokens=...)['input_ids']
+        """
+        return self._encode([[target] for target in targets], targets, max_length, truncation, add_special_tokens)
+
+    def encode_articles(self, articles: list[Article], max_length: Optional[int] = None, truncation: bool = False,
+                        add_special_tokens: bool = True) -> list[list[int]]:
+        """
+        returns:
+            the token ids of the articles' targets, the same as encode(LINEARIZERS[encoding](articles, ...)),
+            but without putting the strings together first
+        """
+        pieces = [target_pieces(article, self.encoding) for article in articles]
+        return self._encode(pieces, None, max_length, truncation, add_special_tokens)
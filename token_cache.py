@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import utils
+
+# On-disk cache of tokenized train/eval splits, so that re-running train.py with the same checkpoint,
+# encoding and data (e.g. in a hyperparameter sweep) doesn't re-tokenize everything.
+#
+# Entries are content addressed: the key hashes the tokenizer (its vocab, added tokens and
+# config), the split names and contents of the data files (not their paths) and the max lengths. Each entry is a directory holding
+# one flat int32 array of token ids and one int64 offset array per split/column, which are
+# memory-mapped when loaded.
+
+CACHE_DIR = 'cache/tokenized'
+# bump this if the way examples are tokenized changes
+CACHE_VERSION = 1
+# least recently used entries are dropped once the cache gets bigger than this
+MAX_CACHE_BYTES = 5 * 1024**3
+
+COLUMNS = ['input_ids', 'labels']
+
+
+def _sha256(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_hash(fname: str) -> str:
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    added_vocab = json.dumps(sorted(tokenizer.get_added_vocab().items()))
+    if getattr(tokenizer, 'is_fast', False):
+        # the serialized backend covers the vocab, merges, normalizer, added tokens, ... but also
+        # the truncation/padding settings of whatever the last call was, which don't matter here
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop('truncation', None)
+        backend.pop('padding', None)
+        backend = json.dumps(backend, sort_keys=True)
+    else:
+        backend = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return _sha256(type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer),
+                   _sha256(added_vocab), _sha256(backend))
+
+
+class TokenizedSplit:
+    """
+    One cached split, as a sequence of {'input_ids', 'attention_mask', 'labels'} examples that the
+    Trainer/DataCollatorForSeq2Seq can use directly.
+    """
+    def __init__(self, entry_dir: str, split: str):
+        self.split = split
+        self._arrays = {}
+        for column in COLUMNS:
+            self._arrays[column] = (np.load(f'{entry_dir}/{split}.{column}.ids.npy', mmap_mode='r'),
+                                    np.load(f'{entry_dir}/{split}.{column}.offsets.npy', mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return len(self._arrays['input_ids'][1]) - 1
+
+    def __getitem__(self, i: int) -> dict:
+        if not 0 <= i < len(self):
+            raise IndexError('split index out of range')
+        example = {}
+        for column, (ids, offsets) in self._arrays.items():
+            example[column] = ids[offsets[i]:offsets[i + 1]].tolist()
+        # nothing is padded at this point, so the mask is all ones
+        example['attention_mask'] = [1] * len(example['input_ids'])
+        return example
+
+    def lengths(self, column: str = 'input_ids') -> np.ndarray:
+        return np.diff(self._arrays[column][1])
+
+
+def _write_entry(entry_dir: str, tokenized_dataset, meta: dict) -> None:
+    # build the entry next to where it's going and rename it into place, so a crash part way
+    # through never leaves a half-written entry behind
+    tmp_dir = f'{entry_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for split in meta['data_files']:
+        for column in COLUMNS:
+            seqs = tokenized_dataset[split][column]
+            offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+            np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+            ids = np.fromiter((i for seq in seqs for i in seq), dtype=np.int32, count=int(offsets[-1]))
+            np.save(f'{tmp_dir}/{split}.{column}.ids.npy', ids)
+            np.save(f'{tmp_dir}/{split}.{column}.offsets.npy', offsets)
+    json.dump(meta, open(f'{tmp_dir}/meta.json', 'w'), indent=2)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # somebody else finished the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _entry_bytes(entry_dir: str) -> int:
+    return sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+
+
+def evict(cache_dir: str, keep: str, max_bytes: int = MAX_CACHE_BYTES) -> None:
+    """
+    Removes entries that can never be hit again (same tokenizer, data files and lengths as the entry
+    being kept, but older file contents), then least recently used entries until the cache fits.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        meta_fname = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_fname):
+            continue
+        entries.append((name, entry_dir, json.load(open(meta_fname))))
+    slots = {name: meta['slot'] for name, _, meta in entries}
+    remaining = []
+    for name, entry_dir, meta in entries:
+        if name != keep and meta['slot'] == slots.get(keep):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        else:
+            remaining.append((os.path.getmtime(os.path.join(entry_dir, 'meta.json')), name, entry_dir))
+    total = sum(_entry_bytes(entry_dir) for _, _, entry_dir in remaining)
+    for _, name, entry_dir in sorted(remaining):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        total -= _entry_bytes(entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+
+def _tokenize(articles, preprocess_fn, batch_size: int = 1000) -> dict[str, list]:
+    # what dataset.map(preprocess_fn, batched=True) would come up with for the articles' data records
+    columns = {column: [] for column in COLUMNS}
+    for docs in utils.chunked(articles, batch_size):
+        examples = {'text': [doc.text for doc in docs], 'target': [doc.target for doc in docs]}
+        if all(doc.words is not None for doc in docs):
+            examples['words'] = [doc.words for doc in docs]
+        outputs = preprocess_fn(examples)
+        for column in COLUMNS:
+            columns[column].extend(outputs[column])
+    return columns
+
+
+def get_tokenized(tokenizer, data_files: dict[str, str], dataset, preprocess_fn,
+                  max_lengths: dict, cache_dir: str = CACHE_DIR) -> dict[str, TokenizedSplit]:
+    """
+    parameters:
+        tokenizer: the tokenizer, with any new tokens already added
+        data_files: split name -> the file that split's articles were read from (e.g. a {split}.corpus)
+        dataset: split name -> the split's articles, with their targets (only tokenized on a cache miss)
+        preprocess_fn: batched tokenization function, from the columns of the articles' data records ('text',
+            'target', and 'words' if they have them) to input_ids and labels
+        max_lengths: the truncation lengths preprocess_fn uses
+    returns:
+        split name -> TokenizedSplit
+    """
+    tok_fp = tokenizer_fingerprint(tokenizer)
+    lengths = json.dumps(max_lengths, sort_keys=True)
+    # the key only goes by what's in the files, not where they are (the windowed/evidence inputs get written
+    # under each run's own timestamped output directory, so their paths never repeat)
+    contents = [(split, file_hash(fname)) for split, fname in sorted(data_files.items())]
+    key = _sha256(CACHE_VERSION, tok_fp, lengths, json.dumps(contents))
+    # the same but with the paths instead; a new entry in the same slot makes the old one stale
+    slot = _sha256(CACHE_VERSION, tok_fp, lengths, json.dumps(data_files, sort_keys=True))
+    entry_dir = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(entry_dir, 'meta.json')):
+        print(f'Using cached tokenization {entry_dir}')
+        # bump the mtime for LRU eviction
+        os.utime(os.path.join(entry_dir, 'meta.json'))
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        tokenized_dataset = {split: _tokenize(dataset[split], preprocess_fn) for split in data_files}
+        meta = {
+            'slot': slot,
+            'tokenizer': tokenizer.name_or_path,
+            'data_files': data_files,
+            'max_lengths': max_lengths,
+            'created': time.time(),
+        }
+        _write_entry(entry_dir, tokenized_dataset, meta)
+    evict(cache_dir, keep=key)
+    return {split: TokenizedSplit(entry_dir, split) for split in data_files}
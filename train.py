@@ -1,20 +1,80 @@
-from datasets import load_dataset, Dataset, DatasetDict
-from transformers import Seq2SeqTrainer, Seq2SeqTrainingArguments
-from transformers import DataCollatorForSeq2Seq
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
-from torch.utils.data import DataLoader
 import pathlib
 import json
 import pdb
 import datetime
 import evaluate
+import instrumentation
 import linearization
-from typing import cast
+import utils
+import archive
+import token_cache
+import constraints
+import batching
+import build
+import windowing
+from schema import get_decoding_schema
+from target_encoder import TargetEncoder
+
+# transformers and torch take seconds to import, so they're only imported once training actually
+# starts (in run_training_loop), not by everything that imports this module
+
+
+_RELATION_TRAINER = None
+def relation_trainer_class():
+	# the Seq2SeqTrainer subclass below, defined the first time it's needed so that transformers isn't
+	# imported until then
+	global _RELATION_TRAINER
+	if _RELATION_TRAINER is not None:
+		return _RELATION_TRAINER
+	from transformers import Seq2SeqTrainer
+	from transformers.trainer_pt_utils import LengthGroupedSampler
+
+	class RelationTrainer(Seq2SeqTrainer):
+		# a Seq2SeqTrainer that can
+		#   - pass extra logits processors (i.e. the grammar constraints) to generate()
+		#   - batch the training data by length (train_lengths), and run eval in a fixed order (eval_order)
+		#   - cap each eval batch's generation length by its input length (length_envelope, see batching.py)
+		def __init__(self, *args, logits_processor=None, train_lengths=None, eval_order=None, length_envelope=None, **kwargs):
+			super().__init__(*args, **kwargs)
+			self.logits_processor = logits_processor
+			self.train_lengths = train_lengths
+			self.eval_order = eval_order
+			self.length_envelope = length_envelope
+
+		def _get_train_sampler(self, *args, **kwargs):
+			if self.train_lengths is None:
+				return super()._get_train_sampler(*args, **kwargs)
+			return LengthGroupedSampler(self.args.train_batch_size * self.args.gradient_accumulation_steps,
+			                            lengths=self.train_lengths.tolist())
+
+		def _get_eval_sampler(self, eval_dataset):
+			if self.eval_order is None:
+				return super()._get_eval_sampler(eval_dataset)
+			return self.eval_order.tolist()
+
+		def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs):
+			# the trainer only falls back on its own generation kwargs (max_length etc.) when none are passed
+			gen_kwargs = {**getattr(self, '_gen_kwargs', {}), **gen_kwargs}
+			if self.logits_processor is not None:
+				gen_kwargs.setdefault('logits_processor', self.logits_processor)
+			if self.length_envelope is not None:
+				# the collator pads to the longest input in the batch; +1 for the decoder start token
+				gen_kwargs['max_length'] = self.length_envelope.limit(inputs['input_ids'].shape[-1]) + 1
+			with instrumentation.stage('generate'):
+				return super().prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys, **gen_kwargs)
+
+	_RELATION_TRAINER = RelationTrainer
+	return RelationTrainer
 
 
 CUR_EPOCH = 0
-def run_training_loop(MODEL_CKPT, DATASET, ENCODING):
-	delinearize = getattr(linearization, f'delinearize_{ENCODING}')
+# with NUM_EVAL_WORKERS > 1, how many eval rows to save up before handing them to the worker pool
+SCORER_CHUNK_ROWS = 2048
+def run_training_loop(MODEL_CKPT, DATASET, ENCODING, NUM_EVAL_WORKERS=0, ARCHIVE_OUTPUTS=False, CONSTRAINED_GENERATION=False,
+                      GROUP_BY_LENGTH=True, CAP_GENERATION_LENGTH=False, WINDOW_INPUTS=False, EVIDENCE_INPUTS=False,
+                      PROFILE=False):
+	from transformers import Seq2SeqTrainingArguments, DataCollatorForSeq2Seq
+	from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
 	now = datetime.datetime.now()
 	timestamp = now.strftime("%d-%m-%H-%M-%S")
@@ -22,8 +82,12 @@ def run_training_loop(MODEL_CKPT, DATASET, ENCODING):
 	DATA_DIR = f'data/{DATASET}/{ENCODING}'
 	OUTPUT_DIR = f'outputs/{DATASET}/{ENCODING}_{MODEL_CKPT.replace("/", "-")}_{timestamp}'
 
+	# PROFILE: time the stages of the pipeline and count why relations get dropped (see instrumentation.py),
+	#          written out to profile_{epoch}.json and logged with each epoch's eval metrics
+	if PROFILE:
+		instrumentation.enable()
+
 	config = json.load(open(f'{DATA_DIR}/config.json', 'r'))
-	possible_labels = json.load(open(f'data/{DATASET}/rel_types.json'))
 	model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_CKPT)
 
 	# update the tokenizer with the special tokens we need for our ENCODING scheme
@@ -32,52 +96,196 @@ def run_training_loop(MODEL_CKPT, DATASET, ENCODING):
 	tokenizer = AutoTokenizer.from_pretrained(MODEL_CKPT)
 	tokenizer.add_tokens(new_tokens)
 	model.resize_token_embeddings(len(tokenizer))
+	# build the decoding tables once up front, rather than re-reading them on every eval
+	schema = get_decoding_schema(DATASET, ENCODING, tokenizer)
+	possible_labels = schema.relation_types
 
-	# parse the .json data (outputs from process.{dataset}.py) into huggingface Datasets
-	split2filename = {
-		'train': f'{DATA_DIR}/train.json',
-		'eval': f'{DATA_DIR}/eval.json'
+	# the max lengths come from config.json (see length_profile.py), but can't be more than the model takes
+	MAX_LENGTHS = {
+		'text': min(config['input_ids_max_len'], tokenizer.model_max_length),
+		'target': min(config['labels_max_len'], tokenizer.model_max_length),
 	}
-	dataset: Dataset = cast(Dataset, load_dataset('json', data_files=split2filename))
+	if 'length_profile' not in config:
+		print(f'{DATA_DIR}/config.json has the default max lengths; run length_profile.py to fit them to the data')
+	elif config['length_profile']['tokenizer'] != MODEL_CKPT:
+		print(f'{DATA_DIR}/config.json was profiled with {config["length_profile"]["tokenizer"]}, not {MODEL_CKPT}')
+	print(MAX_LENGTHS)
+
+	# the articles and their targets, from the binary corpora build.py writes next to the .json data (opening
+	# one is just an mmap, and the articles only get built as they're read; see corpus.py)
+	split2filename = {split: build.corpus_path(DATASET, ENCODING, split) for split in ['train', 'eval']}
+	# optionally build the inputs differently from the raw data (see windowing.py):
+	#   WINDOW_INPUTS:   rather than truncating long documents, split them into windows that fit, each of which
+	#                    is an example with the gold relations that are in it as its target. The eval outputs are
+	#                    per window too (inputs/eval_windows.json has which document each one came from)
+	#   EVIDENCE_INPUTS: only the sentences that the gold relations' evidence is in, and their neighbours. Much
+	#                    shorter inputs for the *_evidence encodings, but it takes the gold evidence, eval included
+	assert not (WINDOW_INPUTS and EVIDENCE_INPUTS)
+	if WINDOW_INPUTS or EVIDENCE_INPUTS:
+		input_dir = pathlib.Path(f'{OUTPUT_DIR}/inputs')
+		input_dir.mkdir(parents=True, exist_ok=True)
+		for split in split2filename:
+			articles = utils.read_articles(split2filename[split])
+			split2filename[split] = f'{input_dir}/{split}.corpus'
+			with instrumentation.stage('linearize'):
+				if WINDOW_INPUTS:
+					windows = list(windowing.window_documents(articles, tokenizer, DATASET, ENCODING, MAX_LENGTHS['text']))
+					docs = [doc for _, _, doc in windows]
+					json.dump([{'doc': doc_idx, 'window': window_idx} for doc_idx, window_idx, _ in windows],
+					          open(f'{input_dir}/{split}_windows.json', 'w'))
+				else:
+					docs = list(windowing.evidence_documents(articles, DATASET, ENCODING))
+				utils.write_articles(docs, split2filename[split])
+	with instrumentation.stage('load'):
+		dataset = {split: utils.read_articles(fname) for split, fname in split2filename.items()}
 	# tokenization!
+	# datasets that come split into words (see Article.words) are tokenized from the words, not the text.
+	# Byte-level BPE tokenizers (BART's) need telling to put spaces between them
+	# (server.py tokenizes its inputs the same way)
+	word_tokenizer = utils.load_word_tokenizer(tokenizer, MODEL_CKPT, new_tokens)
+	# the targets are mostly our added tokens, which TargetEncoder handles a lot faster than the tokenizer
+	target_encoder = TargetEncoder(tokenizer, ENCODING)
 	def preprocess_data(examples):
-		model_inputs = tokenizer(examples['text'],   max_length = 512, truncation = True)
-		targets      = tokenizer(examples['target'], max_length = 512, truncation = True)
-		model_inputs['labels'] = targets['input_ids']
+		if 'words' in examples:
+			model_inputs = word_tokenizer(examples['words'], is_split_into_words = True,
+			                              max_length = MAX_LENGTHS['text'], truncation = True)
+		else:
+			model_inputs = tokenizer(examples['text'], max_length = MAX_LENGTHS['text'], truncation = True)
+		model_inputs['labels'] = target_encoder.encode(examples['target'], max_length = MAX_LENGTHS['target'], truncation = True)
 		return model_inputs
 
-	tokenized_dataset: Dataset = dataset.map(preprocess_data, batched=True)
+	# only actually tokenizes if this tokenizer/data/max length combination hasn't been seen before
+	with instrumentation.stage('tokenize'):
+		tokenized_dataset = token_cache.get_tokenized(tokenizer, split2filename, dataset, preprocess_data, MAX_LENGTHS)
 	# just a quick peek to make sure everything looks sane
 	print(tokenized_dataset['eval'][0]['labels'])
 	print(tokenizer.convert_ids_to_tokens(tokenized_dataset['eval'][0]['labels']))
 	print(len(tokenized_dataset['eval'][0]['labels']))
 
-	def compute_accuracy(eval_pred):
+	# nothing longer than the longest training target is worth generating
+	GENERATION_MAX_LENGTH = MAX_LENGTHS['target']
+	# GROUP_BY_LENGTH: group the batches by length (so outputs_{epoch}.json comes out in length order; each
+	#                  output's 'row' is which row of the eval split it is)
+	# CAP_GENERATION_LENGTH: only generate as far as each eval batch's inputs call for (see batching.py)
+	train_lengths = eval_order = length_envelope = None
+	if GROUP_BY_LENGTH:
+		train_lengths = tokenized_dataset['train'].lengths('input_ids')
+		eval_order = batching.length_sorted_order(tokenized_dataset['eval'].lengths('input_ids'))
+	if CAP_GENERATION_LENGTH:
+		length_envelope = batching.TargetLengthEnvelope(tokenized_dataset['train'].lengths('input_ids'),
+		                                                tokenized_dataset['train'].lengths('labels'),
+		                                                GENERATION_MAX_LENGTH)
+		print(length_envelope)
+	# which row of the eval split each eval output is
+	eval_rows = eval_order if eval_order is not None else range(len(tokenized_dataset['eval']))
+
+	# optionally farm the delinearization and alignment out to a pool of worker processes
+	scorer = None
+	if NUM_EVAL_WORKERS > 1:
+		scorer = evaluate.ParallelScorer(tokenizer, DATASET, ENCODING, NUM_EVAL_WORKERS)
+
+	# optionally archive the raw eval outputs in binary on a background thread (see archive.py) rather
+	# than decoding them and writing outputs_{epoch}.json in the middle of training
+	archiver = None
+	if ARCHIVE_OUTPUTS:
+		archiver = archive.PredictionArchiver(OUTPUT_DIR, possible_labels, {
+			'model_ckpt': MODEL_CKPT,
+			'tokens_file': f'{DATA_DIR}/tokens.json',
+			'eval_file': split2filename['eval'],
+			# -100s get replaced by 0 below, so that's padding too if it's a special token
+			'pad_ids': sorted({tokenizer.pad_token_id} | ({0} & set(tokenizer.all_special_ids))),
+		})
+
+	# eval is scored a batch at a time (batch_eval_metrics), so only the current batch and the label
+	# counts so far are ever held in memory; the outputs file is streamed out as we go
+	# (with NUM_EVAL_WORKERS, the batches are saved up in 'pending' and handed to the pool SCORER_CHUNK_ROWS rows
+	# at a time, since eval batches are far too small to be worth sharding across processes one by one)
+	eval_state = {'accumulator': None, 'writer': None, 'offset': 0, 'pending': []}
+
+	def write_outputs(predictions, labels, pred_relations, true_relations):
+		# the eval order is fixed, so this batch is the next slice of it
+		offset = eval_state['offset']
+		eval_state['offset'] += len(predictions)
+		rows = eval_rows[offset:offset + len(predictions)]
+		with instrumentation.stage('write'):
+			if archiver is not None:
+				archiver.add_batch(predictions, labels, rows, pred_relations, true_relations)
+			else:
+				texts = [dataset['eval'][int(row)].text for row in rows]
+				for row, text, p_toks, t_toks, p_rels, t_rels in zip(rows, texts, predictions, labels, pred_relations, true_relations):
+					eval_state['writer'].write({
+						'row': int(row),
+						'text': text,
+						'pred_target': tokenizer.decode(p_toks, skip_special_tokens=True),
+						'true_target': tokenizer.decode(t_toks, skip_special_tokens=True),
+						'pred_relations': [rel.to_dict() for rel in p_rels],
+						'true_relations': [rel.to_dict() for rel in t_rels]
+					})
+
+	def score_pending():
+		# delinearize and count the saved-up batches in the pool, all at once, then write them out batch by batch
+		pending, eval_state['pending'] = eval_state['pending'], []
+		if not pending:
+			return
+		with instrumentation.stage('parallel_scoring'):
+			pred_relations, true_relations, label_counts = scorer.delinearize_and_count(
+				[row for predictions, _ in pending for row in predictions], [row for _, labels in pending for row in labels])
+		eval_state['accumulator'].update_counts(label_counts, len(true_relations))
+		n_done = 0
+		for predictions, labels in pending:
+			write_outputs(predictions, labels, pred_relations[n_done:n_done + len(predictions)],
+			              true_relations[n_done:n_done + len(predictions)])
+			n_done += len(predictions)
+
+	def compute_accuracy(eval_pred, compute_result=True):
+		global CUR_EPOCH
 		predictions, labels = eval_pred
+		# batches come straight off the device
+		predictions = predictions.cpu().numpy() if hasattr(predictions, 'cpu') else predictions
+		labels = labels.cpu().numpy() if hasattr(labels, 'cpu') else labels
 		# TODO: figure out where the hell -100 token_ids are coming from
 		# tokenizer.pad_token_id and model.config.json.pad_token_id are both 0. what do?
 		labels[labels==-100] = 0
 		predictions[predictions==-100] = 0
-		pred_relations = delinearize(predictions, tokenizer, DATASET)
-		true_relations = delinearize(labels, tokenizer, DATASET)
 
-		# TODO: score the predictions using confusion matrix stats from eval.py!
-		global CUR_EPOCH
-		outputs = []
-		for text, p_toks, t_toks, p_rels, t_rels in zip(dataset['eval']['text'], predictions, labels, pred_relations, true_relations):
-			outputs.append({
-				'text': text,
-				'pred_target': tokenizer.decode(p_toks, skip_special_tokens=True),
-				'true_target': tokenizer.decode(t_toks, skip_special_tokens=True),
-				'pred_relations': [rel.to_dict() for rel in p_rels],
-				'true_relations': [rel.to_dict() for rel in t_rels]
-			})
-		path = pathlib.Path(OUTPUT_DIR)
-		if not path.exists():
-			path.mkdir(parents=True, exist_ok=True)
-		json.dump(outputs, open(f'{OUTPUT_DIR}/outputs_{CUR_EPOCH}.json', 'w'), indent=2)
+		if eval_state['accumulator'] is None:
+			# first batch of this epoch's eval
+			path = pathlib.Path(OUTPUT_DIR)
+			if not path.exists():
+				path.mkdir(parents=True, exist_ok=True)
+			eval_state['accumulator'] = evaluate.ScoreAccumulator(possible_labels)
+			if archiver is not None:
+				archiver.start_epoch(CUR_EPOCH)
+			else:
+				eval_state['writer'] = utils.JsonArrayWriter(f'{OUTPUT_DIR}/outputs_{CUR_EPOCH}.json')
+			eval_state['offset'] = 0
+		accumulator = eval_state['accumulator']
+
+		if scorer is not None:
+			eval_state['pending'].append((predictions, labels))
+			if compute_result or sum(len(p) for p, _ in eval_state['pending']) >= SCORER_CHUNK_ROWS:
+				score_pending()
+		else:
+			pred_relations = linearization.delinearize_batch(predictions, tokenizer, DATASET, ENCODING, stage='delinearize/pred')
+			true_relations = linearization.delinearize_batch(labels, tokenizer, DATASET, ENCODING, stage='delinearize/true')
+			accumulator.update(true_relations, pred_relations)
+			write_outputs(predictions, labels, pred_relations, true_relations)
+
+		if not compute_result:
+			return {}
+		if archiver is not None:
+			archiver.end_epoch()
+		else:
+			eval_state['writer'].close()
+		eval_state['accumulator'] = eval_state['writer'] = None
+		result = accumulator.result()
+		if instrumentation.enabled():
+			# everything since the last epoch's eval (so the first one has the setup and the training in it too)
+			profile = instrumentation.take()
+			profile.write(f'{OUTPUT_DIR}/profile_{CUR_EPOCH}.json')
+			result.update(profile.metrics())
 		CUR_EPOCH += 1
-		return evaluate.compute_score(true_relations, pred_relations, possible_labels)
+		return result
 
 	data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
 	args = Seq2SeqTrainingArguments(
@@ -90,20 +298,34 @@ def run_training_loop(MODEL_CKPT, DATASET, ENCODING):
 			per_device_train_batch_size=10,
 			per_device_eval_batch_size=8,
 			predict_with_generate=True,
-			generation_max_length=500,
+			generation_max_length=GENERATION_MAX_LENGTH,
+			batch_eval_metrics=True,
 	)
 
-	trainer = Seq2SeqTrainer(
+	# optionally only let the model generate targets that parse under the encoding's grammar (see constraints.py)
+	logits_processor = None
+	if CONSTRAINED_GENERATION:
+		logits_processor = constraints.grammar_logits_processor(tokenizer, DATASET, ENCODING)
+
+	trainer = relation_trainer_class()(
 			model,
 			args,
 			train_dataset=tokenized_dataset["train"],
 			eval_dataset=tokenized_dataset["eval"],
 			data_collator=data_collator,
 			tokenizer=tokenizer,
-			compute_metrics=compute_accuracy)
+			compute_metrics=compute_accuracy,
+			logits_processor=logits_processor,
+			train_lengths=train_lengths,
+			eval_order=eval_order,
+			length_envelope=length_envelope)
 
 	print(OUTPUT_DIR)
 	trainer.train()
+	if scorer is not None:
+		scorer.close()
+	if archiver is not None:
+		archiver.close()
 
 if __name__ == '__main__':
 	MODEL_CKPT = "facebook/bart-large"
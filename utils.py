@@ -1,5 +1,7 @@
-from typing import Iterable
+from typing import Iterable, Iterator
+import json
 from classes import Article
+from corpus import Corpus, write_corpus
 
 def split_seq(seq: list, val) -> list[list]:
     """
@@ -26,8 +28,128 @@ def partition_seq(seq: list, percentage: float):
     return seq[:part_idx], seq[part_idx:]
 
 
+def joins_words_without_spaces(tokenizer) -> bool:
+    """
+    returns:
+        whether tokenizing pre-split words (is_split_into_words=True) would run them together, i.e. it's a
+        byte-level BPE tokenizer (GPT-2, RoBERTa, BART) that wasn't loaded with add_prefix_space=True
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is None:
+        return False
+    pre_tokenizer = json.loads(backend.to_str()).get('pre_tokenizer') or {}
+    return any(p.get('type') == 'ByteLevel' and not p.get('add_prefix_space')
+               for p in pre_tokenizer.get('pretokenizers', [pre_tokenizer]))
+
+
+def load_word_tokenizer(tokenizer, model_ckpt: str, new_tokens: list[str]):
+    """
+    parameters:
+        tokenizer: the model's tokenizer, with new_tokens already added
+    returns:
+        the tokenizer to tokenize pre-split words with (is_split_into_words=True): tokenizer itself, unless it
+        would run them together, in which case the same one loaded with add_prefix_space=True
+    """
+    if not joins_words_without_spaces(tokenizer):
+        return tokenizer
+    from transformers import AutoTokenizer
+    word_tokenizer = AutoTokenizer.from_pretrained(model_ckpt, add_prefix_space=True)
+    word_tokenizer.add_tokens(new_tokens)
+    return word_tokenizer
+
+
+# binary, memory-mapped corpus files; see corpus.py for the format
 def write_articles(articles: list[Article], fname: str) -> None:
-    ...
+    write_corpus(articles, fname)
+
+def read_articles(fname: str) -> Corpus:
+    """
+    returns:
+        a read-only sequence of the articles in fname. Opening it doesn't parse anything; articles are
+        built as they're indexed, and slicing it (e.g. with partition_seq) doesn't copy anything.
+    """
+    return Corpus(fname)
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """
+    parameters:
+        items: any iterable (e.g. a generator of Articles)
+        size: the max number of items per chunk
+    returns:
+        the items, in lists of (up to) size items each
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_json_array(fname: str, chunk_size: int = 1 << 16) -> Iterator:
+    """
+    parameters:
+        fname: path to a file containing one top-level JSON array
+    returns:
+        the elements of the array one at a time, without ever holding more than one of them
+        (plus a chunk of the file) in memory
+    """
+    decoder = json.JSONDecoder()
+    with open(fname, 'r') as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f'{fname} does not contain a JSON array')
+        buf = buf[1:]
+        at_eof = False
+        while True:
+            buf = buf.lstrip().lstrip(',').lstrip()
+            if buf.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buf)
+                # make sure we can see what comes after the element; otherwise a number
+                # could have been cut off part way through by the end of the buffer
+                rest = buf[end:].lstrip()
+                if not rest[:1] or rest[0] not in ',]':
+                    raise json.JSONDecodeError('Expecting \',\' delimiter', buf, end)
+            except json.JSONDecodeError:
+                if at_eof:
+                    raise
+                # read at least as much again as we already have, so big elements don't go quadratic
+                more = f.read(max(chunk_size, len(buf)))
+                at_eof = not more
+                buf += more
+                continue
+            yield item
+            buf = buf[end:]
+
+
+class JsonArrayWriter:
+    """
+    Writes a JSON array one element at a time. The file comes out exactly the same as
+    json.dump(items, f, indent=2) would have written it.
+    """
+    def __init__(self, fname: str):
+        self.f = open(fname, 'w')
+        self.n_written = 0
+
+    def write(self, item) -> None:
+        item_str = json.dumps(item, indent=2).replace('\n', '\n  ')
+        self.f.write(('[\n  ' if self.n_written == 0 else ',\n  ') + item_str)
+        self.n_written += 1
+
+    def write_all(self, items: Iterable) -> None:
+        for item in items:
+            self.write(item)
+
+    def close(self) -> None:
+        self.f.write('\n]' if self.n_written else '[]')
+        self.f.close()
+
+    def __enter__(self):
+        return self
 
-def read_articles(fname: str) -> list[Article]:
-    ...
\ No newline at end of file
+    def __exit__(self, *exc_info):
+        self.close()
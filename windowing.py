@@ -0,0 +1,376 @@
+import re
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+import batching
+import linearization
+import utils
+from classes import Article, Entity, Relation
+
+# Extraction from documents that are longer than the encoder takes. Rather than truncating them (and never
+# seeing the relations in the tail), the text is split into overlapping windows that each fit, on sentence
+# boundaries where possible:
+#
+#   |-- window 0 --------------|
+#                      |-- window 1 --------------|
+#                                         |-- window 2 ------|
+#   s0    s1    s2     s3    s4     s5    s6    s7     s8
+#
+# Each window starts as many sentences before the previous one ended as fit in `overlap` tokens, so a
+# relation that's stated across a boundary is still entirely inside one of them. A single sentence that doesn't fit on its own gets split
+# wherever the tokens run out. Documents that fit are one window, i.e. exactly what they were before.
+#
+# All of the windows get generated for in batches of at most batch_size windows (so memory goes with the
+# window length, not the document's), and each document's relations are the union of its windows',
+# deduplicated on (relation type, entity spans) with the spans' case/whitespace normalized.
+#
+# For training/scoring, window_articles gives each window the gold relations it can actually be expected to
+# find: the ones whose evidence sentences are inside it when the sentence numbering is known to be the
+# dataset's own (the article's sentences, or pass them in), and otherwise the ones whose entity spans all
+# appear in it.
+#
+# For training the *_evidence encodings there's also evidence_article, which goes the other way: the input
+# is only the sentences that the gold relations' evidence is in (and their neighbours), which is a lot
+# shorter than the whole document. It needs the gold evidence, so it's only for training/eval.
+
+# how many tokens (at most) consecutive windows share, in whole sentences
+DEFAULT_OVERLAP = 128
+# how many sentences either side of the evidence evidence_article keeps
+DEFAULT_NEIGHBOURS = 1
+DEFAULT_BATCH_SIZE = 8
+
+# a sentence ends at ./!/? followed by whitespace, or at a blank line (the section breaks in the abstracts)
+_SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+(?=\S)|\n\s*\n\s*')
+
+
+class Window:
+    """
+    A window of a document: the characters [start, end), which are the sentences [first_sentence, last_sentence).
+    """
+    __slots__ = ('start', 'end', 'first_sentence', 'last_sentence')
+
+    def __init__(self, start: int, end: int, first_sentence: int, last_sentence: int):
+        self.start = start
+        self.end = end
+        self.first_sentence = first_sentence
+        self.last_sentence = last_sentence
+
+    def __repr__(self) -> str:
+        return f'<Window chars {self.start}:{self.end}|sentences {self.first_sentence}:{self.last_sentence}>'
+
+    def text(self, document: str) -> str:
+        return document[self.start:self.end]
+
+
+def sentence_spans(text: str) -> list[tuple[int, int]]:
+    """
+    returns:
+        the (start, end) character offsets of each sentence in text, by a simple punctuation rule
+    """
+    spans = []
+    start = len(text) - len(text.lstrip())
+    for match in _SENTENCE_BREAK.finditer(text, start):
+        if match.start() > start:
+            spans.append((start, match.start()))
+        start = match.end()
+    end = len(text.rstrip())
+    if end > start:
+        spans.append((start, end))
+    return spans
+
+
+def make_windows(text: str, tokenizer, max_tokens: int, overlap: int = DEFAULT_OVERLAP,
+                 sentences: Optional[list[tuple[int, int]]] = None) -> list[Window]:
+    """
+    parameters:
+        max_tokens: the encoder's max input length (including special tokens)
+        sentences: the (start, end) character offsets of the sentences, if they're already known; otherwise
+            they're found with sentence_spans
+    returns:
+        the windows to cover text with, in order
+    """
+    budget = max(max_tokens - tokenizer.num_special_tokens_to_add(), 1)
+    sentences = sentences if sentences is not None else sentence_spans(text)
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+    if len(offsets) <= budget or not sentences:
+        return [Window(0, len(text), 0, len(sentences))]
+
+    # which sentence each token starts in, and so how many tokens each sentence is
+    token_starts = np.array([start for start, _ in offsets])
+    sentence_starts = np.array([start for start, _ in sentences])
+    token_sentence = np.maximum(np.searchsorted(sentence_starts, token_starts, side='right') - 1, 0)
+    n_tokens = np.bincount(token_sentence, minlength=len(sentences))
+
+    windows = []
+    first = prev_last = 0
+    while first < len(sentences):
+        last, total = first, 0
+        while last < len(sentences) and total + n_tokens[last] <= budget:
+            total += n_tokens[last]
+            last += 1
+        # the counts are from tokenizing the whole text, which can differ a little at the window's edges
+        while last > first + 1 and _n_tokens(tokenizer, text[sentences[first][0]:sentences[last - 1][1]]) > budget:
+            last -= 1
+        if first < prev_last and last <= prev_last:
+            # with the overlap, this window wouldn't get any further than the last one did
+            first = prev_last
+            continue
+        if last == first:
+            # this sentence doesn't fit by itself, so it gets chopped up wherever the tokens run out
+            tokens = np.nonzero(token_sentence == first)[0]
+            bounds = [sentences[first][0]] + [offsets[tokens[i]][0] for i in range(budget, len(tokens), budget)]
+            bounds.append(sentences[first][1])
+            windows += [Window(start, end, first, first + 1) for start, end in zip(bounds, bounds[1:])]
+            last = first + 1
+        else:
+            windows.append(Window(sentences[first][0], sentences[last - 1][1], first, last))
+        if last >= len(sentences):
+            break
+        # back up to the earliest sentence that keeps the shared part within `overlap` tokens, but always
+        # move forward
+        next_first = last
+        while next_first > first + 1 and n_tokens[next_first - 1:last].sum() <= overlap:
+            next_first -= 1
+        first, prev_last = next_first, last
+    return windows
+
+
+def _squeeze(text: str) -> str:
+    return ''.join(text.split())
+
+
+def _n_tokens(tokenizer, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False)['input_ids'])
+
+
+def _evidence_range(rel: Relation) -> Optional[tuple[int, int]]:
+    try:
+        return int(rel.evidence[0]), int(rel.evidence[-1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def window_relations(relations: list[Relation], text: str, window: Window, by_evidence: bool = False) -> list[Relation]:
+    """
+    parameters:
+        by_evidence: the window's sentence numbers are the same as the ones in the relations' evidence, so
+            use that to decide what's in the window (and renumber the evidence from the window's first sentence)
+    returns:
+        the gold relations that the window can be expected to produce
+    """
+    if window.start == 0 and window.end == len(text):
+        return relations
+    # whitespace doesn't count, since the spans are often tokenized differently from the text ("group , and")
+    window_text = _squeeze(window.text(text))
+    inside = []
+    for rel in relations:
+        evidence = _evidence_range(rel) if by_evidence else None
+        if evidence is not None:
+            if window.first_sentence <= evidence[0] and evidence[1] < window.last_sentence:
+                shifted = [evidence[0] - window.first_sentence, evidence[1] - window.first_sentence]
+                inside.append(Relation(rel.rtype, list(rel.entities), list(rel.slots), evidence=shifted))
+        elif all(_squeeze(ent.span) in window_text for ent in rel.entities):
+            inside.append(rel)
+    return inside
+
+
+def window_articles(article: Article, tokenizer, max_tokens: int, overlap: int = DEFAULT_OVERLAP,
+                    sentences: Optional[list[tuple[int, int]]] = None) -> list[tuple[Window, Article]]:
+    """
+    parameters:
+        sentences: the dataset's own sentence offsets, which the relations' evidence refers to (by default
+            the article's, if it has them)
+    returns:
+        each window of the article, along with an Article of its text and the gold relations mapped to it
+        (which keeps the article's words and sentences, if it has them)
+    """
+    # the window's sentences can only be taken from the article's words if they're the article's sentences
+    with_words = article.words is not None and sentences is None
+    if sentences is None:
+        sentences = article.sentence_spans
+    windows = make_windows(article.text, tokenizer, max_tokens, overlap, sentences)
+    windowed = []
+    for window in windows:
+        relations = window_relations(article.relations, article.text, window, sentences is not None)
+        if len(windows) == 1:
+            doc = Article(article.text, relations, article.words, article.sentence_offsets)
+        elif with_words and (window.start, window.end) == (sentences[window.first_sentence][0],
+                                                           sentences[window.last_sentence - 1][1]):
+            doc = Article.from_sentences([article.sentence_words(i) for i in range(window.first_sentence, window.last_sentence)],
+                                         relations)
+        elif with_words:
+            # a piece of a sentence
+            doc = Article.from_sentences([window.text(article.text).split()], relations)
+        else:
+            doc = Article(window.text(article.text), relations)
+        windowed.append((window, doc))
+    return windowed
+
+
+def window_documents(articles: Iterator[Article], tokenizer, dataset: str, encoding: str, max_tokens: int,
+                     overlap: int = DEFAULT_OVERLAP) -> Iterator[tuple[int, int, Article]]:
+    """
+    returns:
+        for each window of each article: the index of the document it came from, which of its windows it is,
+        and the window as an Article, with its target
+    """
+    linearize = linearization.LINEARIZERS[encoding]
+    for doc_idx, article in enumerate(articles):
+        window_docs = [doc for _, doc in window_articles(article, tokenizer, max_tokens, overlap)]
+        for window_idx, (doc, target) in enumerate(zip(window_docs, linearize(window_docs, dataset))):
+            doc.target = target
+            yield doc_idx, window_idx, doc
+
+
+def window_records(articles: Iterator[Article], tokenizer, dataset: str, encoding: str, max_tokens: int,
+                   overlap: int = DEFAULT_OVERLAP) -> Iterator[dict]:
+    """
+    returns:
+        a data record (as in linearization.data_records) for each window of each article, with the index
+        of the document it came from ('doc') and which of its windows it is ('window')
+    """
+    for doc_idx, window_idx, doc in window_documents(articles, tokenizer, dataset, encoding, max_tokens, overlap):
+        record = next(linearization.data_records([doc], [doc.target]))
+        record['doc'] = doc_idx
+        record['window'] = window_idx
+        yield record
+
+
+def evidence_article(article: Article, neighbours: int = DEFAULT_NEIGHBOURS) -> Article:
+    """
+    returns:
+        the article cut down to the sentences that its relations' evidence is in, plus `neighbours` sentences
+        either side, with the evidence renumbered to match. An article without sentences or usable evidence
+        comes back as it is
+    """
+    n_sentences = article.n_sentences
+    in_range = lambda evidence: evidence is not None and 0 <= evidence[0] <= evidence[1] < n_sentences
+    keep = set()
+    for rel in article.relations:
+        evidence = _evidence_range(rel)
+        if in_range(evidence):
+            keep.update(range(max(evidence[0] - neighbours, 0), min(evidence[1] + neighbours + 1, n_sentences)))
+    if not keep:
+        return article
+    kept = sorted(keep)
+    renumbered = {old: new for new, old in enumerate(kept)}
+    relations = []
+    for rel in article.relations:
+        evidence = _evidence_range(rel)
+        if in_range(evidence):
+            rel = Relation(rel.rtype, list(rel.entities), list(rel.slots),
+                           evidence=[renumbered[evidence[0]], renumbered[evidence[1]]])
+        relations.append(rel)
+    return Article.from_sentences([article.sentence_words(i) for i in kept], relations)
+
+
+def evidence_documents(articles: Iterator[Article], dataset: str, encoding: str,
+                       neighbours: int = DEFAULT_NEIGHBOURS) -> Iterator[Article]:
+    """
+    returns:
+        the evidence_article of each article, with its target
+    """
+    linearize = linearization.LINEARIZERS[encoding]
+    for docs in utils.chunked(articles, 1000):
+        docs = [evidence_article(article, neighbours) for article in docs]
+        for doc, target in zip(docs, linearize(docs, dataset)):
+            doc.target = target
+            yield doc
+
+
+def evidence_records(articles: Iterator[Article], dataset: str, encoding: str,
+                     neighbours: int = DEFAULT_NEIGHBOURS) -> Iterator[dict]:
+    """
+    returns:
+        a data record (as in linearization.data_records) for the evidence_article of each article
+    """
+    for docs in utils.chunked(evidence_documents(articles, dataset, encoding, neighbours), 1000):
+        yield from linearization.data_records(docs, [doc.target for doc in docs])
+
+
+def _span_key(span: str) -> str:
+    return ' '.join(span.split()).casefold()
+
+def merge_relations(relation_lists: list[list[Relation]], windows: Optional[list[Window]] = None) -> list[Relation]:
+    """
+    parameters:
+        relation_lists: the relations from each window of one document
+        windows: the windows, to renumber predicted evidence from window sentences to document sentences
+    returns:
+        the union of the relations, in order, with the ones that only differ in the case or whitespace of
+        their entity spans counted as the same
+    """
+    merged: dict[tuple, Relation] = {}
+    for i, relations in enumerate(relation_lists):
+        offset = windows[i].first_sentence if windows is not None else 0
+        for rel in relations:
+            key = (rel.rtype, tuple(_span_key(ent.span) for ent in rel.entities))
+            if key in merged:
+                continue
+            evidence = _evidence_range(rel)
+            if windows is not None and evidence is not None:
+                rel = Relation(rel.rtype, list(rel.entities), list(rel.slots),
+                               evidence=[evidence[0] + offset, evidence[1] + offset])
+            merged[key] = rel
+    return list(merged.values())
+
+
+def extract_windowed(texts: list[str], tokenizer, max_tokens: int, extract_batch: Callable[[list[str]], list[list[Relation]]],
+                     batch_size: int = DEFAULT_BATCH_SIZE, overlap: int = DEFAULT_OVERLAP,
+                     sentences: Optional[list[list[tuple[int, int]]]] = None) -> list[list[Relation]]:
+    """
+    parameters:
+        extract_batch: generates for a batch of texts (that fit) and delinearizes the outputs
+        batch_size: how many windows go to extract_batch at a time
+        sentences: each text's sentence offsets (if known), which predicted evidence gets renumbered by
+    returns:
+        each text's relations, merged across its windows
+    """
+    windows = [make_windows(text, tokenizer, max_tokens, overlap, sentences[i] if sentences else None)
+               for i, text in enumerate(texts)]
+    flat = [(doc_idx, window.text(texts[doc_idx])) for doc_idx, doc_windows in enumerate(windows) for window in doc_windows]
+    # the windows are batched longest first, so each batch is padded about as little as it can be
+    order = batching.length_sorted_order(np.array([len(text) for _, text in flat], dtype=np.int64))
+    window_relations = [None] * len(flat)
+    for i in range(0, len(order), batch_size):
+        batch = order[i:i + batch_size]
+        for j, relations in zip(batch, extract_batch([flat[j][1] for j in batch])):
+            window_relations[j] = relations
+
+    merged, i = [], 0
+    for doc_windows in windows:
+        doc_relations = window_relations[i:i + len(doc_windows)]
+        i += len(doc_windows)
+        merged.append(merge_relations(doc_relations, doc_windows if sentences else None))
+    return merged
+
+
+def test_windowing(tokenizer, dataset: str = 'evidence_inference', encoding: str = 'boring', max_tokens: int = 512,
+                   overlap: int = DEFAULT_OVERLAP):
+    # how much of the gold the windows can see, compared to truncating (a document that fits sees all of it)
+    n_docs = n_gold = n_truncated = n_windowed = n_windows = 0
+    for record in utils.iter_json_array(f'data/{dataset}/{encoding}/eval.json'):
+        text = record['text']
+        relations = [Relation(r['rtype'], [Entity(None, e['span']) for e in r['entities'].values()],
+                              list(r['entities'])) for r in record['relations']]
+        windows = make_windows(text, tokenizer, max_tokens, overlap)
+        for window in windows:
+            # (the pieces of a sentence that's too long by itself can come out a token or two over, and get truncated)
+            if window.last_sentence - window.first_sentence > 1:
+                assert len(tokenizer(window.text(text))['input_ids']) <= max_tokens, window
+        # every (non-space) character of the text is in some window
+        covered = np.zeros(len(text), dtype=bool)
+        for window in windows:
+            covered[window.start:window.end] = True
+        assert all(c.isspace() for c in np.array(list(text))[~covered]) if len(text) else True
+        offsets = tokenizer(text, max_length=max_tokens, truncation=True, return_offsets_mapping=True)['offset_mapping']
+        truncated = max(end for _, end in offsets)
+        n_docs += 1
+        n_gold += len(relations)
+        n_truncated += len(window_relations(relations, text, Window(0, truncated, 0, 0)))
+        n_windowed += sum(any(window_relations([rel], text, Window(window.start, window.end, 0, 0)) for window in windows)
+                          for rel in relations)
+        n_windows += len(windows)
+    print(f'{dataset}: {n_docs} docs -> {n_windows} windows; of {n_gold} gold relations, '
+          f'{n_truncated} are in the truncated text, {n_windowed} in some window')